@@ -0,0 +1,120 @@
+"""Recovery time and lost events of the poll loop under hub faults.
+
+For each fault, runs the subscription of a controller against a simulated
+hub, makes deviceListGet fail with the fault for an outage while devices
+keep changing, and reports:
+
+- failed: polls answered with the fault
+- recover: seconds from the end of the outage until a change made then
+  is reported
+- lost: switch flips never reported, as they were undone before a poll
+  succeeded
+
+    python benchmarks/fault_recovery.py [--outage 3] [--retry-base 3]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyclimax  # noqa: E402
+from pyclimax.scheduler import PollScheduler, RETRY_MAX  # noqa: E402
+from pyclimax.subscribe import SUBSCRIPTION_RETRY  # noqa: E402
+from pyclimax.test_server.simulator import FAULTS, HubSimulator  # noqa: E402
+
+# Seconds deviceListGet fails for
+OUTAGE = 3
+# Seconds between device changes on the hub
+CHANGE_INTERVAL = 0.2
+# Switches on the hub, few so that they flip more than once per outage
+DEVICES = 5
+# Seconds a stalled request is held, longer than the read timeout
+STALL_TIME = 10
+# Seconds to wait for the recovery before giving up
+RECOVERY_LIMIT = 120
+
+
+def run(fault, args):
+    """Return (failed polls, recovery seconds or None, lost, changes)."""
+    hub = HubSimulator({48: args.devices, 20: 1}, block_polls=False,
+                       long_poll=args.long_poll)
+    sensor = [row['id'] for row in hub.rows if row['type'] == 20][0]
+    hub.stall_time = STALL_TIME
+    scheduler = PollScheduler(retry_base=args.retry_base,
+                              retry_max=args.retry_max)
+    controller = pyclimax.ClimaxController(
+        hub.url, 'user', 'password', connect_timeout=1, subscription_wait=1,
+        poll_scheduler=scheduler, long_poll=args.long_poll)
+    lock = threading.Lock()
+    seen = {}
+    reported = []
+
+    def on_changes(controller, changes):
+        with lock:
+            for device_id, fields in changes.changed.items():
+                if 'status' in fields:
+                    reported.append(device_id)
+                    event = seen.pop(device_id, None)
+                    if event is not None:
+                        event.set()
+
+    controller.register_changes(on_changes)
+    try:
+        controller.get_devices()
+        controller.start()
+        time.sleep(1)
+        del reported[:]
+        changes = 0
+        hub.inject(fault, duration=args.outage)
+        end = time.monotonic() + args.outage
+        while time.monotonic() < end:
+            hub.mutate(1)
+            changes += 1
+            time.sleep(CHANGE_INTERVAL)
+        recovered = threading.Event()
+        with lock:
+            seen[sensor] = recovered
+        hub.update(sensor, temperature=100.0)
+        start = time.monotonic()
+        recovery = None
+        if recovered.wait(RECOVERY_LIMIT):
+            recovery = time.monotonic() - start
+        # Let the last polls be reported
+        time.sleep(1)
+        failed = hub.faults_served.get(fault, 0)
+        lost = changes - len([device_id for device_id in reported
+                              if device_id != sensor])
+    finally:
+        controller.stop()
+        hub.close()
+    return failed, recovery, lost, changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--faults', nargs='+', choices=FAULTS,
+                        default=FAULTS)
+    parser.add_argument('--outage', type=float, default=OUTAGE)
+    parser.add_argument('--devices', type=int, default=DEVICES)
+    parser.add_argument('--retry-base', type=float,
+                        default=SUBSCRIPTION_RETRY)
+    parser.add_argument('--retry-max', type=float, default=RETRY_MAX)
+    parser.add_argument('--long-poll', action='store_true')
+    args = parser.parse_args()
+
+    print("{:<12}{:>8}{:>12}{:>12}".format(
+        'fault', 'failed', 'recover s', 'lost'))
+    for fault in args.faults:
+        failed, recovery, lost, changes = run(fault, args)
+        print("{:<12}{:>8}{:>12}{:>12}".format(
+            fault, failed,
+            'never' if recovery is None else '{:.2f}'.format(recovery),
+            '{}/{}'.format(lost, changes)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
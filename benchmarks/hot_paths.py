@@ -0,0 +1,227 @@
+"""Benchmarks of the pyclimax hot paths at growing device counts.
+
+Each benchmark drives the real code against a simulated hub with 10,
+100, 1,000 and 10,000 devices of mixed types, and reports the best time per
+operation and the peak memory (tracemalloc) of one run. Results are
+compared with a stored baseline, slower ones are flagged. Baselines are
+machine specific, save a new one before comparing on another machine.
+
+    python benchmarks/hot_paths.py                  # run and compare
+    python benchmarks/hot_paths.py --save-baseline  # store new baseline
+    python benchmarks/hot_paths.py --check          # exit 1 on regression
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyclimax  # noqa: E402
+from pyclimax.subscribe import SubscriptionRegistry  # noqa: E402
+from pyclimax.test_server.simulator import HubSimulator  # noqa: E402
+
+# Device counts benchmarked
+SIZES = (10, 100, 1000, 10000)
+# Device types the simulated devices are spread over
+TYPES = (48, 53, 20, 50, 11)
+# Timed repeats per benchmark and size, the best counts
+REPEATS = 7
+# Ratio to the baseline time above which a result is a regression
+THRESHOLD = 1.5
+# Stored results compared against
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+# Fraction of the devices changed between polls by bench_changed_devices
+CHANGED_FRACTION = 0.01
+# Commands sent per run by bench_set_device_value
+COMMANDS = 200
+# Device operations per run of the in-memory benchmarks, so that runs
+# are long enough to time
+IN_MEMORY_OPERATIONS = 100000
+
+
+def _hub(size):
+    """Return a simulated hub with size devices spread over TYPES."""
+    return HubSimulator({device_type: size // len(TYPES)
+                         + (number < size % len(TYPES))
+                         for number, device_type in enumerate(TYPES)},
+                        areas=4, seed=size)
+
+
+def _controller(hub, **kwargs):
+    return pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                     subscription_wait=0, **kwargs)
+
+
+def bench_get_devices(hub, size):
+    """Fetch, parse and build the devices with a new controller."""
+    def run():
+        with _controller(hub) as controller:
+            controller.get_devices()
+    return run, 1
+
+
+def bench_changed_devices(hub, size):
+    """Poll with get_changed_devices while 1% of the devices change."""
+    controller = _controller(hub)
+    controller.get_devices()
+    changes = max(1, int(size * CHANGED_FRACTION))
+
+    def prepare():
+        hub.mutate(changes)
+        hub.body()
+
+    def run():
+        controller.get_changed_devices()
+    return run, 1, prepare
+
+
+def bench_event_fanout(hub, size):
+    """SubscriptionRegistry._event with three callbacks per device."""
+    controller = _controller(hub)
+    devices = controller.get_devices()
+    registry = SubscriptionRegistry(controller, callback_workers=0)
+    calls = []
+    for device in devices:
+        registry.register(device, calls.append)
+        registry.register(device, lambda device, changes: None,
+                          fields={'status'})
+        registry.register(device, lambda device, changes: None,
+                          predicate=lambda device, changes: True)
+    changes = pyclimax.ChangeSet(changed={
+        device.device_id: {'status': ('Off, 0.0W', 'On, 1.3W')}
+        for device in devices})
+    passes = max(1, IN_MEMORY_OPERATIONS // 10 // len(devices))
+
+    def run():
+        for _ in range(passes):
+            del calls[:]
+            registry._event(devices, changes)
+    return run, passes * len(devices)
+
+
+def bench_properties(hub, size):
+    """Read the typed status properties of every device."""
+    controller = _controller(hub)
+    devices = controller.get_devices()
+    switches = [device for device in devices
+                if isinstance(device, pyclimax.ClimaxSwitch)]
+    dimmers = [device for device in devices
+               if isinstance(device, pyclimax.ClimaxDimmer)]
+    sensors = [device for device in devices
+               if isinstance(device, pyclimax.ClimaxSensor)]
+    passes = max(1, IN_MEMORY_OPERATIONS // len(devices))
+
+    def run():
+        for _ in range(passes):
+            for device in switches:
+                device.is_switched_on()
+                device.power
+            for device in dimmers:
+                device.level
+            for device in sensors:
+                device.temperature
+                device.energy
+    return run, passes * len(devices)
+
+
+def bench_set_device_value(hub, size):
+    """Send switch commands to the hub, without confirmation."""
+    controller = _controller(hub, confirm_commands=False)
+    switches = [device for device in controller.get_devices()
+                if device.type == pyclimax.CATEGORY_POWER_SWITCH_METER]
+
+    def run():
+        for number in range(COMMANDS):
+            switches[number % len(switches)].set_switch_state(number % 2)
+    return run, COMMANDS
+
+
+BENCHMARKS = (bench_get_devices, bench_changed_devices, bench_event_fanout,
+              bench_properties, bench_set_device_value)
+
+
+def measure(bench, size, repeats):
+    """Return (seconds per operation, peak bytes) of a benchmark.
+
+    A benchmark returns (run, operations per run) and optionally a
+    prepare callable, called untimed before each run.
+    """
+    hub = _hub(size)
+    try:
+        run, operations, prepare = (bench(hub, size) + (None,))[:3]
+        prepare = prepare or (lambda: None)
+        prepare()
+        run()
+        best = None
+        for _ in range(repeats):
+            prepare()
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        prepare()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        hub.close()
+    return best / operations, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--only', nargs='+', metavar='BENCHMARK',
+                        help='run only these benchmarks, eg get_devices')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with 1 if a result regressed')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    print("{:<24}{:>8}{:>14}{:>12}{:>10}".format(
+        'benchmark', 'devices', 'us/op', 'peak KiB', 'vs base'))
+    for bench in BENCHMARKS:
+        name = bench.__name__[len('bench_'):]
+        if args.only and name not in args.only:
+            continue
+        for size in args.sizes:
+            seconds, peak = measure(bench, size, args.repeats)
+            key = '{}/{}'.format(name, size)
+            results[key] = {'seconds': seconds, 'peak': peak}
+            ratio = ''
+            if key in baseline:
+                change = seconds / baseline[key]['seconds']
+                ratio = '{:.2f}x'.format(change)
+                if change > args.threshold:
+                    ratio += ' !'
+                    regressions.append(key)
+            print("{:<24}{:>8}{:>14.2f}{:>12.1f}{:>10}".format(
+                name, size, seconds * 1e6, peak / 1024.0, ratio))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+        print("Saved baseline to {}".format(args.baseline))
+    if regressions:
+        print("Slower than {}x the baseline: {}".format(
+            args.threshold, ', '.join(regressions)))
+    return 1 if regressions and args.check else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Check the time taken by 'import pyclimax' against a budget.
+
+Runs 'python -X importtime -c "import pyclimax"' in fresh interpreters,
+alternating with 'import requests' as a baseline of the speed of the
+machine, takes the best cumulative time of each, and fails if pyclimax
+takes more than a fraction of requests or if a dependency that should
+load on first use, such as requests, was imported.
+
+    python benchmarks/import_time.py [--budget-ratio 0.3] [--runs 7]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Max cumulative import time of the pyclimax package, as a fraction of
+# that of BASELINE_MODULE, about 0.16 when measured
+IMPORT_BUDGET_RATIO = 0.3
+# Module timed in the same runs to scale the budget to the machine
+BASELINE_MODULE = 'requests'
+# Interpreters started, the best run counts
+RUNS = 7
+# Modules 'import pyclimax' must not import
+LAZY_MODULES = ('requests', 'urllib3', 'aiohttp', 'numpy', 'hashlib',
+                'pyclimax.aio', 'pyclimax.fleet', 'pyclimax.history',
+                'pyclimax.store')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHECK = ("import sys, pyclimax; "
+          "print(' '.join(m for m in {!r} if m in sys.modules))")
+
+
+def _environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+    env.pop('PYCLIMAX_LOGLEVEL', None)
+    return env
+
+
+def import_time_us(module='pyclimax'):
+    """Return the cumulative import time of module in microseconds."""
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        env=_environment(), stderr=subprocess.PIPE, universal_newlines=True,
+        check=True).stderr
+    for line in output.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    raise RuntimeError("{} not found in -X importtime output".format(module))
+
+
+def eager_modules():
+    """Return the LAZY_MODULES loaded by 'import pyclimax'."""
+    output = subprocess.run(
+        [sys.executable, '-c', _CHECK.format(LAZY_MODULES)],
+        env=_environment(), stdout=subprocess.PIPE, universal_newlines=True,
+        check=True).stdout
+    return output.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ratio', type=float,
+                        default=IMPORT_BUDGET_RATIO)
+    parser.add_argument('--runs', type=int, default=RUNS)
+    args = parser.parse_args()
+
+    times = []
+    baselines = []
+    for _ in range(args.runs):
+        times.append(import_time_us())
+        baselines.append(import_time_us(BASELINE_MODULE))
+    best = min(times) / 1000.0
+    budget = min(baselines) / 1000.0 * args.budget_ratio
+    eager = eager_modules()
+    print("import pyclimax: {:.1f} ms (budget {:.1f} ms, {} of import {}, "
+          "best of {})".format(best, budget, args.budget_ratio,
+                               BASELINE_MODULE, args.runs))
+    failed = False
+    if best > budget:
+        print("FAIL: import time over budget")
+        failed = True
+    if eager:
+        print("FAIL: imported eagerly: {}".format(', '.join(eager)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""Event latency and request rate of interval polling and long polling.
+
+Runs the subscription of a controller against a simulated hub, changes a
+device at random intervals, and reports the time from each change on the
+hub to its changes callback, and the deviceListGet requests per second.
+
+    python benchmarks/long_poll.py [--changes 30] [--devices 100]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyclimax  # noqa: E402
+from pyclimax.test_server.simulator import HubSimulator  # noqa: E402
+
+# Changes made on the hub per mode
+CHANGES = 30
+# Devices on the hub
+DEVICES = 100
+# Max seconds between changes, the waits are uniform from 0
+MAX_GAP = 1.0
+
+
+def run(long_poll, changes, devices, max_gap, seed=1):
+    """Return (sorted latencies in seconds, requests per second)."""
+    rng = random.Random(seed)
+    hub = HubSimulator({48: devices}, block_polls=False, long_poll=long_poll,
+                       seed=seed)
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                           long_poll=long_poll)
+    received = threading.Event()
+    controller.register_changes(lambda controller, changes: received.set())
+    latencies = []
+    try:
+        controller.get_devices()
+        controller.start()
+        # Let the subscription settle into its steady state
+        time.sleep(1)
+        requests = hub.requests.get('deviceListGet', 0)
+        start = time.monotonic()
+        for _ in range(changes):
+            time.sleep(rng.uniform(0, max_gap))
+            received.clear()
+            changed = time.monotonic()
+            hub.mutate(1)
+            if received.wait(10):
+                latencies.append(time.monotonic() - changed)
+        elapsed = time.monotonic() - start
+        requests = hub.requests.get('deviceListGet', 0) - requests
+    finally:
+        controller.stop()
+        hub.close()
+    return sorted(latencies), requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--changes', type=int, default=CHANGES)
+    parser.add_argument('--devices', type=int, default=DEVICES)
+    parser.add_argument('--max-gap', type=float, default=MAX_GAP)
+    args = parser.parse_args()
+
+    print("{:<12}{:>10}{:>10}{:>10}{:>12}".format(
+        'mode', 'p50 ms', 'p95 ms', 'max ms', 'requests/s'))
+    for name, long_poll in (('interval', False), ('long poll', True)):
+        latencies, rate = run(long_poll, args.changes, args.devices,
+                              args.max_gap)
+        if not latencies:
+            print("{:<12} no events received".format(name))
+            continue
+        print("{:<12}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.2f}".format(
+            name, latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3,
+            latencies[-1] * 1e3, rate))
+        if len(latencies) < args.changes:
+            print("  {} changes not received".format(
+                args.changes - len(latencies)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
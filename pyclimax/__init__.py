@@ -3,13 +3,27 @@ Climax Controller Python API.
 
 This lib is designed to simplify communication with Climax HA controllers
 """
+import collections
+import importlib
 import logging
-import requests
 import sys
 import json
 import os
-from jsondiff import diff
-
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .cache import DeviceListCache
+from .changes import ChangeDetector, ChangeSet
+from .commands import (CommandQueue, CommandResult, COMMAND_RETRIES,
+                       command_key, confirm_delays, CONFIRM_TIMEOUT,
+                       log_failure)
+from .index import DeviceIndex, INDEXED_FIELDS
+from .readings import parse_dimmer, parse_sensor, parse_status, parse_switch
+from .scheduler import PollScheduler
+from .singleflight import SingleFlight
+from .snapshot import SnapshotStore
+from .stats import prometheus_text, Stats
 from .subscribe import SubscriptionRegistry
 from .subscribe import PyclimaxError
 
@@ -21,38 +35,95 @@ SUBSCRIPTION_WAIT = 30
 SUBSCRIPTION_MIN_WAIT = 200
 # Timeout for requests calls, as Climax sometimes just sits on sockets.
 TIMEOUT = SUBSCRIPTION_WAIT
+# Timeout for establishing a connection to Climax in seconds
+CONNECT_TIMEOUT = 5
+# Max number of pooled keep-alive connections kept open to one Climax hub
+POOL_MAXSIZE = 4
+# Max age in seconds of a cached device list before it is fetched again
+CACHE_MAX_AGE = 5
+# Seconds past max_age an expired device list may still be served while it
+# is refreshed in the background, older ones are fetched first
+CACHE_MAX_STALE = 10
+# Number of recent command confirmation latencies kept
+LATENCY_SAMPLES = 100
 
 CATEGORY_DIMMER = 53
 CATEGORY_POWER_SWITCH_METER = 48
 CATEGORY_TEMPERATURE_SENSOR = 20
 CATEGORY_POWER_METER = 50
 
+# Topology events passed to register_topology callbacks
+DEVICE_ADDED = 'added'
+DEVICE_REMOVED = 'removed'
+
 _CLIMAX_CONTROLLER = None
 
-# Set up the console logger for debugging
+# Classes of optional modules, imported on first access, see __getattr__
+_LAZY_ATTRIBUTES = {
+    'AsyncClimaxController': 'aio',
+    'FleetState': 'fleet',
+    'DeviceHistory': 'history',
+    'TimeSeriesStore': 'store',
+}
+
+# Get the logger for use in this module
 logger = logging.getLogger(__name__)
-# Set logging level (such as INFO, DEBUG, etc) via an environment variable
-# Defaults to WARNING log level unless PYClimax_LOGLEVEL variable exists
-logger_level = os.environ.get("PYCLIMAX_LOGLEVEL", None)
-if logger_level:
-    logger.setLevel(logger_level)
-    ch = logging.StreamHandler()
-    ch.setFormatter(logging.Formatter('%(levelname)s@{%(name)s:%(lineno)d} - %(message)s'))
-    logger.addHandler(ch)
-logger.debug("DEBUG logging is ON")
-
-def init_controller(url, username, password):
+_logging_configured = False
+
+
+def _configure_logging():
+    """Set up the console logger for debugging, once.
+
+    Done when the first controller is created rather than at import, so
+    importing pyclimax has no side effects.
+    """
+    # pylint: disable=global-statement
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+    # Set logging level (such as INFO, DEBUG, etc) via an environment variable
+    # Defaults to WARNING log level unless PYClimax_LOGLEVEL variable exists
+    logger_level = os.environ.get("PYCLIMAX_LOGLEVEL", None)
+    if logger_level:
+        logger.setLevel(logger_level)
+        ch = logging.StreamHandler()
+        ch.setFormatter(logging.Formatter('%(levelname)s@{%(name)s:%(lineno)d} - %(message)s'))
+        logger.addHandler(ch)
+    logger.debug("DEBUG logging is ON")
+
+
+def __getattr__(name):
+    """Import the optional modules, and their dependencies, on first use."""
+    module = _LAZY_ATTRIBUTES.get(name)
+    if module is None:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
+
+
+def init_controller(url, username, password, snapshot=None):
     """Initialize a controller.
 
     Provides a single global controller for applications that can't do this
-    themselves
+    themselves. With a snapshot directory the devices of the last run are
+    available at once, see ClimaxController.warm_start.
     """
     # pylint: disable=global-statement
     global _CLIMAX_CONTROLLER
     created = False
     if _CLIMAX_CONTROLLER is None:
-        _CLIMAX_CONTROLLER = ClimaxController(url, username, password)
+        _CLIMAX_CONTROLLER = ClimaxController(url, username, password,
+                                              snapshot=snapshot)
         created = True
+        if snapshot is not None:
+            _CLIMAX_CONTROLLER.warm_start()
         _CLIMAX_CONTROLLER.start()
     return [_CLIMAX_CONTROLLER, created]
 
@@ -67,98 +138,409 @@ class ClimaxController(object):
 
     # pylint: disable=too-many-instance-attributes
     temperature_units = 'C'
-
-    def __init__(self, base_url, username, password):
+    # Request methods return awaitables instead of results
+    is_async = False
+
+    def __init__(self, base_url, username, password,
+                 connect_timeout=CONNECT_TIMEOUT, pool_maxsize=POOL_MAXSIZE,
+                 max_age=CACHE_MAX_AGE, stale_while_revalidate=True,
+                 max_stale=CACHE_MAX_STALE,
+                 ignored_fields=(), command_window=None,
+                 confirm_commands=False, confirm_timeout=CONFIRM_TIMEOUT,
+                 command_retries=COMMAND_RETRIES,
+                 subscription_wait=SUBSCRIPTION_WAIT,
+                 subscription_min_wait=SUBSCRIPTION_MIN_WAIT,
+                 poll_scheduler=None, snapshot=None, long_poll=False):
         """Setup Climax controller at the given URL.
 
         base_url: Climax API URL, eg http://Climax:80.
+        connect_timeout: seconds to wait for the TCP connection to the hub.
+        pool_maxsize: max number of keep-alive connections to the hub.
+        max_age: seconds a cached device list is served without refetching.
+        stale_while_revalidate: serve an expired device list immediately
+        and refresh it in the background.
+        max_stale: seconds past max_age an expired device list may be
+        served, an older one is fetched before returning.
+        ignored_fields: noisy device fields, eg 'rssi', that are not
+        reported as changes.
+        command_window: if set, device commands are queued and coalesced
+        for this many seconds and sent by a background thread.
+        confirm_commands: post device commands, then return a Future that
+        resolves once a re-poll shows the expected device state.
+        confirm_timeout: seconds to wait for confirmation before resending.
+        command_retries: times an unconfirmed command is resent.
+        subscription_wait: seconds the hub may block a poll waiting for
+        changes.
+        subscription_min_wait: min milliseconds the hub waits for events.
+        poll_scheduler: PollScheduler deciding when the subscription polls.
+        snapshot: SnapshotStore, or its directory, for warm_start.
+        long_poll: send the version of the last device list with
+        subscription polls, so a hub supporting it blocks until something
+        changes, and poll again as soon as it answers.
         """
+        _configure_logging()
         self.base_url = base_url
         self.username = username
         self.password = password
+        self.connect_timeout = connect_timeout
+        self.pool_maxsize = pool_maxsize
+        self.max_age = max_age
+        self.subscription_wait = subscription_wait
+        self.subscription_min_wait = subscription_min_wait
+        self.poll_scheduler = poll_scheduler or PollScheduler()
+        self.metrics = Stats()
+        self.long_poll = long_poll
+        self.device_list_version = None
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_stale = max_stale
+        self.device_cache = DeviceListCache(max_age)
         self.devices = []
+        self._devices_result = None
+        self._detected_result = None
+        self._devices_lock = threading.Lock()
+        self._single_flight = SingleFlight()
+        self.confirm_commands = confirm_commands
+        self.confirm_timeout = confirm_timeout
+        self.command_retries = command_retries
+        self.command_latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._command_tokens = {}
+        self._command_executor = None
+        self.command_queue = None
+        if command_window is not None:
+            self.command_queue = CommandQueue(self._post_command,
+                                              command_window)
         self.version = None
         self.zwave_version = None
         self.mac = None
-        self.subscription_registry = SubscriptionRegistry()
+        self._welcome = None
+        if isinstance(snapshot, str):
+            snapshot = SnapshotStore(snapshot)
+        self.snapshot = snapshot
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.device_index = DeviceIndex()
+        self.change_detector = ChangeDetector(ignored_fields=ignored_fields)
+        self.last_changes = None
+        self.last_poll_held = False
+        self.subscription_registry = SubscriptionRegistry(self)
 
-        #self.subscription_registry = SubscriptionRegistry()
         self.device_id_map = {}
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def session(self):
+        """The persistent HTTP session used for all requests to the hub.
+
+        It is created on first use and shared by the subscription thread
+        and device commands, so connections to the hub are kept alive.
+        """
+        if self._session is None:
+            # requests is only imported once the hub is talked to
+            import requests
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    session.auth = (self.username, self.password)
+                    # Climax is a small embedded web server, so keep the
+                    # pool bounded and let callers wait for a free connection
+                    # instead of opening new ones.
+                    adapter = requests.adapters.HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=self.pool_maxsize,
+                        pool_block=True)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        """Stop polling this controller, send queued commands, save the
+        snapshot and close the HTTP session.
+
+        The subscription thread is stopped once its registry has no other
+        controllers to poll.
+        """
+        registry = self.subscription_registry
+        registry.remove_controller(self)
+        if not registry.controllers:
+            registry.stop()
+        self.save_snapshot()
+        if self.command_queue is not None:
+            self.command_queue.close()
+        with self._session_lock:
+            executor, self._command_executor = self._command_executor, None
+        if executor is not None:
+            executor.shutdown()
+        with self._session_lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    def _timeout(self, timeout):
+        """Return a (connect, read) timeout tuple for requests."""
+        if isinstance(timeout, tuple):
+            return timeout
+        if timeout is None:
+            return (self.connect_timeout, None)
+        return (min(self.connect_timeout, timeout), timeout)
+
     def post_request(self, method, payload, timeout=TIMEOUT):
         """Post a request and return the result."""
-        requests_url = self.base_url + "/action/" + method 
-        return requests.post(requests_url, auth=(self.username, self.password), timeout=timeout, data=payload)
+        requests_url = self.base_url + "/action/" + method
+        start = time.perf_counter()
+        try:
+            r = self.session.post(requests_url,
+                                  timeout=self._timeout(timeout),
+                                  data=payload)
+        except Exception as ex:
+            self.metrics.count('errors', type(ex).__name__)
+            raise
+        self._record_request(method, start, len(r.content))
+        return r
 
     def get_request(self, method, payload={}, timeout=TIMEOUT):
         """Post a request and return the result."""
         requests_url = self.base_url + "/action/" + method
+        start = time.perf_counter()
+        try:
+            r = self.session.get(requests_url,
+                                 timeout=self._timeout(timeout),
+                                 data=payload)
+        except Exception as ex:
+            self.metrics.count('errors', type(ex).__name__)
+            raise
+        self._record_request(method, start, len(r.content))
+        return r
 
-        r = requests.get(requests_url, auth=(self.username, self.password), timeout=timeout, data=payload)
-        
+    def _record_request(self, method, start, size):
+        """Record the latency and bytes of a request started at start
+        (perf_counter)."""
+        self.metrics.observe('request_seconds', method,
+                             time.perf_counter() - start)
+        self.metrics.count('received_bytes', method, size)
 
-        return r
+    def _ensure_devices(self, refresh):
+        """Load the device list if asked to or if it was never loaded."""
+        if refresh or not self.device_index.loaded:
+            self.get_devices()
 
-    def get_device_by_name(self, device_name):
+    def get_device_by_name(self, device_name, refresh=False):
         """Search the list of connected devices by name.
 
-        device_name param is the string name of the device
+        device_name param is the string name of the device, matched case
+        insensitively. The last known device list is used unless refresh
+        is True or no device list has been loaded yet.
         """
-
-        # Find the device for the Climax device name we are interested in
-        found_device = None
-        for device in self.get_devices():
-            if device.name == device_name:
-              found_device = device
-              # found the first (and should be only) one so we will finish
-              break
+        self._ensure_devices(refresh)
+        found_device = self.device_index.by_name(device_name)
 
         if found_device is None:
             logger.debug('Did not find device with {}'.format(device_name))
 
         return found_device
 
-    def get_device_by_id(self, device_id):
+    def get_device_by_id(self, device_id, refresh=False):
         """Search the list of connected devices by ID.
 
-        device_id param is the integer ID of the device
+        device_id param is the ID of the device, eg 'ZW:00000008'. The last
+        known device list is used unless refresh is True or no device list
+        has been loaded yet.
         """
-
-        # Find the device for the Climax device name we are interested in
-        found_device = None
-        for device in self.get_devices():
-            if device.device_id == device_id:
-              found_device = device
-              # found the first (and should be only) one so we will finish
-              break
+        self._ensure_devices(refresh)
+        found_device = self.device_index.get(device_id)
 
         if found_device is None:
             logger.debug('Did not find device with {}'.format(device_id))
 
         return found_device
 
-    def get_devices(self):
-        """Get list of connected devices."""
-        # pylint: disable=too-many-branches
+    def get_devices_by_type(self, device_type, refresh=False):
+        """Return the devices with the given type (eg 48) or type_f."""
+        self._ensure_devices(refresh)
+        return self.device_index.by_type(device_type)
 
+    def get_devices_by_area(self, area, zone=None, refresh=False):
+        """Return the devices in an area, optionally limited to a zone."""
+        self._ensure_devices(refresh)
+        return self.device_index.by_area(area, zone)
+
+    def get_devices(self, max_age=None):
+        """Get list of connected devices.
+
+        The device list is served from the cache if it is younger than
+        max_age seconds (default: the controller's max_age), pass 0 to
+        always fetch it from the hub.
         """
-        This is done via a blocking call, pass NONE for initial state.
+        result = self.get_device_list(max_age)
+        if result is self._devices_result:
+            return self.devices
+        return self._load_devices(result)
+
+    def _load_devices(self, result):
+        """Set the device list outside of polling.
+
+        The first device list loaded becomes the baseline for the change
+        detector, so the devices looked up before the subscription starts
+        are not all reported as changed by its first poll.
+        """
+        devices = self._set_devices(result)
+        self.change_detector.seed(result.get('senrows'))
+        return devices
+
+    def get_device_list(self, max_age=None, revalidate=True):
+        """Return the parsed deviceListGet payload, using the cache.
+
+        A cached result younger than max_age is returned as is. An older
+        one, up to max_stale seconds past max_age, is returned immediately
+        while a background thread refreshes it, if stale_while_revalidate
+        and revalidate are set. If the hub can't be reached the last known
+        good result is returned and device_cache.stale is True. With
+        max_age=0 the hub is always asked and errors raise.
+        """
+        import requests
+        cache = self.device_cache
+        if max_age is None:
+            max_age = self.max_age
+        if max_age > 0 and cache.result is not None:
+            if cache.is_fresh(max_age):
+                return cache.result
+            if revalidate and self._serve_stale(max_age):
+                self._revalidate()
+                return cache.result
+        try:
+            return self._fetch_device_list()
+        except (requests.RequestException, PyclimaxError) as ex:
+            if max_age > 0 and cache.result is not None:
+                logger.warning("Climax unreachable, using device list from "
+                               "%.1fs ago: %s", cache.age(), str(ex))
+                return cache.result
+            raise
+
+    def _serve_stale(self, max_age):
+        """Return True if the expired cached result may be served while it
+        is refreshed in the background."""
+        cache = self.device_cache
+        return (self.stale_while_revalidate and cache.revalidatable
+                and cache.age() <= max_age + self.max_stale)
+
+    def _revalidate(self):
+        """Refresh the device list cache on a background thread."""
+        if not self.device_cache.begin_revalidate():
+            return
+
+        import requests
+
+        def run():
+            try:
+                self._fetch_device_list()
+            except (requests.RequestException, PyclimaxError) as ex:
+                logger.debug("Background refresh failed: %s", str(ex))
+            finally:
+                self.device_cache.end_revalidate()
+
+        threading.Thread(target=run, name='Climax Cache Refresh',
+                         daemon=True).start()
+
+    def _fetch_device_list(self, poll=False):
+        """Fetch, parse and cache deviceListGet from the hub.
+
+        This is done via a blocking call. Concurrent callers, eg several
+        device refreshes, join the request already in flight and share its
+        parsed result.
+        poll: send the subscription's payload, letting the hub hold the
+        request until something changes. Other reads are answered at once,
+        and never join a poll in flight.
+        """
+        key = 'deviceListPoll' if poll else 'deviceListGet'
+        return self._single_flight.do(
+            key, lambda: self._request_device_list(poll))
+
+    def _request_device_list(self, poll=False, version=None, timeout=None):
+        import requests
+        if poll:
+            payload = self._device_list_payload(version)
+            timeout = timeout or self._poll_timeout()
+        else:
+            payload = {}
+            timeout = timeout or TIMEOUT
+
+        logger.debug("get_devices() requesting payload %s", str(payload))
+        try:
+            r = self.get_request('deviceListGet', payload, timeout=timeout)
+        except requests.RequestException as ex:
+            self.device_cache.fail(ex)
+            raise
+        try:
+            r.raise_for_status()
+            return self._store_device_list(r.content, lambda: r.text)
+        except (requests.RequestException, PyclimaxError) as ex:
+            self.metrics.count('errors', type(ex).__name__)
+            self.device_cache.fail(ex)
+            raise
+
+    def _store_device_list(self, content, decode):
+        """Parse and cache a deviceListGet body.
+
+        Most polls return exactly the same bytes as the previous one, so the
+        raw body is fingerprinted first, and if it matches the cached result
+        is kept without decoding, parsing or building devices again.
+        decode: callable returning the body as text.
+        """
+        import hashlib
+        start = time.perf_counter()
+        fingerprint = hashlib.blake2b(content, digest_size=16).digest()
+        result = self.device_cache.reuse(fingerprint)
+        if result is not None:
+            self.metrics.observe('poll_seconds', 'parse',
+                                 time.perf_counter() - start)
+            return result
+
+        result = self._parse_device_list(decode())
+        self.device_list_version = result.get('version')
+        self.device_cache.put(result, fingerprint)
+        self.metrics.observe('poll_seconds', 'parse',
+                             time.perf_counter() - start)
+        return result
+
+    def _poll_timeout(self):
+        """Read timeout for deviceListGet, longer than the hub may block."""
+        return self.subscription_wait + self.connect_timeout
+
+    def _device_list_payload(self, version=None):
+        """Return the deviceListGet payload used when polling.
+
+        With the version of the last device list, the hub answers once the
+        devices have changed since, or after timeout seconds.
         """
         payload = {
-            'timeout': SUBSCRIPTION_WAIT,
-            'minimumdelay': SUBSCRIPTION_MIN_WAIT
+            'timeout': self.subscription_wait,
+            'minimumdelay': self.subscription_min_wait
         }
+        if version is not None:
+            payload['version'] = version
+        return payload
 
-        logger.debug("get_devices() requesting payload %s", str(payload))
-        r = self.get_request('deviceListGet', payload)
-        
-        r.raise_for_status()
+    @property
+    def long_polling(self):
+        """True if subscription polls block on the hub until a change.
 
+        Requires long_poll and a hub that returns a version with its
+        device list.
+        """
+        return self.long_poll and self.device_list_version is not None
+
+    def _parse_device_list(self, text):
+        """Decode and validate a deviceListGet response body."""
         # If the Climax disconnects before writing a full response (as lu_sdata
         # will do when interrupted by a Luup reload), the requests module will
         # happily return 200 with an empty string. So, test for empty response,
         # so we don't rely on the JSON parser to throw an exception.
-        if r.text == "":
+        if text == "":
             raise PyclimaxError("Empty response from Climax")
 
         # Catch a wide swath of what the JSON parser might throw, within
@@ -166,109 +548,430 @@ class ClimaxController(object):
         # json.decode.JSONDecodeError, but so far most seem to derive what
         # they do throw from ValueError, so that's helpful.
         try:
-            result = r.json()
+            result = json.loads(text)
         except ValueError as ex:
             raise PyclimaxError("JSON decode error: " + str(ex))
 
         if not ( type(result) is dict and 'senrows' in result ):
             raise PyclimaxError("Unexpected/garbled response from Climax")
 
-        self.devices = []
-        items = result.get('senrows')
-
-        for item in items:
-            device_type = item.get('type')
-            if CATEGORY_DIMMER == device_type:
-                device = ClimaxDimmer(item, self)
-            elif CATEGORY_POWER_SWITCH_METER == device_type:
-                device = ClimaxSwitch(item, self)
-            elif (CATEGORY_TEMPERATURE_SENSOR == device_type or
-                CATEGORY_POWER_METER == device_type):
-                device = ClimaxSensor(item, self)
-            else:
-                device = ClimaxDevice(item, self)
-            
-            self.devices.append(device)
-
+        return result
+
+    def _make_device(self, item):
+        """Create the ClimaxDevice subclass matching a senrows item."""
+        device_type = item.get('type')
+        if CATEGORY_DIMMER == device_type:
+            return ClimaxDimmer(item, self)
+        elif CATEGORY_POWER_SWITCH_METER == device_type:
+            return ClimaxSwitch(item, self)
+        elif (CATEGORY_TEMPERATURE_SENSOR == device_type or
+            CATEGORY_POWER_METER == device_type):
+            return ClimaxSensor(item, self)
+        return ClimaxDevice(item, self)
+
+    def _set_devices(self, result):
+        """Reconcile the device list with a parsed deviceListGet result.
+
+        There is one long lived device object per hub id, whose json_state
+        is patched in place, and self.devices is only replaced when devices
+        appear, disappear or move. Added and removed devices are reported
+        to the topology callbacks of the subscription registry.
+        """
+        with self._devices_lock:
+            if result is self._devices_result:
+                return self.devices
+            added, removed = self._reconcile(result.get('senrows'))
+            self._devices_result = result
+
+        for device in removed:
+            self.subscription_registry._event_topology(DEVICE_REMOVED, device)
+        for device in added:
+            self.subscription_registry._event_topology(DEVICE_ADDED, device)
         return self.devices
 
-    def refresh_data(self):
-        """Refresh data from Climax device."""
-        j = self.get_request('welcomeGet').json()
-
+    def _reconcile(self, rows):
+        """Update the device table from rows, return (added, removed)."""
+        index = self.device_index
+        devices = self.devices
+        same = len(rows) == len(devices)
+        current = []
+        added = []
+        removed = []
+        changed = []
+
+        for position, item in enumerate(rows):
+            device = index.get(item.get('id'))
+            if device is not None and device.type == item.get('type'):
+                state = device.json_state
+                for field in INDEXED_FIELDS:
+                    if state.get(field) != item.get(field):
+                        changed.append(device)
+                        break
+                device._set_state(item)
+            else:
+                if device is not None:
+                    removed.append(device)
+                device = self._make_device(dict(item))
+                added.append(device)
+            if same and devices[position] is not device:
+                same = False
+            current.append(device)
+
+        if not same:
+            seen = set(device.device_id for device in current)
+            removed.extend(device for device in devices
+                           if device.device_id not in seen)
+            self.devices = current
+        index.apply(added + changed, removed)
+        return added, removed
+
+    def _set_welcome(self, j):
+        """Store the hub versions from a parsed welcomeGet result."""
         welcome_data = j.get('updates')
 
+        self._welcome = welcome_data
         self.version = welcome_data.get('version')
         self.zwave_version = welcome_data.get('zw_ver')
         self.mac = welcome_data.get('mac')
 
-        device_id_map = {}
+    def _fetch_hub(self, max_age=None):
+        """Get welcomeGet and deviceListGet in parallel, return the device
+        list."""
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            welcome = executor.submit(self.get_request, 'welcomeGet')
+            result = self.get_device_list(max_age)
+            self._set_welcome(welcome.result().json())
+        return result
 
-        j = self.get_request('deviceListGet').json()
+    def refresh_data(self):
+        """Refresh data from Climax device."""
+        device_id_map = {}
 
-        devs = j.get('senrows')
+        devs = self._fetch_hub().get('senrows')
         for dev in devs:
             device_id_map[dev.get('id')] = dev
 
         return device_id_map
 
-    def get_changed_devices(self):
+    def refresh_device(self, device, max_age=None):
+        """Refresh the json_state of a single device from the hub, see
+        get_device_list for max_age. An expired device list is never
+        served, it is fetched first."""
+        result = self.get_device_list(max_age, revalidate=False)
+        self._update_device(device, result.get('senrows'))
+
+    def warm_start(self):
+        """Load the snapshot of the hub and reconcile in the background.
+
+        The devices and hub versions of the snapshot are usable at once,
+        with device_cache.stale True, while a background refresh fetches
+        welcomeGet and deviceListGet and reconciles the devices, reporting
+        added and removed ones to the topology callbacks. Differences in
+        device state are reported by the next subscription poll. Returns
+        True if a snapshot was loaded.
         """
-        Get data from controller and filter out the ones
-        that have changed.
+        snapshot = None
+        if self.snapshot is not None:
+            snapshot = self.snapshot.load(self.base_url)
+        if snapshot is not None:
+            logger.info("Using snapshot of Climax %s from %s",
+                        snapshot['mac'], time.ctime(snapshot['saved_at']))
+            self._set_welcome({'updates': snapshot['welcome']})
+            self.device_cache.restore(snapshot['devices'],
+                                      snapshot['saved_at'])
+            self._load_devices(snapshot['devices'])
+        self._start_reconcile()
+        return snapshot is not None
+
+    def _start_reconcile(self):
+        threading.Thread(target=self._reconcile_snapshot,
+                         name='Climax Warm Start', daemon=True).start()
+
+    def _reconcile_snapshot(self):
+        import requests
+        mac = self.mac
+        try:
+            result = self._fetch_hub(max_age=0)
+        except (requests.RequestException, PyclimaxError, ValueError) as ex:
+            logger.warning("Could not reach Climax %s, using snapshot: %s",
+                           self.base_url, str(ex))
+            return
+        if mac is not None and mac != self.mac:
+            logger.warning("Climax at %s is now %s, not %s", self.base_url,
+                           self.mac, mac)
+        self._load_devices(result)
+        self.save_snapshot()
+
+    def save_snapshot(self):
+        """Save the last device list and welcome data to the snapshot."""
+        cache = self.device_cache
+        if (self.snapshot is None or self.mac is None or cache.result is None
+                or cache.restored):
+            return
+        try:
+            self.snapshot.save(self.base_url, self.mac, self._welcome,
+                               cache.result, cache.fetched_at)
+        except OSError as ex:
+            logger.warning("Could not save snapshot: %s", str(ex))
+
+    @staticmethod
+    def _update_device(device, rows):
+        """Update device from the matching row of a senrows list."""
+        for device_data in rows:
+            if device_data.get('id') == device.device_id:
+                device.update(device_data)
+
+    def send_command(self, method, payload, expect=None):
+        """Send a device command to the hub.
+
+        The response is returned, or with a command_window a Future for it.
+
+        With confirm_commands the command is posted, or queued, in order
+        and a Future is returned, resolving to a CommandResult once a fast
+        re-poll of the device list by a worker thread shows
+        expect(json_state) to be true for the device. If it doesn't within
+        confirm_timeout the command is resent with backoff, and the Future
+        raises PyclimaxError if it is never confirmed. Without expect the
+        Future resolves once the command has been posted. Failures are
+        logged, as nobody may wait for the Future.
         """
+        if not self.confirm_commands:
+            return self._dispatch_command(method, payload)
+
+        token = object()
+        self._command_tokens[command_key(method, payload)] = token
+        start = time.monotonic()
+        response = self._dispatch_command(method, payload)
+        future = self.command_executor.submit(
+            self._confirm_command, method, payload, expect, token, start,
+            response)
+        future.add_done_callback(log_failure)
+        return future
 
-        old_device_data = self.devices
-
-        new_device_data = self.get_devices()
-
-        changed_devices = []
-
-        for device in new_device_data:
-            found_old_device = None
-
-            for old_device in old_device_data:
-                if (device.json_state.get('id') in old_device.json_state.get('id')):
-                    found_old_device = old_device
+    @property
+    def command_executor(self):
+        """Worker threads sending and confirming device commands."""
+        if self._command_executor is None:
+            with self._session_lock:
+                if self._command_executor is None:
+                    self._command_executor = ThreadPoolExecutor(
+                        max_workers=self.pool_maxsize,
+                        thread_name_prefix='Climax Command')
+        return self._command_executor
+
+    def _dispatch_command(self, method, payload):
+        if self.command_queue is not None:
+            return self.command_queue.submit(method, payload)
+        return self._post_command(method, payload)
+
+    def _confirm_command(self, method, payload, expect, token, start,
+                         response):
+        """Wait until the hub shows the effect of a posted command,
+        resending it if it doesn't."""
+        key = command_key(method, payload)
+        for attempt in range(1, self._command_attempts(payload) + 1):
+            if attempt > 1:
+                if self._command_tokens.get(key) is not token:
+                    # A newer value was sent before this one was resent
+                    return CommandResult(method, payload, response, False,
+                                         attempt - 1,
+                                         time.monotonic() - start,
+                                         superseded=True)
+                response = self._dispatch_command(method, payload)
+            if isinstance(response, Future):
+                response = response.result()
+            if expect is None:
+                return CommandResult(method, payload, response, None, attempt,
+                                     time.monotonic() - start)
+
+            timeout = self.confirm_timeout * 2 ** (attempt - 1)
+            deadline = time.monotonic() + timeout
+            for delay in confirm_delays(timeout):
+                time.sleep(max(min(delay, deadline - time.monotonic()), 0))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
                     break
-            
-            if found_old_device is None:
-                changed_devices.append(device)
-                continue
+                if self._command_tokens.get(key) is not token:
+                    return CommandResult(method, payload, response, False,
+                                         attempt, time.monotonic() - start,
+                                         superseded=True)
+                if self._check_confirmed(payload.get('id'), expect,
+                                         remaining):
+                    latency = time.monotonic() - start
+                    self.command_latencies.append(latency)
+                    logger.debug("Command %s %s confirmed in %.3fs",
+                                 method, payload, latency)
+                    return CommandResult(method, payload, response, True,
+                                         attempt, latency)
+
+            logger.info("Command %s %s not confirmed after %ss",
+                        method, payload, timeout)
+
+        raise PyclimaxError("Command {} {} was not confirmed".format(
+            method, payload))
+
+    def _command_attempts(self, payload):
+        """Return the times a command may be posted, once for a toggle as
+        resending it would undo it."""
+        if str(payload.get('switch')) == '2':
+            return 1
+        return self.command_retries + 1
+
+    def _check_confirmed(self, device_id, expect, timeout):
+        """Re-poll the device list and test expect on the device.
+
+        The request is sent on its own, as joining one in flight, eg a
+        subscription poll held by the hub, could return a list from before
+        the command or wait for the hub's timeout.
+        """
+        import requests
+        try:
+            self._set_devices(self._request_device_list(timeout=timeout))
+        except (requests.RequestException, PyclimaxError) as ex:
+            logger.debug("Confirmation poll failed: %s", str(ex))
+            return False
+        device = self.device_index.get(device_id)
+        return device is not None and expect(device.json_state)
+
+    def _post_command(self, method, payload):
+        result = self.post_request(method, payload)
+        self.poll_scheduler.command_sent()
+        self.subscription_registry.wakeup(self)
+        self.device_cache.invalidate()
+        logger.debug("set_service_value: "
+                  "result of climax_request %s with payload %s: %s",
+                  method, payload, result.text)
+        return result
 
-            if diff(device.json_state, found_old_device.json_state):
-                changed_devices.append(device)
+    def get_changed_devices(self):
+        """
+        Get data from controller and filter out the ones
+        that have changed.
 
-        return changed_devices
+        The field level changes, and the ids of removed devices, of the
+        poll are kept in last_changes.
+        """
+        start = time.perf_counter()
+        if self.long_polling:
+            # Not shared with other callers, they would wait for a change
+            result = self._request_device_list(True,
+                                               self.device_list_version)
+        else:
+            result = self._fetch_device_list(poll=True)
+        fetched = time.perf_counter()
+        self._set_devices(result)
+        built = time.perf_counter()
+        changed = self._detect_changes()
+        self._record_poll(start, fetched, built)
+        return changed
+
+    def _record_poll(self, start, fetched, built):
+        """Record the phases of get_changed_devices, fetch includes
+        parse, and whether the hub held the poll for its minimumdelay."""
+        self.last_poll_held = (
+            fetched - start >= self.subscription_min_wait / 1000.0)
+        metrics = self.metrics
+        metrics.observe('poll_seconds', 'fetch', fetched - start)
+        metrics.observe('poll_seconds', 'build', built - fetched)
+        metrics.observe('poll_seconds', 'diff', time.perf_counter() - built)
+
+    def stats(self):
+        """Return a snapshot of the controller's metrics.
+
+        A dict of {metric: {label: value}}, see pyclimax.stats.METRICS,
+        histograms being dicts of their count, sum, max and p50/p95/p99
+        in seconds. The 'cache' entry holds the device list cache state.
+        """
+        stats = self.metrics.snapshot()
+        cache = self.device_cache
+        stats['cache'] = {
+            'age': cache.age(),
+            'stale': cache.stale,
+        }
+        return stats
+
+    def prometheus(self):
+        """Return the metrics of the controller and its subscription
+        registry in the Prometheus text format."""
+        return prometheus_text([(self.metrics, {'hub': self.base_url}),
+                                (self.subscription_registry.metrics, {})])
+
+    def _detect_changes(self):
+        """Run the change detector over the current device list."""
+        result = self._devices_result
+        if result is self._detected_result:
+            # Same payload as the last poll, nothing can have changed
+            self.last_changes = ChangeSet()
+            return []
+        changes = self.change_detector.detect(result.get('senrows'))
+        self._detected_result = result
+        self.last_changes = changes
+        return [self.device_index.get(device_id) for device_id in changes.ids]
 
     def start(self):
-        """Start the subscription thread."""
+        """Start polling this controller from its subscription registry."""
+        self.subscription_registry.add_controller(self)
         self.subscription_registry.start()
 
     def stop(self):
-        """Stop the subscription thread."""
-        self.subscription_registry.stop()
+        """Stop polling this controller and close the HTTP session, see
+        close."""
+        self.close()
+
+    def register(self, device, callback, fields=None, predicate=None):
+        """Register a device and callback with the subscription service.
 
-    def register(self, device, callback):
-        """Register a device and callback with the subscription service."""
-        self.subscription_registry.register(device, callback)
+        See SubscriptionRegistry.register for fields and predicate.
+        """
+        self.subscription_registry.register(device, callback, fields,
+                                            predicate)
 
     def unregister(self, device, callback):
         """Unregister a device and callback with the subscription service."""
         self.subscription_registry.unregister(device, callback)
 
+    def register_topology(self, callback):
+        """Register a callback(event, device) for added/removed devices."""
+        self.subscription_registry.register_topology(callback)
+
+    def unregister_topology(self, callback):
+        """Unregister a callback added with register_topology."""
+        self.subscription_registry.unregister_topology(callback)
+
+    def register_changes(self, callback):
+        """Register a callback for the ChangeSet of each poll."""
+        self.subscription_registry.register_changes(callback)
+
+    def unregister_changes(self, callback):
+        """Unregister a callback added with register_changes."""
+        self.subscription_registry.unregister_changes(callback)
+
 
 class ClimaxDevice(object):  # pylint: disable=R0904
     """ Class to represent each Climax device."""
 
+    # Parser of the status string into the device's reading
+    parse_status = staticmethod(parse_status)
+
     def __init__(self, json_obj, climax_controller):
         """Setup a Climax device."""
         self.json_state = json_obj
         self.device_id = self.json_state.get('id')
         self.climax_controller = climax_controller
         self.name = ''
+        self.reading = None
 
         self.type = self.json_state.get('type')
+        self._set_name()
+        self._set_reading()
+
+    def _set_reading(self):
+        """Parse the status, if it changed, into the cached reading."""
+        status = self.json_state.get('status')
+        if self.reading is None or status != self.reading.status:
+            self.reading = self.parse_status(status)
+
+    def _set_name(self):
         self.name = self.json_state.get('name')
 
         if not self.name:
@@ -278,6 +981,18 @@ class ClimaxDevice(object):  # pylint: disable=R0904
             else:
                 self.name = 'Climax Device ' + str(self.device_id)
 
+    def _set_state(self, json_obj):
+        """Patch json_state in place from a full senrows item."""
+        state = self.json_state
+        if state is json_obj:
+            return
+        state.update(json_obj)
+        if len(state) != len(json_obj):
+            for key in [key for key in state if key not in json_obj]:
+                del state[key]
+        self._set_name()
+        self._set_reading()
+
     def __repr__(self):
         if sys.version_info >= (3, 0):
             return "{} (id={} type={} name={})".format(
@@ -292,6 +1007,15 @@ class ClimaxDevice(object):  # pylint: disable=R0904
                 self.type,
                 self.name).encode('utf-8')
 
+    def _check_refresh(self, refresh):
+        """Refresh before a read if asked to, on a blocking controller."""
+        if not refresh:
+            return
+        if self.climax_controller.is_async:
+            raise PyclimaxError("Use 'await device.refresh()' with an "
+                                "AsyncClimaxController")
+        self.refresh()
+
     def climax_post_request(self, method, **kwargs):
         """Perfom a climax_request for this device."""
         request_payload = {}
@@ -306,20 +1030,21 @@ class ClimaxDevice(object):  # pylint: disable=R0904
 
         return self.climax_controller.get_request(method, request_payload)
 
-    def set_device_value(self, method, device_id, parameter_name, value):
+    def set_device_value(self, method, device_id, parameter_name, value,
+                         expect=None):
         """Set a variable on the Climax device.
 
-        This will call the Climax api to change device state.
+        This will call the Climax api to change device state. expect is a
+        callable taking the device's json_state and returning True once the
+        change shows, see ClimaxController.send_command for what is
+        returned.
         """
 
         payload = {
             'id': device_id,
             parameter_name: value
         }
-        result = self.climax_post_request(method, **payload)
-        logger.debug("set_service_value: "
-                  "result of climax_request %s with payload %s: %s",
-                  method, payload, result.text)
+        return self.climax_controller.send_command(method, payload, expect)
 
     def get_all_values(self):
         """Get all values from the deviceInfo area.
@@ -347,13 +1072,10 @@ class ClimaxDevice(object):  # pylint: disable=R0904
     def refresh(self):
         """Refresh the dev_info data used by get_value.
 
-        Only needed if you're not using subscriptions.
+        Only needed if you're not using subscriptions. Returns an awaitable
+        when the device belongs to an AsyncClimaxController.
         """
-        j = self.climax_get_request('deviceListGet').json()
-        devices = j.get('senrows')
-        for device_data in devices:
-            if device_data.get('id') == self.device_id:
-                self.update(device_data)
+        return self.climax_controller.refresh_device(self)
 
     def update(self, params):
         """Update the dev_info data from a dictionary.
@@ -362,6 +1084,7 @@ class ClimaxDevice(object):  # pylint: disable=R0904
         """
         dev_info = self.json_state
         dev_info.update({k: params[k] for k in params if dev_info.get(k)})
+        self._set_reading()
 
     @property
     def is_dimmable(self):
@@ -407,26 +1130,48 @@ class ClimaxDevice(object):  # pylint: disable=R0904
 class ClimaxSwitch(ClimaxDevice):
     """Class to add switch functionality."""
 
+    parse_status = staticmethod(parse_switch)
+
     def set_switch_state(self, state):
-        """Set the switch state, also update local state."""
-        self.set_device_value(
+        """Set the switch state: 0 off, 1 on and 2 toggle.
+
+        The hub toggles atomically, but with confirm_commands a toggle
+        reads the current state from the hub first and sends the opposite
+        explicitly, as a resent toggle would undo itself.
+        """
+        expect = None
+        if state == 2 and self.climax_controller.confirm_commands:
+            if self.climax_controller.is_async:
+                return self._toggle_async()
+            self.climax_controller.refresh_device(self, max_age=0)
+            state = 0 if self.is_switched_on() else 1
+        if state != 2:
+            on = bool(state)
+            expect = lambda json_state: self.parse_status(
+                json_state.get('status')).on == on
+
+        return self.set_device_value(
             'deviceSwitchPSSPost',
             self.device_id,
             'switch',
-            state)
+            state,
+            expect=expect)
+
+    async def _toggle_async(self):
+        await self.climax_controller.refresh_device(self, max_age=0)
+        return await self.set_switch_state(0 if self.is_switched_on() else 1)
 
     def switch_on(self):
         """Turn the switch on."""
-        self.set_switch_state(1)
+        return self.set_switch_state(1)
 
     def switch_off(self):
         """Turn the switch off."""
-        self.set_switch_state(0)
+        return self.set_switch_state(0)
 
     def switch_toggle(self):
         """Toggle the switch state."""
-
-        self.set_switch_state(2)
+        return self.set_switch_state(2)
 
     def is_switched_on(self, refresh=False):
         """Get switch state.
@@ -434,30 +1179,20 @@ class ClimaxSwitch(ClimaxDevice):
         Refresh data from Climax if refresh is True, otherwise use local cache.
         Refresh is only needed if you're not using subscriptions.
         """
-        if refresh:
-            self.refresh()
-        val = self.get_value('status')
-
-        return 'On' in val
+        self._check_refresh(refresh)
+        return self.reading.on
 
     @property
     def power(self):
         """Current power useage in watts"""
-        power = self.get_value('status')
-        
-        power = power.strip('Off, ')
-        power = power.strip('On, ')
-
-        try:
-            return float(power.strip('W'))
-        except (TypeError, AttributeError, ValueError):
-            pass
-        return 0.0
+        return self.reading.power
 
 
 class ClimaxDimmer(ClimaxSwitch):
     """Class to add dimmer functionality."""
 
+    parse_status = staticmethod(parse_dimmer)
+
     def get_brightness(self, refresh=False):
         """Get dimmer brightness.
 
@@ -466,8 +1201,7 @@ class ClimaxDimmer(ClimaxSwitch):
         Converts the Climax level property for dimmable lights from a percentage
         to the 0 - 255 scale used by HA.
         """
-        if refresh:
-            self.refresh()
+        self._check_refresh(refresh)
         brightness = 0
         percent = self.level
         if percent > 0:
@@ -484,46 +1218,32 @@ class ClimaxDimmer(ClimaxSwitch):
         if brightness > 0:
             percent = round(brightness / 2.55)
 
-        self.set_device_value(
+        return self.set_device_value(
             'deviceSwitchDimmerPost',
             self.device_id,
             'level',
-            percent)
+            percent,
+            expect=lambda json_state: self.parse_status(
+                json_state.get('status')).level == percent)
 
     @property
     def level(self):
         """Get level from Climax."""
         # Used for dimmers
-        level = self.get_value('status')
+        return self.reading.level
 
-        level = level.strip('On (')
-        try:
-            return int(level.strip('%)'))
-        except (TypeError, AttributeError, ValueError):
-            pass
-        return 0
 
 class ClimaxSensor(ClimaxDevice):
     """Class to represent a supported sensor."""
 
+    parse_status = staticmethod(parse_sensor)
+
     @property
     def temperature(self):
         """Temperature in °C."""
-
-        temp = self.get_value('status')
-        try:
-            return float(temp.strip(' °C'))
-        except (TypeError, AttributeError, ValueError):
-            pass
-        return 0.0
+        return self.reading.temperature
 
     @property
     def energy(self):
         """Energy usage in kwh"""
-        power = self.get_value('status')
-        
-        try:
-            return float(power.strip('kWh'))
-        except (TypeError, AttributeError, ValueError):
-            pass
-        return 0.0
+        return self.reading.energy
@@ -0,0 +1,637 @@
+"""
+Climax Controller asyncio API.
+
+Async counterpart of ClimaxController for applications running an asyncio
+event loop. Requires aiohttp (pip install pyclimax[async]). A single event
+loop can drive any number of hubs, each with its own poll task.
+"""
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from . import ClimaxController, TIMEOUT
+from .commands import (CoalescingQueue, COMMAND_WINDOW, CommandResult,
+                       command_key, confirm_delays)
+from .subscribe import PyclimaxError, SubscriptionRegistry
+
+# Get the logger for use in this module
+logger = logging.getLogger(__name__)
+
+_REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, PyclimaxError)
+
+
+class AsyncClimaxController(ClimaxController):
+    """Class to interact with the Climax device from asyncio.
+
+    The request methods, get_devices, get_changed_devices, refresh_data and
+    the commands of its devices (switch_on, set_brightness, refresh, ...)
+    are coroutines.
+    """
+
+    is_async = True
+
+    def __init__(self, base_url, username, password, session=None,
+                 **kwargs):
+        """Setup async Climax controller at the given URL.
+
+        base_url: Climax API URL, eg http://Climax:80.
+        session: optional aiohttp.ClientSession to share between hubs.
+        Other keyword arguments are the same as for ClimaxController.
+        """
+        super(AsyncClimaxController, self).__init__(
+            base_url, username, password, **kwargs)
+        self._session = session
+        self._owns_session = session is None
+        self._auth = aiohttp.BasicAuth(username, password)
+        self._revalidate_task = None
+        self._single_flight = AsyncSingleFlight()
+        if self.command_queue is not None:
+            self.command_queue = AsyncCommandQueue(self._post_command,
+                                                   self.command_queue.window)
+        self.subscription_registry = AsyncSubscriptionRegistry(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __enter__(self):
+        raise TypeError("Use 'async with' with an AsyncClimaxController")
+
+    @property
+    def session(self):
+        """The aiohttp session used for all requests to the hub."""
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_maxsize)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """Stop polling this controller, send queued commands, save the
+        snapshot and close the HTTP session if it is ours."""
+        registry = self.subscription_registry
+        registry.remove_controller(self)
+        if not registry.controllers:
+            await registry.stop()
+        self.save_snapshot()
+        if self.command_queue is not None:
+            await self.command_queue.close()
+        session, self._session = self._session, None
+        if session is not None and self._owns_session:
+            await session.close()
+
+    def _timeout(self, timeout):
+        """Return an aiohttp timeout with separate connect and read parts."""
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+        else:
+            connect, read = self.connect_timeout, timeout
+        return aiohttp.ClientTimeout(total=None, connect=connect,
+                                     sock_read=read)
+
+    async def _request(self, verb, method, payload, timeout, raw=False):
+        requests_url = self.base_url + "/action/" + method
+        start = time.perf_counter()
+        try:
+            async with self.session.request(
+                    verb, requests_url, auth=self._auth, data=payload,
+                    timeout=self._timeout(timeout)) as r:
+                r.raise_for_status()
+                content = await r.read()
+        except _REQUEST_ERRORS as ex:
+            self.metrics.count('errors', type(ex).__name__)
+            raise
+        self._record_request(method, start, len(content))
+        if raw:
+            return content
+        return content.decode(r.get_encoding(), 'replace')
+
+    async def post_request(self, method, payload, timeout=TIMEOUT):
+        """Post a request and return the response body."""
+        return await self._request('POST', method, payload, timeout)
+
+    async def get_request(self, method, payload={}, timeout=TIMEOUT):
+        """Get a request and return the response body."""
+        return await self._request('GET', method, payload, timeout)
+
+    async def _ensure_devices(self, refresh):
+        if refresh or not self.device_index.loaded:
+            await self.get_devices()
+
+    async def get_device_by_name(self, device_name, refresh=False):
+        """Search the list of connected devices by name."""
+        await self._ensure_devices(refresh)
+        found_device = self.device_index.by_name(device_name)
+        if found_device is None:
+            logger.debug('Did not find device with {}'.format(device_name))
+        return found_device
+
+    async def get_device_by_id(self, device_id, refresh=False):
+        """Search the list of connected devices by ID."""
+        await self._ensure_devices(refresh)
+        found_device = self.device_index.get(device_id)
+        if found_device is None:
+            logger.debug('Did not find device with {}'.format(device_id))
+        return found_device
+
+    async def get_devices_by_type(self, device_type, refresh=False):
+        """Return the devices with the given type (eg 48) or type_f."""
+        await self._ensure_devices(refresh)
+        return self.device_index.by_type(device_type)
+
+    async def get_devices_by_area(self, area, zone=None, refresh=False):
+        """Return the devices in an area, optionally limited to a zone."""
+        await self._ensure_devices(refresh)
+        return self.device_index.by_area(area, zone)
+
+    async def get_devices(self, max_age=None):
+        """Get list of connected devices, see ClimaxController.get_devices."""
+        result = await self.get_device_list(max_age)
+        if result is self._devices_result:
+            return self.devices
+        return self._load_devices(result)
+
+    async def get_device_list(self, max_age=None, revalidate=True):
+        """Return the parsed deviceListGet payload, using the cache.
+
+        Same semantics as ClimaxController.get_device_list, the background
+        refresh runs as a task on the event loop.
+        """
+        cache = self.device_cache
+        if max_age is None:
+            max_age = self.max_age
+        if max_age > 0 and cache.result is not None:
+            if cache.is_fresh(max_age):
+                return cache.result
+            if revalidate and self._serve_stale(max_age):
+                self._revalidate()
+                return cache.result
+        try:
+            return await self._fetch_device_list()
+        except _REQUEST_ERRORS as ex:
+            if max_age > 0 and cache.result is not None:
+                logger.warning("Climax unreachable, using device list from "
+                               "%.1fs ago: %s", cache.age(), str(ex))
+                return cache.result
+            raise
+
+    def _revalidate(self):
+        if not self.device_cache.begin_revalidate():
+            return
+
+        async def run():
+            try:
+                await self._fetch_device_list()
+            except _REQUEST_ERRORS as ex:
+                logger.debug("Background refresh failed: %s", str(ex))
+            finally:
+                self.device_cache.end_revalidate()
+
+        self._revalidate_task = asyncio.ensure_future(run())
+
+    async def _fetch_device_list(self, poll=False):
+        key = 'deviceListPoll' if poll else 'deviceListGet'
+        return await self._single_flight.do(
+            key, lambda: self._request_device_list(poll))
+
+    async def _request_device_list(self, poll=False, version=None,
+                                   timeout=None):
+        if poll:
+            payload = self._device_list_payload(version)
+            timeout = timeout or self._poll_timeout()
+        else:
+            payload = {}
+            timeout = timeout or TIMEOUT
+
+        logger.debug("get_devices() requesting payload %s", str(payload))
+        try:
+            content = await self._request('GET', 'deviceListGet', payload,
+                                          timeout, raw=True)
+            return self._store_device_list(
+                content, lambda: content.decode('utf-8', 'replace'))
+        except PyclimaxError as ex:
+            self.metrics.count('errors', type(ex).__name__)
+            self.device_cache.fail(ex)
+            raise
+        except _REQUEST_ERRORS as ex:
+            self.device_cache.fail(ex)
+            raise
+
+    async def _fetch_hub(self, max_age=None):
+        """Get welcomeGet and deviceListGet in parallel, return the device
+        list."""
+        welcome, device_list = await asyncio.gather(
+            self.get_request('welcomeGet'),
+            self.get_device_list(max_age))
+        self._set_welcome(self._parse_json(welcome))
+        return device_list
+
+    async def refresh_data(self):
+        """Refresh data from Climax device."""
+        devs = (await self._fetch_hub()).get('senrows')
+        return {dev.get('id'): dev for dev in devs}
+
+    def _start_reconcile(self):
+        self._reconcile_task = asyncio.ensure_future(
+            self._reconcile_snapshot())
+
+    async def _reconcile_snapshot(self):
+        mac = self.mac
+        try:
+            result = await self._fetch_hub(max_age=0)
+        except _REQUEST_ERRORS as ex:
+            logger.warning("Could not reach Climax %s, using snapshot: %s",
+                           self.base_url, str(ex))
+            return
+        if mac is not None and mac != self.mac:
+            logger.warning("Climax at %s is now %s, not %s", self.base_url,
+                           self.mac, mac)
+        self._load_devices(result)
+        self.save_snapshot()
+
+    async def refresh_device(self, device, max_age=None):
+        """Refresh the json_state of a single device from the hub."""
+        result = await self.get_device_list(max_age, revalidate=False)
+        self._update_device(device, result.get('senrows'))
+
+    async def send_command(self, method, payload, expect=None):
+        """Send a device command to the hub.
+
+        With confirm_commands this returns a CommandResult
+        once a re-poll shows the expected state, see
+        ClimaxController.send_command. Otherwise it returns the response
+        body. With a command_window the command is queued and coalesced.
+        """
+        if not self.confirm_commands:
+            return await self._dispatch_command(method, payload)
+
+        key = command_key(method, payload)
+        token = self._command_tokens[key] = object()
+        start = time.monotonic()
+        response = None
+        for attempt in range(1, self._command_attempts(payload) + 1):
+            if self._command_tokens.get(key) is not token:
+                # A newer value was sent before this one got its turn
+                return CommandResult(method, payload, response, False,
+                                     attempt - 1, time.monotonic() - start,
+                                     superseded=True)
+            response = await self._dispatch_command(method, payload)
+            if expect is None:
+                return CommandResult(method, payload, response, None, attempt,
+                                     time.monotonic() - start)
+
+            timeout = self.confirm_timeout * 2 ** (attempt - 1)
+            deadline = time.monotonic() + timeout
+            for delay in confirm_delays(timeout):
+                await asyncio.sleep(
+                    max(min(delay, deadline - time.monotonic()), 0))
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self._command_tokens.get(key) is not token:
+                    return CommandResult(method, payload, response, False,
+                                         attempt, time.monotonic() - start,
+                                         superseded=True)
+                if await self._check_confirmed(payload.get('id'), expect,
+                                               remaining):
+                    latency = time.monotonic() - start
+                    self.command_latencies.append(latency)
+                    return CommandResult(method, payload, response, True,
+                                         attempt, latency)
+
+            logger.info("Command %s %s not confirmed after %ss",
+                        method, payload, timeout)
+
+        raise PyclimaxError("Command {} {} was not confirmed".format(
+            method, payload))
+
+    async def _dispatch_command(self, method, payload):
+        if self.command_queue is not None:
+            return await self.command_queue.submit(method, payload)
+        return await self._post_command(method, payload)
+
+    async def _check_confirmed(self, device_id, expect, timeout):
+        try:
+            self._set_devices(await asyncio.wait_for(
+                self._request_device_list(timeout=timeout), timeout))
+        except _REQUEST_ERRORS as ex:
+            logger.debug("Confirmation poll failed: %s", str(ex))
+            return False
+        device = self.device_index.get(device_id)
+        return device is not None and expect(device.json_state)
+
+    async def _post_command(self, method, payload):
+        result = await self.post_request(method, payload)
+        self.poll_scheduler.command_sent()
+        self.subscription_registry.wakeup(self)
+        self.device_cache.invalidate()
+        logger.debug("set_service_value: "
+                  "result of climax_request %s with payload %s: %s",
+                  method, payload, result)
+        return result
+
+    async def get_changed_devices(self):
+        """
+        Get data from controller and filter out the ones
+        that have changed.
+        """
+        start = time.perf_counter()
+        if self.long_polling:
+            result = await self._request_device_list(
+                True, self.device_list_version)
+        else:
+            result = await self._fetch_device_list(poll=True)
+        fetched = time.perf_counter()
+        self._set_devices(result)
+        built = time.perf_counter()
+        changed = self._detect_changes()
+        self._record_poll(start, fetched, built)
+        return changed
+
+    @staticmethod
+    def _parse_json(text):
+        try:
+            return json.loads(text)
+        except ValueError as ex:
+            raise PyclimaxError("JSON decode error: " + str(ex))
+
+    def start(self):
+        """Start the subscription poll task on the running event loop."""
+        self.subscription_registry.add_controller(self)
+        self.subscription_registry.start()
+
+    async def stop(self):
+        """Stop the subscription poll task and close the HTTP session, see
+        close."""
+        await self.close()
+
+
+class AsyncSingleFlight(object):
+    """Class running at most one coroutine per key at a time.
+
+    Tasks calling do() with a key already in flight await that call and
+    share its result or exception.
+    """
+
+    def __init__(self):
+        """Setup with no calls in flight."""
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key, fn):
+        """Return await fn(), or the result of the call for key in flight."""
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+            return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # Mark it retrieved, the leader raises it itself
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
+
+
+class AsyncCommandQueue(CoalescingQueue):
+    """Coalescing command queue flushed by a task on the event loop.
+
+    send: coroutine function(method, payload) posting a command to the hub.
+    """
+
+    def __init__(self, send, window=COMMAND_WINDOW):
+        """Setup the queue, the worker task starts on first submit."""
+        super(AsyncCommandQueue, self).__init__(window)
+        self._send = send
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._exiting = False
+
+    def submit(self, method, payload):
+        """Queue a command, return a future for the hub's response."""
+        future = asyncio.get_running_loop().create_future()
+        self._add(method, payload, future)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+        return future
+
+    async def close(self):
+        """Send pending commands and stop the worker task."""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        self._exiting = True
+        self._wakeup.set()
+        await task
+        self._exiting = False
+
+    async def _run(self):
+        while True:
+            command, wait = self._pop_due(self._exiting)
+            if command is None:
+                if self._exiting:
+                    return
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                result = await self._send(command.method, command.payload)
+            except Exception as ex:
+                for future in command.futures:
+                    if not future.done():
+                        future.set_exception(ex)
+            else:
+                for future in command.futures:
+                    if not future.done():
+                        future.set_result(result)
+
+
+class AsyncSubscriptionRegistry(SubscriptionRegistry):
+    """Subscription registry polling from asyncio tasks.
+
+    Each controller is polled by its own task on the event loop, so one
+    loop drives any number of hubs. Callbacks may be plain functions or
+    coroutine functions; coroutine callbacks are awaited in order on the
+    poll task of their hub. Its metrics are the same, except for the
+    stalls, as it has no watchdog thread.
+    """
+
+    def __init__(self, controller=None):
+        """Setup subscription for one or a list of AsyncClimaxControllers."""
+        self._poll_tasks = {}
+        self._wakeups = {}
+        super(AsyncSubscriptionRegistry, self).__init__(controller,
+                                                        callback_workers=0)
+
+    def add_controller(self, controller):
+        """Poll a controller from this registry."""
+        super(AsyncSubscriptionRegistry, self).add_controller(controller)
+        if self._poll_tasks and controller not in self._poll_tasks:
+            self._start_task(controller)
+
+    def remove_controller(self, controller):
+        """Stop polling a controller."""
+        super(AsyncSubscriptionRegistry, self).remove_controller(controller)
+        task = self._poll_tasks.pop(controller, None)
+        if task is not None:
+            task.cancel()
+
+    def _event_topology(self, event, device):
+        logger.debug("Topology event: %s %s", event, device.name)
+        for callback in list(self._topology_callbacks):
+            try:
+                result = callback(event, device)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result)
+            except Exception:
+                logger.exception(
+                    "Unhandled exception in topology callback for device "
+                    "#%s (%s)", str(device.device_id), device.name)
+
+    async def _event(self, device_data_list, changes=None):
+        for device_data in device_data_list:
+            device_list = self._devices.get(self._key(device_data))
+            if device_list is None:
+                continue
+            device_changes = self._device_changes(device_data, changes)
+            for device in device_list:
+                await self._event_device(device, device_data, device_changes)
+
+    async def _event_device(self, device, device_data, changes=None):
+        if device is None:
+            return
+        logger.debug("Event: %s", device.name)
+        device.update(device_data.json_state)
+        if changes is None:
+            changes = self._device_changes(device_data, None)
+        matched = self._match(device, changes)
+        if not matched:
+            return
+        start = time.perf_counter()
+        for subscription, changes in matched.items():
+            try:
+                if subscription.filtered:
+                    result = subscription.callback(device, changes)
+                else:
+                    result = subscription.callback(device)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                # Don't let loosely-implemented callbacks kill the poll task.
+                self.metrics.count('callback_errors', device.device_id)
+                logger.exception(
+                    "Unhandled exception in callback for device #%s (%s)",
+                    str(device.device_id), device.name)
+        self.metrics.observe('callback_seconds', device.device_id,
+                             time.perf_counter() - start)
+
+    def join(self):
+        """Return an awaitable finishing with the poll tasks."""
+        return asyncio.gather(*self._poll_tasks.values(),
+                              return_exceptions=True)
+
+    def start(self):
+        """Start a task per controller to handle Climax polling."""
+        self._exiting = False
+        for controller in self._controllers:
+            if controller not in self._poll_tasks:
+                self._start_task(controller)
+
+    def _start_task(self, controller):
+        self._poll_tasks[controller] = asyncio.ensure_future(
+            self._run_poll_task(controller))
+
+    def wakeup(self, controller=None):
+        """Poll a controller, or all of them, without further waiting."""
+        for hub, event in self._wakeups.items():
+            if controller is None or hub is controller:
+                event.set()
+
+    async def _wait(self, controller, delay):
+        event = self._wakeups.setdefault(controller, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    async def stop(self):
+        """Tell the poll tasks to terminate and wait for them."""
+        self._exiting = True
+        tasks = list(self._poll_tasks.values())
+        self._poll_tasks = {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info("Terminated poll tasks")
+
+    async def _run_poll_task(self, controller):
+        scheduler = controller.poll_scheduler
+        while not self._exiting:
+            start = time.perf_counter()
+            try:
+                logger.debug("Polling for Climax changes")
+                device_data = await controller.get_changed_devices()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                logger.debug("Caught request error: %s", str(ex))
+                failed = ex
+            except PyclimaxError as ex:
+                logger.debug("Non-fatal error in poll: %s", str(ex))
+                failed = ex
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                logger.exception("Climax poll task general exception: %s",
+                    str(ex))
+                failed = ex
+            else:
+                logger.debug("Poll returned")
+                scheduler.poll_succeeded(controller.last_changes.activity,
+                                         controller.long_polling,
+                                         controller.last_poll_held)
+                if not self._exiting:
+                    events = time.perf_counter()
+                    if controller.last_changes:
+                        self._event_changes(controller,
+                                            controller.last_changes)
+                    if device_data:
+                        await self._event(device_data,
+                                          controller.last_changes)
+                    else:
+                        logger.debug("No changes in poll interval")
+                    self.metrics.observe('poll_seconds', 'events',
+                                         time.perf_counter() - events)
+                    self.metrics.observe('poll_seconds', 'total',
+                                         time.perf_counter() - start)
+                    await self._wait(controller, scheduler.next_delay())
+
+                continue
+
+            self.metrics.observe('poll_seconds', 'total',
+                                 time.perf_counter() - start)
+            self.metrics.count('poll_errors', type(failed).__name__)
+            scheduler.poll_failed()
+            delay = scheduler.next_delay()
+            logger.info("Could not poll Climax %s - will retry in %.1fs",
+                        controller.base_url, delay)
+            await self._wait(controller, delay)
+
+        logger.info("Shutdown Climax Poll Task")
@@ -0,0 +1,117 @@
+"""Cache of the last deviceListGet payload from a Climax hub."""
+import threading
+import time
+
+
+class DeviceListCache(object):
+    """Class holding the last known good deviceListGet result.
+
+    Ages are measured on the monotonic clock; fetched_at is wall clock time
+    for display. A failed fetch keeps the last good result around and marks
+    the cache stale until the next successful fetch. The result is kept
+    with the fingerprint of the body it was parsed from, both are set and
+    matched together under a lock as several threads may fetch at once.
+    """
+
+    def __init__(self, max_age):
+        """Setup an empty cache.
+
+        max_age: seconds a result is considered fresh.
+        """
+        self.max_age = max_age
+        self.result = None
+        self.fingerprint = None
+        self.fetched_at = None
+        self.last_error = None
+        self.last_error_at = None
+        self._fetched = None
+        self._invalidated = False
+        self._revalidating = False
+        self._lock = threading.Lock()
+        self.restored = False
+
+    def put(self, result, fingerprint=None):
+        """Store a freshly fetched result, and the fingerprint of the body
+        it was parsed from."""
+        with self._lock:
+            self.result = result
+            self.fingerprint = fingerprint
+            self._fetched_now()
+
+    def reuse(self, fingerprint):
+        """Return the result if it was parsed from a body with fingerprint,
+        counting it as freshly fetched, else None."""
+        with self._lock:
+            if (fingerprint is None or fingerprint != self.fingerprint
+                    or self.result is None):
+                return None
+            self._fetched_now()
+            return self.result
+
+    def _fetched_now(self):
+        self._fetched = time.monotonic()
+        self.fetched_at = time.time()
+        self.last_error = None
+        self._invalidated = False
+        self.restored = False
+
+    def restore(self, result, fetched_at):
+        """Store a result from a snapshot, fetched at wall clock time
+        fetched_at. It is served as stale until the next fetch."""
+        with self._lock:
+            self.result = result
+            self.fingerprint = None
+            self.fetched_at = fetched_at
+            self._fetched = (time.monotonic()
+                             - max(time.time() - fetched_at, 0))
+            self._invalidated = False
+            self.restored = True
+
+    def invalidate(self):
+        """Force the next read to fetch, e.g. after a device command.
+
+        The result is kept as a fallback if the hub can't be reached.
+        """
+        self._invalidated = True
+
+    def fail(self, error):
+        """Record a failed fetch, keeping the last good result."""
+        self.last_error = error
+        self.last_error_at = time.time()
+
+    def age(self):
+        """Seconds since the last successful fetch, None if never fetched."""
+        if self._fetched is None:
+            return None
+        return time.monotonic() - self._fetched
+
+    def is_fresh(self, max_age=None):
+        """Return True if there is a result younger than max_age."""
+        if max_age is None:
+            max_age = self.max_age
+        age = self.age()
+        return (age is not None and age <= max_age and not self._invalidated
+                and not self.restored)
+
+    @property
+    def revalidatable(self):
+        """True if an expired result may be served while refreshing."""
+        return self.result is not None and not self._invalidated
+
+    @property
+    def stale(self):
+        """True if the result is too old or the last fetch failed."""
+        return self.last_error is not None or not self.is_fresh()
+
+    def begin_revalidate(self):
+        """Claim the background refresh, False if one is already running."""
+        with self._lock:
+            if self._revalidating:
+                return False
+            self._revalidating = True
+            return True
+
+    def end_revalidate(self):
+        """Release the background refresh claimed by begin_revalidate."""
+        with self._lock:
+            self._revalidating = False
@@ -0,0 +1,102 @@
+"""Single pass change detection between Climax device lists."""
+
+# Fields of a senrows item compared between polls, 'id' is the key
+DEVICE_FIELDS = ('status', 'rssi', 'battery', 'battery_ok', 'tamper',
+                 'tamper_ok', 'cond', 'cond_ok', 'bypass', 'su', 'name',
+                 'area', 'zone', 'type', 'type_f')
+# Fields drifting on their own, their changes don't make the house active
+NOISY_FIELDS = ('rssi',)
+
+
+class ChangeSet(object):
+    """Class describing the difference between two device lists.
+
+    added: ids of devices that appeared.
+    removed: ids of devices that disappeared.
+    changed: {id: {field: (old value, new value)}} for devices whose
+    compared fields changed.
+    """
+
+    def __init__(self, added=None, removed=None, changed=None):
+        self.added = added or []
+        self.removed = removed or []
+        self.changed = changed or {}
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "ChangeSet(added={}, removed={}, changed={})".format(
+            self.added, self.removed, self.changed)
+
+    @property
+    def activity(self):
+        """True if devices were added or removed, or changed more than
+        their NOISY_FIELDS."""
+        if self.added or self.removed:
+            return True
+        return any(field not in NOISY_FIELDS
+                   for fields in self.changed.values() for field in fields)
+
+    @property
+    def ids(self):
+        """Ids of the added and changed devices, in poll order."""
+        return self.added + list(self.changed)
+
+
+class ChangeDetector(object):
+    """Class detecting changes in successive deviceListGet results.
+
+    Keeps a tuple of the compared fields per device id, so each poll is a
+    single dict-keyed pass with tuple comparisons, and only devices that
+    actually changed are compared field by field.
+    """
+
+    def __init__(self, fields=DEVICE_FIELDS, ignored_fields=()):
+        """Setup a detector.
+
+        fields: the senrows fields to compare.
+        ignored_fields: noisy fields, such as 'rssi', that never count as a
+        change.
+        """
+        self.fields = tuple(field for field in fields
+                            if field not in ignored_fields)
+        self._snapshots = {}
+
+    def reset(self):
+        """Forget the previous device list, all devices count as added."""
+        self._snapshots = {}
+
+    def seed(self, rows):
+        """Use rows as the previous device list if there is none yet."""
+        if not self._snapshots:
+            self.detect(rows)
+
+    def detect(self, rows):
+        """Compare rows (a senrows list) with the previous call."""
+        fields = self.fields
+        old_snapshots = self._snapshots
+        snapshots = {}
+        added = []
+        changed = {}
+
+        for row in rows:
+            device_id = row.get('id')
+            snapshot = tuple(row.get(field) for field in fields)
+            snapshots[device_id] = snapshot
+            old = old_snapshots.get(device_id)
+            if old is None:
+                added.append(device_id)
+            elif old != snapshot:
+                changed[device_id] = {
+                    field: (old_value, new_value)
+                    for field, old_value, new_value in zip(fields, old,
+                                                           snapshot)
+                    if old_value != new_value}
+
+        removed = [device_id for device_id in old_snapshots
+                   if device_id not in snapshots]
+        self._snapshots = snapshots
+        return ChangeSet(added, removed, changed)
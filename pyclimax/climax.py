@@ -8,7 +8,6 @@ import requests
 import sys
 import json
 import os
-from jsondiff import diff
 
 from subscribe import SubscriptionRegistry
 from subscribe import PyclimaxError
@@ -236,7 +235,7 @@ class ClimaxController(object):
                 changed_devices.append(device)
                 continue
 
-            if diff(device.json_state, found_old_device.json_state):
+            if device.json_state != found_old_device.json_state:
                 print('Got a diff!')
                 changed_devices.append(device)
 
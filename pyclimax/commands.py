@@ -0,0 +1,219 @@
+"""Coalescing queue for Climax device commands."""
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+# Default time in seconds a command waits for newer values to replace it
+COMMAND_WINDOW = 0.2
+# Delay in seconds before the first confirmation re-poll, doubled each time
+CONFIRM_POLL_DELAY = 0.1
+# Longest delay in seconds between confirmation re-polls
+CONFIRM_POLL_MAX_DELAY = 1
+# Time in seconds to wait for a command to be confirmed before resending it
+CONFIRM_TIMEOUT = 3
+# Number of times an unconfirmed command is resent
+COMMAND_RETRIES = 1
+
+# Get the logger for use in this module
+logger = logging.getLogger(__name__)
+
+
+def command_key(method, payload):
+    """Return the key identifying what a command changes.
+
+    Commands with the same key (method, device id and parameter names)
+    replace each other.
+    """
+    return (method, payload.get('id'),
+            tuple(sorted(name for name in payload if name != 'id')))
+
+
+def confirm_delays(timeout):
+    """Yield exponentially growing re-poll delays adding up to timeout."""
+    delay = CONFIRM_POLL_DELAY
+    remaining = timeout
+    while remaining > 0:
+        delay = min(delay, remaining)
+        yield delay
+        remaining -= delay
+        delay = min(delay * 2, CONFIRM_POLL_MAX_DELAY)
+
+
+def log_failure(future):
+    """Done callback logging the error of a command Future, as its caller
+    may never ask for the result."""
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("Device command failed: %s", str(future.exception()))
+
+
+class CommandResult(object):
+    """Outcome of a device command.
+
+    response: the hub's response to the last post of the command.
+    confirmed: True if a re-poll showed the expected state, False if the
+    command was superseded by a newer one first, None if there was nothing
+    to confirm.
+    attempts: number of times the command was posted.
+    latency: seconds from the first post to confirmation.
+    """
+
+    def __init__(self, method, payload, response, confirmed, attempts,
+                 latency, superseded=False):
+        self.method = method
+        self.payload = payload
+        self.response = response
+        self.confirmed = confirmed
+        self.attempts = attempts
+        self.latency = latency
+        self.superseded = superseded
+
+    def __repr__(self):
+        return ("CommandResult({} {} confirmed={} attempts={} "
+                "latency={:.3f})").format(self.method, self.payload,
+                                          self.confirmed, self.attempts,
+                                          self.latency)
+
+
+class _Command(object):
+    """A pending command and the futures waiting for it."""
+
+    def __init__(self, method, payload, due):
+        self.method = method
+        self.payload = payload
+        self.due = due
+        self.futures = []
+
+
+class CoalescingQueue(object):
+    """Class keeping pending commands, coalesced per device and parameter.
+
+    A command replaces the pending command for the same (method, device id,
+    parameters) and keeps its place in the queue, so only the latest value
+    is sent while commands for different devices are sent in the order
+    they were first submitted.
+    """
+
+    def __init__(self, window=COMMAND_WINDOW):
+        """Setup an empty queue.
+
+        window: seconds a command is held back for newer values.
+        """
+        self.window = window
+        self._pending = collections.OrderedDict()
+        self.submitted = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _add(self, method, payload, future):
+        self.submitted += 1
+        key = command_key(method, payload)
+        command = self._pending.get(key)
+        if command is None:
+            command = self._pending[key] = _Command(
+                method, payload, time.monotonic() + self.window)
+        else:
+            self.coalesced += 1
+            command.payload = payload
+        command.futures.append(future)
+
+    def _pop_due(self, flush=False):
+        """Return (command, None) if the first command is due, otherwise
+        (None, seconds until it is due), or (None, None) if empty."""
+        if not self._pending:
+            return None, None
+        key, command = next(iter(self._pending.items()))
+        wait = command.due - time.monotonic()
+        if wait > 0 and not flush:
+            return None, wait
+        del self._pending[key]
+        self.sent += 1
+        return command, None
+
+
+class CommandQueue(CoalescingQueue):
+    """Coalescing command queue flushed by a background thread.
+
+    send: callable(method, payload) posting a command to the hub.
+    """
+
+    def __init__(self, send, window=COMMAND_WINDOW):
+        """Setup the queue, the worker thread starts on first submit."""
+        super(CommandQueue, self).__init__(window)
+        self._send = send
+        self._condition = threading.Condition()
+        self._thread = None
+        self._exiting = False
+        self._flush = False
+
+    def submit(self, method, payload):
+        """Queue a command, return a Future for the hub's response.
+
+        If the command is replaced by a newer value before it is sent, the
+        future resolves with the response to the newer value.
+        """
+        future = Future()
+        with self._condition:
+            self._add(method, payload, future)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='Climax Command Thread',
+                    daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def flush(self):
+        """Send all pending commands now and wait for them."""
+        with self._condition:
+            futures = [future for command in self._pending.values()
+                       for future in command.futures]
+            self._flush = True
+            self._condition.notify()
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def close(self):
+        """Send pending commands and stop the worker thread.
+
+        The queue can be used again afterwards, a new worker is started.
+        """
+        with self._condition:
+            self._exiting = True
+            self._condition.notify()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self._exiting = False
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    command, wait = self._pop_due(self._flush or self._exiting)
+                    if command is not None:
+                        break
+                    if self._exiting:
+                        return
+                    self._flush = False
+                    self._condition.wait(wait)
+            self._execute(command)
+
+    def _execute(self, command):
+        try:
+            result = self._send(command.method, command.payload)
+        except Exception as ex:
+            logger.debug("Command %s %s failed: %s", command.method,
+                         command.payload, str(ex))
+            for future in command.futures:
+                future.set_exception(ex)
+        else:
+            for future in command.futures:
+                future.set_result(result)
@@ -0,0 +1,105 @@
+"""Dispatch of subscription callbacks off the poll thread."""
+import collections
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of threads running callbacks
+CALLBACK_WORKERS = 4
+# Keep only the newest pending update per device
+OVERFLOW_COALESCE = 'coalesce'
+# Keep up to max_pending updates per device, dropping the oldest
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+# Default max pending updates per device for OVERFLOW_DROP_OLDEST
+MAX_PENDING = 100
+
+# Get the logger for use in this module
+logger = logging.getLogger(__name__)
+
+
+class CallbackDispatcher(object):
+    """Class running callbacks on a bounded thread pool.
+
+    Work is submitted per key (a device). Work for one key runs in
+    submission order, one item at a time, while different keys run in
+    parallel. When a key's work arrives faster than it drains the overflow
+    policy applies: OVERFLOW_COALESCE keeps only the newest pending item,
+    OVERFLOW_DROP_OLDEST keeps up to max_pending.
+    """
+
+    def __init__(self, max_workers=CALLBACK_WORKERS,
+                 overflow=OVERFLOW_COALESCE, max_pending=MAX_PENDING):
+        """Setup a dispatcher, threads are started on demand."""
+        if overflow not in (OVERFLOW_COALESCE, OVERFLOW_DROP_OLDEST):
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        self.max_workers = max_workers
+        self.overflow = overflow
+        self.max_pending = 1 if overflow == OVERFLOW_COALESCE else max_pending
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._scheduled = set()
+        self._executor = None
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.dispatched = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def submit(self, key, fn, *args):
+        """Run fn(*args) after the work already submitted for key."""
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = collections.deque()
+            if len(pending) >= self.max_pending:
+                pending.popleft()
+                self.queue_depth -= 1
+                if self.overflow == OVERFLOW_COALESCE:
+                    self.coalesced += 1
+                else:
+                    self.dropped += 1
+            pending.append((fn, args))
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            if key in self._scheduled:
+                return
+            self._scheduled.add(key)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='Climax Callback')
+            executor = self._executor
+        executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                pending = self._pending.get(key)
+                if not pending:
+                    self._pending.pop(key, None)
+                    self._scheduled.discard(key)
+                    return
+                fn, args = pending.popleft()
+                self.queue_depth -= 1
+                self.dispatched += 1
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Unhandled exception in dispatched callback")
+
+    def shutdown(self, wait=True):
+        """Stop the threads, after running pending work if wait is True."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        """Return a dict of queue and drop counters."""
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'dispatched': self.dispatched,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,256 @@
+"""Columnar state of all devices of one or more hubs.
+
+Requires NumPy, install with the 'fleet' extra.
+"""
+import threading
+
+import numpy as np
+
+from . import ClimaxDimmer, ClimaxSwitch, DEVICE_ADDED, DEVICE_REMOVED
+
+# Rows allocated up front, grown by doubling
+INITIAL_CAPACITY = 64
+
+# Float columns, NaN where a device has no such reading
+FLOAT_COLUMNS = ('power', 'level', 'temperature', 'energy', 'battery')
+# Bool columns
+BOOL_COLUMNS = ('on', 'online', 'battery_ok', 'tamper_ok')
+# Integer code columns usable with group_by, -1 if unknown
+CODE_COLUMNS = ('hub', 'area', 'zone', 'type')
+
+# Aggregates of group_by
+AGGREGATES = ('sum', 'mean', 'min', 'max', 'count')
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_code(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+class FleetState(object):
+    """Class keeping the readings of many devices in parallel arrays.
+
+    Each device is a row, identified by (controller, device id). Rows are
+    filled from the device objects when a controller is attached, and then
+    only the rows of devices in each poll's ChangeSet are rewritten, from
+    the controller's subscription registry. Queries are vectorized over
+    all rows, optionally restricted by hub, area, zone or type.
+    """
+
+    def __init__(self, controllers=(), capacity=INITIAL_CAPACITY):
+        """Setup an empty store and attach controllers."""
+        self._lock = threading.Lock()
+        self._hubs = []
+        self._attached = []
+        self._rows = {}
+        self._keys = []
+        self._columns = {}
+        for name in FLOAT_COLUMNS:
+            self._columns[name] = np.full(capacity, np.nan)
+        for name in BOOL_COLUMNS:
+            self._columns[name] = np.zeros(capacity, dtype=bool)
+        for name in CODE_COLUMNS:
+            self._columns[name] = np.full(capacity, -1, dtype=np.int32)
+        for controller in controllers:
+            self.attach(controller)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def attach(self, controller):
+        """Load the devices of controller and follow its polls."""
+        with self._lock:
+            if controller in self._attached:
+                return
+            self._attached.append(controller)
+            if controller not in self._hubs:
+                self._hubs.append(controller)
+            for device in controller.devices:
+                self._set_row(device)
+        controller.register_topology(self._event_topology)
+        controller.register_changes(self._event_changes)
+
+    def detach(self, controller):
+        """Drop the devices of controller and stop following it."""
+        controller.unregister_topology(self._event_topology)
+        controller.unregister_changes(self._event_changes)
+        with self._lock:
+            if controller in self._attached:
+                self._attached.remove(controller)
+            for key in [key for key in self._keys if key[0] is controller]:
+                self._remove_row(key)
+
+    def _event_topology(self, event, device):
+        with self._lock:
+            if event == DEVICE_ADDED:
+                self._set_row(device)
+            elif event == DEVICE_REMOVED:
+                self._remove_row((device.climax_controller, device.device_id))
+
+    def _event_changes(self, controller, changes):
+        index = controller.device_index
+        with self._lock:
+            for device_id in changes.ids:
+                device = index.get(device_id)
+                if device is not None:
+                    self._set_row(device)
+
+    def _grow(self):
+        for name, column in self._columns.items():
+            grown = np.empty(len(column) * 2, dtype=column.dtype)
+            grown[:len(column)] = column
+            self._columns[name] = grown
+
+    def _set_row(self, device):
+        controller = device.climax_controller
+        key = (controller, device.device_id)
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._keys)
+            if row == len(self._columns['hub']):
+                self._grow()
+            self._rows[key] = row
+            self._keys.append(key)
+
+        reading = device.reading
+        state = device.json_state
+        is_switch = isinstance(device, ClimaxSwitch)
+        columns = self._columns
+        columns['power'][row] = reading.power if is_switch else np.nan
+        columns['level'][row] = (reading.level
+                                 if isinstance(device, ClimaxDimmer)
+                                 else np.nan)
+        columns['temperature'][row] = (reading.temperature
+                                       if device.has_temperature else np.nan)
+        columns['energy'][row] = reading.energy if device.has_energy else np.nan
+        columns['battery'][row] = _to_float(state.get('battery'))
+        columns['on'][row] = reading.on
+        columns['online'][row] = state.get('cond_ok') == '1'
+        columns['battery_ok'][row] = state.get('battery_ok') == '1'
+        columns['tamper_ok'][row] = state.get('tamper_ok') == '1'
+        columns['hub'][row] = self._hubs.index(controller)
+        columns['area'][row] = _to_code(state.get('area'))
+        columns['zone'][row] = _to_code(state.get('zone'))
+        columns['type'][row] = _to_code(device.type)
+
+    def _remove_row(self, key):
+        """Remove a row by moving the last row into its place."""
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        last = len(self._keys) - 1
+        if row != last:
+            moved = self._keys[last]
+            for column in self._columns.values():
+                column[row] = column[last]
+            self._keys[row] = moved
+            self._rows[moved] = row
+        self._keys.pop()
+
+    def _select(self, filters):
+        """Return a row mask for filters such as area=1, or None for all."""
+        mask = None
+        for name, value in filters.items():
+            if name == 'hub':
+                value = (self._hubs.index(value) if value in self._hubs
+                         else -2)
+            elif name not in self._columns:
+                raise ValueError("Unknown column: {}".format(name))
+            match = self._columns[name][:len(self._keys)] == value
+            mask = match if mask is None else mask & match
+        return mask
+
+    def column(self, name, **filters):
+        """Return a copy of a column, for the rows matching filters."""
+        with self._lock:
+            values = self._columns[name][:len(self._keys)]
+            mask = self._select(filters)
+            return values[mask] if mask is not None else values.copy()
+
+    def devices(self, **filters):
+        """Return the devices matching filters, in row order."""
+        with self._lock:
+            mask = self._select(filters)
+            keys = (self._keys if mask is None
+                    else [self._keys[row] for row in np.flatnonzero(mask)])
+            return [controller.device_index.get(device_id)
+                    for controller, device_id in keys]
+
+    def sum(self, name, **filters):
+        """Sum of a column over the devices having the reading."""
+        return float(np.nansum(self.column(name, **filters)))
+
+    def mean(self, name, **filters):
+        """Mean of a column over the devices having the reading, or NaN."""
+        return self._reduce(np.nanmean, name, filters)
+
+    def min(self, name, **filters):
+        """Min of a column over the devices having the reading, or NaN."""
+        return self._reduce(np.nanmin, name, filters)
+
+    def max(self, name, **filters):
+        """Max of a column over the devices having the reading, or NaN."""
+        return self._reduce(np.nanmax, name, filters)
+
+    def count(self, name, value=True, **filters):
+        """Number of devices whose column equals value, such as
+        count('battery_ok', False)."""
+        return int(np.count_nonzero(self.column(name, **filters) == value))
+
+    def _reduce(self, func, name, filters):
+        values = self.column(name, **filters)
+        if not np.any(~np.isnan(values)):
+            return np.nan
+        return float(func(values))
+
+    def group_by(self, name, by='area', aggregate='mean', **filters):
+        """Aggregate a column per value of a code column.
+
+        Returns {code: value}, codes being controllers when by is 'hub'.
+        Devices without the reading are left out of each group, groups
+        without any reading are NaN (0 for 'sum' and 'count').
+        """
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate: {}".format(aggregate))
+        if by not in CODE_COLUMNS:
+            raise ValueError("Can't group by: {}".format(by))
+        with self._lock:
+            size = len(self._keys)
+            mask = self._select(filters)
+            values = self._columns[name][:size].astype(float)
+            codes = self._columns[by][:size]
+            if mask is not None:
+                values = values[mask]
+                codes = codes[mask]
+            hubs = list(self._hubs)
+
+        groups, inverse = np.unique(codes, return_inverse=True)
+        present = ~np.isnan(values)
+        counts = np.bincount(inverse, weights=present, minlength=len(groups))
+        if aggregate == 'count':
+            result = counts
+        elif aggregate in ('sum', 'mean'):
+            result = np.bincount(inverse, weights=np.where(present, values, 0),
+                                 minlength=len(groups))
+            if aggregate == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result = result / counts
+        else:
+            result = np.full(len(groups), np.nan)
+            ufunc = np.fmin if aggregate == 'min' else np.fmax
+            ufunc.at(result, inverse, values)
+
+        if by == 'hub':
+            groups = [hubs[code] for code in groups]
+        else:
+            groups = groups.tolist()
+        return dict(zip(groups, result.tolist()))
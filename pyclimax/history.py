@@ -0,0 +1,307 @@
+"""Bounded in-memory history of device readings."""
+import array
+import collections
+import threading
+import time
+
+from . import ClimaxDimmer, ClimaxSwitch
+
+# Raw samples kept per reading
+RAW_CAPACITY = 1024
+# (resolution in seconds, buckets kept) of each downsampled tier: a day of
+# minutes and a week of quarters
+TIERS = ((60, 1440), (900, 672))
+
+# Statistics of the samples in a window
+WindowStats = collections.namedtuple('WindowStats', 'count min max mean')
+
+
+def device_values(device):
+    """Return {reading: value} of the typed readings a device has."""
+    reading = device.reading
+    values = {}
+    if isinstance(device, ClimaxSwitch):
+        values['on'] = float(reading.on)
+        values['power'] = reading.power
+    if isinstance(device, ClimaxDimmer):
+        values['level'] = float(reading.level)
+    if device.has_temperature:
+        values['temperature'] = reading.temperature
+    if device.has_energy:
+        values['energy'] = reading.energy
+    return values
+
+
+class RingBuffer(object):
+    """Fixed size columns of doubles, the oldest row is overwritten.
+
+    Column 0 holds timestamps, which must not decrease. The arrays grow
+    up to capacity as rows are added, so sparse histories stay small.
+    """
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.columns = [array.array('d') for _ in range(columns)]
+        self._start = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def full(self):
+        """True once rows are being overwritten."""
+        return self._count == self.capacity
+
+    def append(self, *row):
+        """Add a row, overwriting the oldest one when full."""
+        if self._count < self.capacity:
+            for column, value in zip(self.columns, row):
+                column.append(value)
+            self._count += 1
+            return
+        position = self._start
+        self._start = (self._start + 1) % self.capacity
+        for column, value in zip(self.columns, row):
+            column[position] = value
+
+    def _position(self, index):
+        return (self._start + index) % self.capacity
+
+    def time(self, index):
+        """Timestamp of the row at index, 0 being the oldest."""
+        return self.columns[0][self._position(index)]
+
+    def bisect(self, since):
+        """Return the index of the first row with a timestamp >= since."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self.time(middle) < since:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def rows(self, start=0):
+        """Yield the rows from index start on, oldest first, without
+        copying the buffer."""
+        columns = self.columns
+        for index in range(start, self._count):
+            position = self._position(index)
+            yield tuple(column[position] for column in columns)
+
+
+class _Bucket(object):
+    """Running statistics of one downsampling period."""
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, count, total, low, high):
+        self.count += count
+        self.total += total
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+
+class ReadingHistory(object):
+    """Class keeping the history of one reading of one device.
+
+    Samples go to a raw ring buffer and are aggregated into downsampled
+    tiers of (time, count, mean, min, max) buckets, each tier being a ring
+    buffer of its own, so memory stays bounded while coarse history
+    reaches back much further than the raw samples.
+    """
+
+    def __init__(self, raw_capacity=RAW_CAPACITY, tiers=TIERS):
+        """Setup an empty history."""
+        self.raw = RingBuffer(raw_capacity, 2)
+        self.resolutions = [resolution for resolution, _ in tiers]
+        self.tiers = [RingBuffer(capacity, 5) for _, capacity in tiers]
+        self._buckets = [None] * len(tiers)
+
+    def add(self, value, now=None):
+        """Record a sample, now defaults to the current time."""
+        if now is None:
+            now = time.time()
+        self.raw.append(now, value)
+        self._aggregate(0, now, 1, value, value, value)
+
+    def _aggregate(self, level, now, count, total, low, high):
+        if level == len(self.tiers):
+            return
+        resolution = self.resolutions[level]
+        start = now - now % resolution
+        bucket = self._buckets[level]
+        if bucket is not None and bucket.start != start:
+            self._close(level, bucket)
+            bucket = None
+        if bucket is None:
+            bucket = self._buckets[level] = _Bucket(start)
+        bucket.add(count, total, low, high)
+
+    def _close(self, level, bucket):
+        """Move a finished bucket into its tier and the next coarser one."""
+        self.tiers[level].append(bucket.start, bucket.count,
+                                 bucket.total / bucket.count, bucket.min,
+                                 bucket.max)
+        self._aggregate(level + 1, bucket.start, bucket.count, bucket.total,
+                        bucket.min, bucket.max)
+
+    def _tier_for(self, since):
+        """Return the level of the finest tier reaching back to since,
+        -1 being the raw samples."""
+        buffers = [self.raw] + self.tiers
+        for level, buffer in enumerate(buffers):
+            if not buffer.full or buffer.time(0) <= since:
+                return level - 1
+        return len(self.tiers) - 1
+
+    def window(self, seconds, now=None):
+        """Return WindowStats of the last seconds, or None if empty.
+
+        Windows longer than the raw samples reach are answered from the
+        finest tier that does, rounded out to its resolution.
+        """
+        if now is None:
+            now = time.time()
+        since = now - seconds
+        level = self._tier_for(since)
+        count = 0
+        total = 0.0
+        low = float('inf')
+        high = float('-inf')
+        if level < 0:
+            for _, value in self.raw.rows(self.raw.bisect(since)):
+                count += 1
+                total += value
+                low = min(low, value)
+                high = max(high, value)
+        else:
+            tier = self.tiers[level]
+            start = tier.bisect(since - self.resolutions[level])
+            for _, n, mean, bucket_min, bucket_max in tier.rows(start):
+                count += int(n)
+                total += mean * n
+                low = min(low, bucket_min)
+                high = max(high, bucket_max)
+            # Samples not yet aggregated into this tier
+            for bucket in self._buckets[:level + 1]:
+                if bucket is not None:
+                    count += bucket.count
+                    total += bucket.total
+                    low = min(low, bucket.min)
+                    high = max(high, bucket.max)
+        if not count:
+            return None
+        return WindowStats(count, low, high, total / count)
+
+    def samples(self, seconds, now=None):
+        """Return [(time, value)] of the last seconds, from the finest tier
+        reaching back that far, bucket means for downsampled tiers."""
+        if now is None:
+            now = time.time()
+        since = now - seconds
+        level = self._tier_for(since)
+        if level < 0:
+            return list(self.raw.rows(self.raw.bisect(since)))
+        tier = self.tiers[level]
+        return [(row[0], row[2]) for row in tier.rows(tier.bisect(since))]
+
+
+class DeviceHistory(object):
+    """Class keeping an opt-in history of the readings of devices.
+
+    Tracked devices get a ReadingHistory per typed reading (on, power,
+    level, temperature, energy), fed from the poll changes of their
+    controller's subscription registry whenever their status changes.
+    """
+
+    def __init__(self, raw_capacity=RAW_CAPACITY, tiers=TIERS):
+        """Setup an empty history."""
+        self.raw_capacity = raw_capacity
+        self.tiers = tiers
+        self._lock = threading.Lock()
+        self._histories = {}
+        self._controllers = collections.Counter()
+
+    def track(self, device):
+        """Start keeping the history of device, from its current reading."""
+        key = (device.climax_controller, device.device_id)
+        with self._lock:
+            if key in self._histories:
+                return
+            self._histories[key] = {
+                name: ReadingHistory(self.raw_capacity, self.tiers)
+                for name in device_values(device)}
+            self._record(device)
+            controller = device.climax_controller
+            self._controllers[controller] += 1
+            first = self._controllers[controller] == 1
+        if first:
+            controller.register_changes(self._event_changes)
+
+    def untrack(self, device):
+        """Stop keeping the history of device and drop it."""
+        controller = device.climax_controller
+        with self._lock:
+            if self._histories.pop((controller, device.device_id),
+                                   None) is None:
+                return
+            self._controllers[controller] -= 1
+            last = not self._controllers[controller]
+            if last:
+                del self._controllers[controller]
+        if last:
+            controller.unregister_changes(self._event_changes)
+
+    def history(self, device, name):
+        """Return the ReadingHistory of a reading, or None."""
+        histories = self._histories.get(
+            (device.climax_controller, device.device_id), {})
+        return histories.get(name)
+
+    def window(self, device, name, seconds):
+        """Return WindowStats of a reading over the last seconds, or None."""
+        history = self.history(device, name)
+        if history is None:
+            return None
+        with self._lock:
+            return history.window(seconds)
+
+    def samples(self, device, name, seconds):
+        """Return [(time, value)] of a reading over the last seconds."""
+        history = self.history(device, name)
+        if history is None:
+            return []
+        with self._lock:
+            return history.samples(seconds)
+
+    def _record(self, device, now=None):
+        histories = self._histories.get(
+            (device.climax_controller, device.device_id))
+        if histories is None:
+            return
+        for name, value in device_values(device).items():
+            history = histories.get(name)
+            if history is not None:
+                history.add(value, now)
+
+    def _event_changes(self, controller, changes):
+        index = controller.device_index
+        now = time.time()
+        with self._lock:
+            for device_id in changes.added:
+                device = index.get(device_id)
+                if device is not None:
+                    self._record(device, now)
+            for device_id, fields in changes.changed.items():
+                if 'status' in fields:
+                    device = index.get(device_id)
+                    if device is not None:
+                        self._record(device, now)
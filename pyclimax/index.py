@@ -0,0 +1,163 @@
+"""Indexes over the last known set of Climax devices."""
+import threading
+import unicodedata
+
+# senrows fields the secondary indexes are built from
+INDEXED_FIELDS = ('name', 'type', 'type_f', 'area', 'zone')
+
+
+def normalize_name(name):
+    """Normalize a device name for lookups.
+
+    Names are NFC normalized, casefolded and have their whitespace
+    collapsed, so 'Kök ' and 'KÖK' (composed or decomposed) match.
+    """
+    if name is None:
+        return None
+    name = unicodedata.normalize('NFC', str(name))
+    return ' '.join(name.casefold().split())
+
+
+class DeviceIndex(object):
+    """Class keeping O(1) lookup tables over devices.
+
+    Devices are indexed by id, normalized name, type, type_f, area and
+    (area, zone). Secondary indexes store device ids, so replacing a device
+    object with a newer one for the same id only touches the id table.
+    """
+
+    def __init__(self):
+        """Setup empty indexes."""
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._keys = {}
+        self._by_name = {}
+        self._by_type = {}
+        self._by_area = {}
+        self._by_zone = {}
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, device_id):
+        return device_id in self._by_id
+
+    @staticmethod
+    def _device_keys(device):
+        state = device.json_state
+        return (normalize_name(device.name), state.get('type'),
+                state.get('type_f'), state.get('area'), state.get('zone'))
+
+    @staticmethod
+    def _add_key(table, key, device_id):
+        table.setdefault(key, {})[device_id] = None
+
+    @staticmethod
+    def _remove_key(table, key, device_id):
+        ids = table.get(key)
+        if ids is None:
+            return
+        ids.pop(device_id, None)
+        if not ids:
+            del table[key]
+
+    def _index(self, device_id, keys, add):
+        name, device_type, type_f, area, zone = keys
+        change = self._add_key if add else self._remove_key
+        change(self._by_name, name, device_id)
+        change(self._by_type, device_type, device_id)
+        if type_f is not None:
+            change(self._by_type, type_f, device_id)
+        change(self._by_area, area, device_id)
+        change(self._by_zone, (area, zone), device_id)
+
+    def add(self, device):
+        """Add or update a single device."""
+        with self._lock:
+            self._add(device)
+
+    def _add(self, device):
+        device_id = device.device_id
+        keys = self._device_keys(device)
+        old_keys = self._keys.get(device_id)
+        self._by_id[device_id] = device
+        if old_keys == keys:
+            return
+        if old_keys is not None:
+            self._index(device_id, old_keys, False)
+        self._index(device_id, keys, True)
+        self._keys[device_id] = keys
+
+    def remove(self, device_id):
+        """Remove a device from all indexes."""
+        with self._lock:
+            self._remove(device_id)
+
+    def _remove(self, device_id):
+        self._by_id.pop(device_id, None)
+        keys = self._keys.pop(device_id, None)
+        if keys is not None:
+            self._index(device_id, keys, False)
+
+    def update(self, devices):
+        """Bring the indexes in line with a complete device list.
+
+        Only devices whose id, name, type or location changed touch the
+        secondary indexes. Returns the ids no longer present.
+        """
+        with self._lock:
+            seen = set()
+            for device in devices:
+                seen.add(device.device_id)
+                self._add(device)
+            removed = [device_id for device_id in self._by_id
+                       if device_id not in seen]
+            for device_id in removed:
+                self._remove(device_id)
+            self.loaded = True
+        return removed
+
+    def apply(self, changed, removed):
+        """Update the indexes incrementally after a poll.
+
+        changed: the devices added, or whose INDEXED_FIELDS changed, since
+        the last update. removed: the devices no longer present. The other
+        devices are left alone, their keys aren't computed again.
+        """
+        with self._lock:
+            for device in removed:
+                if self._by_id.get(device.device_id) is device:
+                    self._remove(device.device_id)
+            for device in changed:
+                self._add(device)
+            self.loaded = True
+
+    def _lookup(self, table, key):
+        with self._lock:
+            ids = table.get(key, ())
+            return [self._by_id[device_id] for device_id in ids]
+
+    def get(self, device_id):
+        """Return the device with the given id or None."""
+        return self._by_id.get(device_id)
+
+    def by_name(self, name):
+        """Return the first device matching the normalized name or None."""
+        devices = self._lookup(self._by_name, normalize_name(name))
+        return devices[0] if devices else None
+
+    def by_type(self, device_type):
+        """Return the devices with the given type or type_f."""
+        return self._lookup(self._by_type, device_type)
+
+    def by_area(self, area, zone=None):
+        """Return the devices in an area, optionally limited to a zone."""
+        if zone is None:
+            return self._lookup(self._by_area, area)
+        return self._lookup(self._by_zone, (area, zone))
+
+    def values(self):
+        """Return all indexed devices."""
+        with self._lock:
+            return list(self._by_id.values())
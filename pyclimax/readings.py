@@ -0,0 +1,70 @@
+"""Parsing of Climax device status strings into typed readings."""
+import re
+
+# Power switch status, such as 'On, 1.3W', 'Off, 0.0W' or 'Off'
+_SWITCH_STATUS = re.compile(
+    r'\s*(On|Off)\b(?:\s*,\s*([-+]?\d+(?:\.\d*)?)\s*W)?')
+# Dimmer status, such as 'On (84%)' or 'Off'
+_DIMMER_STATUS = re.compile(r'\s*(On|Off)\b(?:\s*\(\s*(\d+)\s*%\s*\))?')
+# Sensor status, such as '21.25 °C', '21.25 C' or '29945.742kWh'
+_SENSOR_STATUS = re.compile(r'\s*([-+]?\d+(?:\.\d*)?)\s*(°?\s*C|kWh)')
+
+
+class Reading(object):
+    """Typed values of a device status string.
+
+    Values the status doesn't contain keep their defaults: off, 0.0 W,
+    0 %, 0.0 °C and 0.0 kWh.
+    """
+
+    __slots__ = ('status', 'on', 'power', 'level', 'temperature', 'energy')
+
+    def __init__(self, status=None, on=False, power=0.0, level=0,
+                 temperature=0.0, energy=0.0):
+        self.status = status
+        self.on = on
+        self.power = power
+        self.level = level
+        self.temperature = temperature
+        self.energy = energy
+
+    def __repr__(self):
+        return ("Reading(status={!r}, on={}, power={}, level={}, "
+                "temperature={}, energy={})").format(
+                    self.status, self.on, self.power, self.level,
+                    self.temperature, self.energy)
+
+
+def parse_status(status):
+    """Parse a status string of a device without readings."""
+    return Reading(status)
+
+
+def parse_switch(status):
+    """Parse a power switch status such as 'On, 1.3W'."""
+    match = _SWITCH_STATUS.match(status) if status else None
+    if match is None:
+        return Reading(status)
+    on, power = match.groups()
+    return Reading(status, on=on == 'On',
+                   power=float(power) if power else 0.0)
+
+
+def parse_dimmer(status):
+    """Parse a dimmer status such as 'On (84%)'."""
+    match = _DIMMER_STATUS.match(status) if status else None
+    if match is None:
+        return Reading(status)
+    on, level = match.groups()
+    return Reading(status, on=on == 'On', level=int(level) if level else 0)
+
+
+def parse_sensor(status):
+    """Parse a sensor status such as '21.25 °C' or '29945.742kWh'."""
+    match = _SENSOR_STATUS.match(status) if status else None
+    if match is None:
+        return Reading(status)
+    value, unit = match.groups()
+    if unit == 'kWh':
+        return Reading(status, energy=float(value))
+    return Reading(status, temperature=float(value))
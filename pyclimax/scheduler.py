@@ -0,0 +1,108 @@
+"""Scheduling of Climax subscription polls."""
+import random
+import time
+
+from .subscribe import SUBSCRIPTION_RETRY
+
+# Time in seconds between polls while the house is active
+ACTIVE_INTERVAL = 0.2
+# Shortest time in seconds between polls of a hub answering at once, unless
+# the last poll found activity
+MIN_INTERVAL = 1
+# Time in seconds between polls once the house has been idle for a while
+IDLE_INTERVAL = 2
+# Seconds after a change or local command during which polling stays fast,
+# changes of noisy fields such as rssi don't count
+ACTIVE_PERIOD = 30
+# Factor the interval grows by for each quiet poll after the active period
+IDLE_BACKOFF = 1.5
+# Longest time in seconds between retries of a failing hub
+RETRY_MAX = 60
+# Fraction of the retry delay that is randomized
+RETRY_JITTER = 0.5
+# Time in seconds between long polls, the hub does the waiting
+LONG_POLL_INTERVAL = 0
+
+
+class PollScheduler(object):
+    """Class deciding how long the poll loop waits before the next poll.
+
+    Polls fast right after a local command or a detected change, slows
+    down gradually to idle_interval while nothing happens, and backs off
+    exponentially with jitter while the hub fails. A hub answering polls
+    at once, rather than holding them, is polled at most every
+    min_interval unless the last poll found activity. Long polls, which
+    block on the hub until something changes, follow each other after
+    long_poll_interval. Subclass and override next_delay to plug in a
+    different policy.
+    """
+
+    def __init__(self, active_interval=ACTIVE_INTERVAL,
+                 idle_interval=IDLE_INTERVAL, active_period=ACTIVE_PERIOD,
+                 idle_backoff=IDLE_BACKOFF, min_interval=MIN_INTERVAL,
+                 retry_base=SUBSCRIPTION_RETRY,
+                 retry_max=RETRY_MAX, retry_jitter=RETRY_JITTER,
+                 long_poll_interval=LONG_POLL_INTERVAL):
+        """Setup a scheduler, all times are in seconds."""
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.active_period = active_period
+        self.idle_backoff = idle_backoff
+        self.min_interval = min_interval
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.retry_jitter = retry_jitter
+        self.long_poll_interval = long_poll_interval
+        self.long_polling = False
+        self.held = False
+        self.changed = False
+        self.failures = 0
+        self.interval = active_interval
+        self._last_activity = time.monotonic()
+
+    def activity(self):
+        """Note a change or local command, polling speeds up."""
+        self._last_activity = time.monotonic()
+        self.interval = self.active_interval
+
+    def command_sent(self):
+        """Note a local command was sent to the hub."""
+        self.activity()
+
+    def poll_succeeded(self, changed, long_polling=False, held=False):
+        """Note a successful poll, changed if it found any changes making
+        the house active, see ChangeSet.activity.
+
+        long_polling: the next poll blocks on the hub until a change.
+        held: the hub held the poll for its timeout or minimumdelay.
+        """
+        self.failures = 0
+        self.long_polling = long_polling
+        self.held = held
+        self.changed = bool(changed)
+        if changed:
+            self.activity()
+        elif time.monotonic() - self._last_activity > self.active_period:
+            self.interval = min(self.interval * self.idle_backoff,
+                                self.idle_interval)
+
+    def poll_failed(self):
+        """Note a failed poll."""
+        self.failures += 1
+
+    @property
+    def idle(self):
+        """True if polling has slowed down to the idle interval."""
+        return self.interval >= self.idle_interval
+
+    def next_delay(self):
+        """Return the seconds to wait before the next poll."""
+        if not self.failures:
+            if self.long_polling:
+                return self.long_poll_interval
+            if self.held or self.changed:
+                return self.interval
+            return max(self.interval, self.min_interval)
+        delay = min(self.retry_base * 2 ** (self.failures - 1),
+                    self.retry_max)
+        return delay * (1 - self.retry_jitter * random.random())
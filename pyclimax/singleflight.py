@@ -0,0 +1,52 @@
+"""Coalescing of concurrent identical requests."""
+import threading
+
+
+class _Call(object):
+    """A call in flight and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Class running at most one call per key at a time.
+
+    Threads calling do() with a key that is already in flight wait for that
+    call and share its result or exception, instead of starting their own.
+    """
+
+    def __init__(self):
+        """Setup with no calls in flight."""
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the call for key in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,83 @@
+"""Warm-start snapshots of the device list and welcome data of hubs."""
+import json
+import logging
+import os
+import time
+
+# Format of the snapshot files, others are ignored
+SNAPSHOT_VERSION = 1
+# File mapping base URLs to the MACs of their hubs
+_HUBS = 'hubs.json'
+
+# Get the logger for use in this module
+logger = logging.getLogger(__name__)
+
+
+def _write_json(path, data):
+    """Write data compactly, replacing path atomically."""
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as json_file:
+        json.dump(data, json_file, separators=(',', ':'))
+    os.replace(temporary, path)
+
+
+def _read_json(path):
+    """Return the data in path, or None if missing or unreadable."""
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError) as ex:
+        if os.path.exists(path):
+            logger.warning("Ignoring unreadable snapshot %s: %s", path,
+                           str(ex))
+        return None
+
+
+class SnapshotStore(object):
+    """Class keeping the last device list and welcome data of hubs.
+
+    There is one file per hub, keyed by its MAC, in directory path. As a
+    controller only learns the MAC of its hub from welcomeGet, an index
+    maps base URLs to MACs, so a snapshot can be found before asking the
+    hub anything.
+    """
+
+    def __init__(self, path):
+        """Setup a store in directory path, created on first save."""
+        self.path = path
+
+    def _file(self, mac):
+        return os.path.join(self.path, mac.replace(':', '-') + '.json')
+
+    def load(self, base_url):
+        """Return the snapshot of the hub at base_url, or None.
+
+        A snapshot is a dict with 'mac', 'saved_at' (wall clock time of
+        the device list), 'welcome' (welcomeGet updates) and 'devices' (a
+        deviceListGet result).
+        """
+        mac = (_read_json(os.path.join(self.path, _HUBS)) or {}).get(base_url)
+        if mac is None:
+            return None
+        snapshot = _read_json(self._file(mac))
+        if (not isinstance(snapshot, dict)
+                or snapshot.get('version') != SNAPSHOT_VERSION
+                or snapshot.get('mac') != mac):
+            return None
+        return snapshot
+
+    def save(self, base_url, mac, welcome, devices, saved_at=None):
+        """Store the snapshot of the hub at base_url."""
+        os.makedirs(self.path, exist_ok=True)
+        _write_json(self._file(mac), {
+            'version': SNAPSHOT_VERSION,
+            'mac': mac,
+            'saved_at': time.time() if saved_at is None else saved_at,
+            'welcome': welcome,
+            'devices': devices,
+        })
+        hubs_path = os.path.join(self.path, _HUBS)
+        hubs = _read_json(hubs_path) or {}
+        if hubs.get(base_url) != mac:
+            hubs[base_url] = mac
+            _write_json(hubs_path, hubs)
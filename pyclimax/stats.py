@@ -0,0 +1,202 @@
+"""Counters and latency histograms of controllers and subscriptions."""
+import bisect
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+# Known metrics: name -> (type, label name, help)
+METRICS = {
+    'request_seconds': ('histogram', 'method',
+                        'Latency of requests to the hub'),
+    'received_bytes': ('counter', 'method',
+                       'Bytes of response bodies received from the hub'),
+    'errors': ('counter', 'kind',
+               'Request and response errors by exception type'),
+    'poll_seconds': ('histogram', 'phase',
+                     'Time spent in each phase of a poll'),
+    'poll_errors': ('counter', 'kind', 'Failed polls by exception type'),
+    'callback_seconds': ('histogram', 'device',
+                         'Duration of the callbacks of a device'),
+    'callback_errors': ('counter', 'device',
+                        'Callbacks of a device raising an exception'),
+    'stalls': ('counter', 'hub',
+               'Polls still running after their timeout'),
+}
+
+
+class Histogram(object):
+    """Counts of observed values per bucket, with their sum and max."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # One more for the values above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate quantile q (0-1), interpolating within its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = (self.bounds[index] if index < len(self.bounds)
+                         else self.max)
+                return min(lower + (upper - lower) * (rank - seen) / count,
+                           self.max)
+            seen += count
+        return self.max
+
+    def snapshot(self):
+        """Return a dict of the count, sum, max and p50/p95/p99."""
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Stats(object):
+    """Class keeping labelled counters and histograms, see METRICS.
+
+    Recording takes a lock and a few additions, set enabled to False to
+    skip it.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def count(self, name, label, value=1):
+        """Add value to counter name of label."""
+        if not self.enabled:
+            return
+        key = (name, label)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, label, value):
+        """Add value, eg seconds, to histogram name of label."""
+        if not self.enabled:
+            return
+        key = (name, label)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def counter(self, name, label):
+        """Return the value of a counter, 0 if never counted."""
+        return self._counters.get((name, label), 0)
+
+    def histogram(self, name, label):
+        """Return a Histogram, or None if nothing was observed."""
+        return self._histograms.get((name, label))
+
+    def reset(self):
+        """Forget all counts and observations."""
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def snapshot(self):
+        """Return {name: {label: value}}, histograms as dicts of their
+        count, sum, max and quantiles."""
+        result = {}
+        with self._lock:
+            for (name, label), value in self._counters.items():
+                result.setdefault(name, {})[label] = value
+            for (name, label), histogram in self._histograms.items():
+                result.setdefault(name, {})[label] = histogram.snapshot()
+        return result
+
+    def items(self):
+        """Return sorted ((name, label), counter or Histogram) pairs."""
+        with self._lock:
+            items = list(self._counters.items())
+            items.extend((key, _copy(histogram))
+                         for key, histogram in self._histograms.items())
+        return sorted(items, key=lambda item: (item[0][0], str(item[0][1])))
+
+
+def _copy(histogram):
+    copy = Histogram(histogram.bounds)
+    copy.counts = list(histogram.counts)
+    copy.count = histogram.count
+    copy.sum = histogram.sum
+    copy.max = histogram.max
+    return copy
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value))
+                          for name, value in labels) + '}'
+
+
+def prometheus_text(sources, prefix='pyclimax'):
+    """Return the Prometheus text exposition of several Stats.
+
+    sources: (Stats, {label: value}) pairs, the labels, eg the hub, are
+    added to all the samples of the Stats.
+    """
+    families = {}
+    for stats, constant in sources:
+        constant = sorted((constant or {}).items())
+        for (name, label), value in stats.items():
+            kind, label_name, _ = METRICS.get(
+                name, ('counter', 'label', ''))
+            labels = list(constant)
+            if label is not None:
+                labels.append((label_name, label))
+            families.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(families):
+        kind, _, help_text = METRICS.get(name, ('counter', 'label', name))
+        family = '{}_{}'.format(prefix, name)
+        if kind == 'counter':
+            family += '_total'
+        lines.append('# HELP {} {}'.format(family, help_text))
+        lines.append('# TYPE {} {}'.format(family, kind))
+        for labels, value in families[name]:
+            if kind == 'counter':
+                lines.append('{}{} {}'.format(family, _labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(value.bounds + ('+Inf',), value.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    family, _labels(labels + [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {!r}'.format(family, _labels(labels),
+                                                value.sum))
+            lines.append('{}_count{} {}'.format(family, _labels(labels),
+                                                value.count))
+    return '\n'.join(lines) + '\n'
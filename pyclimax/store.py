@@ -0,0 +1,437 @@
+"""Durable columnar time-series store of device readings.
+
+Requires NumPy, install with the 'store' extra.
+
+Layout: one directory per UTC day, holding one append-only file of raw
+little-endian values per column and the number of rows committed by the
+last write, plus devices.json mapping device keys to the codes in the
+device column:
+
+    root/devices.json
+    root/2024-05-01/rows
+    root/2024-05-01/time.f8
+    root/2024-05-01/device.i4
+    root/2024-05-01/power.f8
+    ...
+
+A write appends to the columns, then replaces rows. Values past the
+committed rows, left by a write interrupted by a crash, are ignored by
+readers and truncated by the next write.
+"""
+import collections
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from .history import device_values
+
+# Readings stored per sample, NaN where a device has no such reading
+FIELDS = ('on', 'power', 'level', 'temperature', 'energy')
+# Samples buffered for the writer thread, the oldest are dropped beyond
+MAX_PENDING = 10000
+# Longest time in seconds samples wait in the buffer
+FLUSH_INTERVAL = 1.0
+# Default age in days of segments compacted by compact()
+COMPACT_AFTER = 7
+# Default resolution in seconds of compacted segments
+COMPACT_RESOLUTION = 900
+
+_TIME = ('time', np.dtype('<f8'))
+_DEVICE = ('device', np.dtype('<i4'))
+_COLUMNS = (_TIME, _DEVICE) + tuple((field, np.dtype('<f8'))
+                                    for field in FIELDS)
+_META = 'meta.json'
+_ROWS = 'rows'
+_DEVICES = 'devices.json'
+
+# Get the logger for use in this module
+logger = logging.getLogger(__name__)
+
+
+def day_of(timestamp):
+    """Return the segment name of a timestamp, its UTC date."""
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def _column_path(directory, name, dtype):
+    """Return the file of a column, eg time.f8."""
+    return os.path.join(directory, '{}.{}'.format(name, dtype.str[1:]))
+
+
+def _segment_rows(path):
+    """Return the committed rows of a segment, fewer if a column is short,
+    eg after losing power before the columns reached the disk."""
+    try:
+        with open(os.path.join(path, _ROWS)) as rows_file:
+            rows = int(rows_file.read())
+    except (OSError, ValueError):
+        return 0
+    for name, dtype in _COLUMNS:
+        column = _column_path(path, name, dtype)
+        size = (os.path.getsize(column) // dtype.itemsize
+                if os.path.exists(column) else 0)
+        rows = min(rows, size)
+    return rows
+
+
+def _commit_rows(path, rows):
+    """Atomically record the number of rows written to a segment."""
+    temporary = os.path.join(path, _ROWS + '.tmp')
+    with open(temporary, 'w') as rows_file:
+        rows_file.write(str(rows))
+    os.replace(temporary, os.path.join(path, _ROWS))
+
+
+def device_key(device):
+    """Return the key of a device in the store, stable across restarts.
+
+    The hub is keyed by its base_url, known from the start, unlike its MAC
+    which is only learned from the hub.
+    """
+    return '{}/{}'.format(device.climax_controller.base_url, device.device_id)
+
+
+class Segment(object):
+    """Read-only memory-mapped view of the columns of one day.
+
+    Columns are numpy arrays backed by the files, so slicing them copies
+    nothing. Rows appended after the segment was opened aren't seen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.resolution = None
+        meta = os.path.join(path, _META)
+        if os.path.exists(meta):
+            with open(meta) as meta_file:
+                self.resolution = json.load(meta_file).get('resolution')
+        self.rows = _segment_rows(path)
+        self.columns = {}
+        for name, dtype in _COLUMNS:
+            if self.rows:
+                self.columns[name] = np.memmap(
+                    _column_path(path, name, dtype), dtype=dtype,
+                    mode='r', shape=(self.rows,))
+            else:
+                self.columns[name] = np.empty(0, dtype=dtype)
+
+    def __len__(self):
+        return self.rows
+
+    def range(self, start=None, end=None):
+        """Return the (first, last) rows with start <= time < end."""
+        times = self.columns['time']
+        first = 0 if start is None else int(np.searchsorted(times, start))
+        last = (self.rows if end is None
+                else int(np.searchsorted(times, end)))
+        return first, last
+
+
+class TimeSeriesStore(object):
+    """Class persisting the readings of devices to day segments.
+
+    Attached controllers feed samples from each poll's ChangeSet into a
+    bounded in-memory buffer; a writer thread appends them to disk in
+    batches, so polling never waits for the disk. When the buffer is full
+    the oldest samples are dropped and counted in dropped.
+    """
+
+    def __init__(self, path, max_pending=MAX_PENDING,
+                 flush_interval=FLUSH_INTERVAL):
+        """Setup a store in directory path, created if needed."""
+        self.path = path
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        self._pending = collections.deque(maxlen=max_pending)
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._exiting = False
+        self._devices = {}
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        devices = os.path.join(path, _DEVICES)
+        if os.path.exists(devices):
+            with open(devices) as devices_file:
+                self._devices = json.load(devices_file)
+        self._keys = {code: key for key, code in self._devices.items()}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def attach(self, controller):
+        """Store the readings of controller's devices from its polls."""
+        controller.register_changes(self._event_changes)
+        for device in controller.devices:
+            self.add(device)
+
+    def detach(self, controller):
+        """Stop storing the readings of controller's devices."""
+        controller.unregister_changes(self._event_changes)
+
+    def _event_changes(self, controller, changes):
+        index = controller.device_index
+        for device_id in changes.added:
+            device = index.get(device_id)
+            if device is not None:
+                self.add(device)
+        for device_id, fields in changes.changed.items():
+            if 'status' in fields:
+                device = index.get(device_id)
+                if device is not None:
+                    self.add(device)
+
+    def add(self, device, now=None):
+        """Queue a sample of the current readings of device.
+
+        now defaults to the current time, taken in queue order so samples
+        are written with increasing timestamps.
+        """
+        values = device_values(device)
+        if not values:
+            return
+        row = tuple(values.get(field, np.nan) for field in FIELDS)
+        with self._condition:
+            if now is None:
+                now = time.time()
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped += 1
+            self._pending.append((now, device_key(device), row))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='Climax Store Writer',
+                    daemon=True)
+                self._thread.start()
+            elif len(self._pending) * 2 >= self._pending.maxlen:
+                self._condition.notify()
+
+    def flush(self):
+        """Write all queued samples now."""
+        with self._write_lock:
+            with self._condition:
+                batch = list(self._pending)
+                self._pending.clear()
+            self._write(batch)
+
+    def close(self):
+        """Write queued samples and stop the writer thread."""
+        with self._condition:
+            self._exiting = True
+            self._condition.notify()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self._exiting = False
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._exiting:
+                    self._condition.wait(self.flush_interval)
+                exiting = self._exiting
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not write samples to %s", self.path)
+            if exiting:
+                return
+
+    def _code(self, key):
+        code = self._devices.get(key)
+        if code is None:
+            code = self._devices[key] = len(self._devices)
+            self._keys[code] = key
+            temporary = os.path.join(self.path, _DEVICES + '.tmp')
+            with open(temporary, 'w') as devices_file:
+                json.dump(self._devices, devices_file)
+            os.replace(temporary, os.path.join(self.path, _DEVICES))
+        return code
+
+    def _write(self, batch):
+        """Append a batch of samples to the segments of their days."""
+        if not batch:
+            return
+        days = collections.OrderedDict()
+        for now, key, row in batch:
+            days.setdefault(day_of(now), []).append(
+                (now, self._code(key)) + row)
+        for day, rows in days.items():
+            directory = os.path.join(self.path, day)
+            os.makedirs(directory, exist_ok=True)
+            committed = _segment_rows(directory)
+            columns = list(zip(*rows))
+            for (name, dtype), values in zip(_COLUMNS, columns):
+                with open(_column_path(directory, name, dtype),
+                          'ab') as column_file:
+                    # Drop what an interrupted write left past the commit
+                    column_file.truncate(committed * dtype.itemsize)
+                    column_file.write(
+                        np.asarray(values, dtype=dtype).tobytes())
+            _commit_rows(directory, committed + len(rows))
+        self.written += len(batch)
+        self.batches += 1
+
+    def segments(self, start=None, end=None):
+        """Return the Segments overlapping start <= time < end, by day."""
+        days = sorted(name for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name))
+                      and not name.endswith(('.tmp', '.old')))
+        first = day_of(start) if start is not None else None
+        last = day_of(end) if end is not None else None
+        return [Segment(os.path.join(self.path, day)) for day in days
+                if (first is None or day >= first)
+                and (last is None or day <= last)]
+
+    def query(self, field, start=None, end=None, device=None):
+        """Return (times, values) arrays of a field for start <= time < end.
+
+        device: only samples of this device, a ClimaxDevice or device key.
+        Without device, ranges within a single day are views into the
+        memory-mapped segment.
+        """
+        code = self._device_code(device)
+        times = []
+        values = []
+        for segment in self.segments(start, end):
+            first, last = segment.range(start, end)
+            segment_times = segment.columns['time'][first:last]
+            segment_values = segment.columns[field][first:last]
+            if code is not None:
+                mask = segment.columns['device'][first:last] == code
+                segment_times = segment_times[mask]
+                segment_values = segment_values[mask]
+            times.append(segment_times)
+            values.append(segment_values)
+        if not times:
+            return np.empty(0), np.empty(0)
+        if len(times) == 1:
+            return times[0], values[0]
+        return np.concatenate(times), np.concatenate(values)
+
+    def aggregate(self, field, start=None, end=None, device=None,
+                  aggregate='mean'):
+        """Return the sum, mean, min, max or count of a field's samples,
+        NaN if there are none."""
+        _, values = self.query(field, start, end, device)
+        present = values[~np.isnan(values)]
+        if aggregate == 'count':
+            return int(len(present))
+        if not len(present):
+            return np.nan
+        return float({'sum': np.sum, 'mean': np.mean, 'min': np.min,
+                      'max': np.max}[aggregate](present))
+
+    def group_by_device(self, field, start=None, end=None,
+                        aggregate='mean'):
+        """Return {device key: aggregate} of a field's samples."""
+        if aggregate not in ('sum', 'mean', 'min', 'max', 'count'):
+            raise ValueError("Unknown aggregate: {}".format(aggregate))
+        codes = []
+        values = []
+        for segment in self.segments(start, end):
+            first, last = segment.range(start, end)
+            codes.append(segment.columns['device'][first:last])
+            values.append(segment.columns[field][first:last])
+        if not codes:
+            return {}
+        codes = np.concatenate(codes)
+        values = np.concatenate(values)
+        present = ~np.isnan(values)
+        codes = codes[present]
+        values = values[present]
+        groups, inverse = np.unique(codes, return_inverse=True)
+        if aggregate in ('sum', 'mean', 'count'):
+            counts = np.bincount(inverse, minlength=len(groups))
+            if aggregate == 'count':
+                result = counts
+            else:
+                result = np.bincount(inverse, weights=values,
+                                     minlength=len(groups))
+                if aggregate == 'mean':
+                    result = result / counts
+        else:
+            result = np.full(len(groups), np.nan)
+            ufunc = np.fmin if aggregate == 'min' else np.fmax
+            ufunc.at(result, inverse, values)
+        return {self._keys.get(int(code), code): value
+                for code, value in zip(groups.tolist(), result.tolist())}
+
+    def _device_code(self, device):
+        if device is None:
+            return None
+        key = device if isinstance(device, str) else device_key(device)
+        code = self._devices.get(key)
+        # An unknown device matches no samples
+        return -1 if code is None else code
+
+    def compact(self, older_than=COMPACT_AFTER,
+                resolution=COMPACT_RESOLUTION, now=None):
+        """Downsample day segments older than older_than days.
+
+        Each device's samples are replaced by their per-field mean over
+        resolution second buckets. Segments already compacted are left
+        alone, today's segment is never compacted. Returns the names of
+        the compacted segments.
+        """
+        if now is None:
+            now = time.time()
+        cutoff = day_of(now - older_than * 86400)
+        compacted = []
+        for segment in self.segments():
+            if (segment.name >= cutoff or segment.name >= day_of(now)
+                    or segment.resolution is not None):
+                continue
+            with self._write_lock:
+                self._compact(segment, resolution)
+            compacted.append(segment.name)
+        return compacted
+
+    def _compact(self, segment, resolution):
+        columns = segment.columns
+        times = np.asarray(columns['time'])
+        devices = np.asarray(columns['device'])
+        buckets = (times // resolution).astype(np.int64)
+        # Order by bucket, then device, one output row per pair
+        keys = np.stack([devices.astype(np.int64), buckets])
+        (unique, inverse) = np.unique(keys, axis=1, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        size = unique.shape[1]
+        out = {'time': unique[1] * float(resolution),
+               'device': unique[0].astype(np.int32)}
+        for field in FIELDS:
+            values = np.asarray(columns[field])
+            present = ~np.isnan(values)
+            total = np.bincount(inverse, weights=np.where(present, values, 0),
+                                minlength=size)
+            count = np.bincount(inverse, weights=present, minlength=size)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[field] = total / count
+        order = np.lexsort((out['device'], out['time']))
+
+        temporary = segment.path + '.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        for name, dtype in _COLUMNS:
+            with open(_column_path(temporary, name, dtype),
+                      'wb') as column_file:
+                column_file.write(
+                    out[name][order].astype(dtype).tobytes())
+        with open(os.path.join(temporary, _META), 'w') as meta_file:
+            json.dump({'resolution': resolution}, meta_file)
+        _commit_rows(temporary, size)
+        # Open memory maps of the old files stay valid after the swap
+        old = segment.path + '.old'
+        os.rename(segment.path, old)
+        os.rename(temporary, segment.path)
+        shutil.rmtree(old)
@@ -2,12 +2,21 @@
 import collections
 import json
 import logging
-import time
 import threading
-import requests
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .dispatch import CALLBACK_WORKERS, CallbackDispatcher, OVERFLOW_COALESCE
+from .stats import prometheus_text, Stats
 
-# How long to wait before retrying Climax
+# How long to wait before retrying Climax, doubled for each failed poll
 SUBSCRIPTION_RETRY = 3
+# Max number of hubs polled at the same time by a SubscriptionRegistry
+POLL_WORKERS = 32
+# Seconds between checks of the watchdog for stalled polls
+WATCHDOG_INTERVAL = 5
+# Seconds a poll may run past its read timeout before it counts as stalled
+STALL_GRACE = 5
 
 # Get the logger for use in this module
 logger = logging.getLogger(__name__)
@@ -15,21 +24,170 @@ logger = logging.getLogger(__name__)
 class PyclimaxError(Exception):
     pass
 
+
+def merge_changes(old, new):
+    """Merge two {field: (old value, new value)} dicts of the same device.
+
+    Fields keep their oldest old value and newest new value, fields that
+    changed back to where they started are left out.
+    """
+    merged = dict(old)
+    for field, (old_value, new_value) in new.items():
+        if field in merged:
+            old_value = merged[field][0]
+        if old_value == new_value:
+            merged.pop(field, None)
+        else:
+            merged[field] = (old_value, new_value)
+    return merged
+
+
+class Subscription(object):
+    """A registered callback and the changes it is interested in.
+
+    Without fields or predicate the callback is called as callback(device)
+    for every update. Otherwise it is called as callback(device, changes),
+    changes being {field: (old value, new value)}, for updates changing
+    one of fields and for which predicate(device, changes) is true.
+    """
+
+    def __init__(self, callback, fields=None, predicate=None):
+        self.callback = callback
+        self.fields = frozenset(fields) if fields is not None else None
+        self.predicate = predicate
+
+    @property
+    def filtered(self):
+        """True if the callback only gets some updates, with the changes."""
+        return self.fields is not None or self.predicate is not None
+
+    def match(self, device, changes):
+        """Return the changes to deliver, or None to skip the update."""
+        if self.fields is not None:
+            changes = {field: change for field, change in changes.items()
+                       if field in self.fields}
+            if not changes:
+                return None
+        if self.predicate is not None and not self.predicate(device, changes):
+            return None
+        return changes
+
+
 class SubscriptionRegistry(object):
-    """Class for subscribing to wemo events."""
+    """Class for subscribing to Climax events from one or more hubs.
+
+    A single dispatcher thread schedules the polls of all hubs, and the
+    polls run concurrently on a shared worker pool with at most one poll
+    per hub in flight, so a slow hub doesn't delay the events of others.
+    Callbacks run on a separate CallbackDispatcher pool, in order per device
+    and concurrently across devices, so a slow callback doesn't delay polls.
+    A watchdog thread logs polls, and a dispatcher thread, that stop making
+    progress.
+    """
 
-    def __init__(self):
-        """Setup subscription."""
+    def __init__(self, controller=None, max_workers=POLL_WORKERS,
+                 callback_workers=CALLBACK_WORKERS,
+                 overflow=OVERFLOW_COALESCE):
+        """Setup subscription.
+
+        controller: the ClimaxController, or a list of them, to poll.
+        Defaults to the global controller from init_controller.
+        max_workers: max number of hubs polled at the same time.
+        callback_workers: threads running callbacks, in order per device.
+        0 runs callbacks on the poll thread.
+        overflow: what to keep when a device's updates arrive faster than
+        its callbacks drain, see CallbackDispatcher.
+        """
+        self.max_workers = max_workers
+        self.dispatcher = None
+        if callback_workers:
+            self.dispatcher = CallbackDispatcher(callback_workers, overflow)
+        self._controllers = []
+        self._due = {}
+        self._polling = set()
+        self._lock = threading.Lock()
         self._devices = collections.defaultdict(list)
         self._callbacks = collections.defaultdict(list)
+        self._pending_changes = {}
+        self._topology_callbacks = []
+        self._changes_callbacks = []
         self._exiting = False
         self._poll_thread = None
+        self._executor = None
+        self._wakeup = threading.Event()
+        self.metrics = Stats()
+        self._poll_started = {}
+        self._stalled = set()
+        self._heartbeat = time.monotonic()
+        self._thread_stalled = False
+        self._watchdog = None
+        self._watchdog_stop = threading.Event()
+
+        if isinstance(controller, (list, tuple)):
+            for hub in controller:
+                self.add_controller(hub)
+        elif controller is not None:
+            self.add_controller(controller)
+
+    @property
+    def controllers(self):
+        """The controllers polled by this registry."""
+        return list(self._controllers)
 
-    def register(self, device, callback):
+    def add_controller(self, controller):
+        """Poll a controller from this registry.
+
+        The controller's subscription_registry becomes this registry, and
+        callbacks registered with its previous registry are moved over.
+        """
+        previous = getattr(controller, 'subscription_registry', None)
+        with self._lock:
+            if controller not in self._controllers:
+                self._controllers.append(controller)
+                self._due[controller] = time.monotonic()
+        controller.subscription_registry = self
+        if previous is not None and previous is not self:
+            previous._move_to(controller, self)
+        self._wakeup.set()
+
+    def remove_controller(self, controller):
+        """Stop polling a controller."""
+        with self._lock:
+            if controller in self._controllers:
+                self._controllers.remove(controller)
+            self._due.pop(controller, None)
+
+    def _move_to(self, controller, registry):
+        """Hand the controller and its subscriptions over to registry."""
+        self.remove_controller(controller)
+        for key in [key for key in self._devices if key[0] is controller]:
+            for device in self._devices.pop(key):
+                for subscription in self._callbacks.pop(device, ()):
+                    registry.register(device, subscription.callback,
+                                      subscription.fields,
+                                      subscription.predicate)
+        if not self._controllers:
+            for callback in self._topology_callbacks:
+                if callback not in registry._topology_callbacks:
+                    registry.register_topology(callback)
+            for callback in self._changes_callbacks:
+                if callback not in registry._changes_callbacks:
+                    registry.register_changes(callback)
+
+    @staticmethod
+    def _key(device):
+        return (device.climax_controller, device.climax_device_id)
+
+    def register(self, device, callback, fields=None, predicate=None):
         """Register a callback.
 
         device: device to be updated by subscription
         callback: callback for notification of changes
+        fields: only notify of changes to these json_state fields, such as
+        {'status'}
+        predicate: only notify if predicate(device, changes) is true
+        With fields or predicate, callback is called as
+        callback(device, changes), see Subscription.
         """
 
         if not device:
@@ -37,8 +195,11 @@ class SubscriptionRegistry(object):
             return
 
         logger.debug("Subscribing to events for %s", device.name)
-        self._devices[device.climax_device_id].append(device)
-        self._callbacks[device].append(callback)
+        devices = self._devices[self._key(device)]
+        if device not in devices:
+            devices.append(device)
+        self._callbacks[device].append(
+            Subscription(callback, fields, predicate))
 
     def unregister(self, device, callback):
         """Remove a registered a callback.
@@ -51,19 +212,102 @@ class SubscriptionRegistry(object):
             return
 
         logger.debug("Removing subscription for {}".format(device.name))
-        self._callbacks[device].remove(callback)
-        self._devices[device.climax_device_id].remove(device)
+        subscriptions = self._callbacks[device]
+        for subscription in subscriptions:
+            if subscription.callback == callback:
+                subscriptions.remove(subscription)
+                break
+        else:
+            raise ValueError("Callback is not registered for {}".format(
+                device.name))
+        if not subscriptions:
+            del self._callbacks[device]
+            self._devices[self._key(device)].remove(device)
+
+    def register_topology(self, callback):
+        """Register a callback for devices added to or removed from a hub.
+
+        callback: called as callback(event, device), event being 'added'
+        or 'removed'
+        """
+        self._topology_callbacks.append(callback)
 
-    def _event(self, device_data_list):
+    def unregister_topology(self, callback):
+        """Remove a callback added with register_topology."""
+        self._topology_callbacks.remove(callback)
+
+    def register_changes(self, callback):
+        """Register a callback for the changes found by each poll.
+
+        callback: called as callback(controller, changes) with the poll's
+        ChangeSet, on the poll thread before the device callbacks, so it
+        should be quick
+        """
+        self._changes_callbacks.append(callback)
+
+    def unregister_changes(self, callback):
+        """Remove a callback added with register_changes."""
+        self._changes_callbacks.remove(callback)
+
+    def _event_changes(self, controller, changes):
+        for callback in list(self._changes_callbacks):
+            try:
+                callback(controller, changes)
+            except:
+                logger.exception("Unhandled exception in changes callback "
+                                 "for %s", controller.base_url)
+
+    def _event_topology(self, event, device):
+        logger.debug("Topology event: %s %s", event, device.name)
+        for callback in list(self._topology_callbacks):
+            try:
+                callback(event, device)
+            except:
+                logger.exception(
+                    "Unhandled exception in topology callback for device "
+                    "#%s (%s)", str(device.device_id), device.name)
+
+    @staticmethod
+    def _device_changes(device_data, changes):
+        """Return {field: (old, new)} for device_data in a poll's ChangeSet.
+
+        Devices without a diff, because they were added or changes is None,
+        have all their compared fields changed from None.
+        """
+        if changes is not None:
+            device_changes = changes.changed.get(device_data.device_id)
+            if device_changes is not None:
+                return device_changes
+        state = device_data.json_state
+        fields = device_data.climax_controller.change_detector.fields
+        return {field: (None, state.get(field)) for field in fields
+                if field in state}
+
+    def _match(self, device, changes):
+        """Return {subscription: changes} of the interested subscriptions."""
+        matched = {}
+        for subscription in list(self._callbacks.get(device, ())):
+            try:
+                match = subscription.match(device, changes)
+            except:
+                logger.exception(
+                    "Unhandled exception in predicate for device #%s (%s)",
+                    str(device.device_id), device.name)
+                continue
+            if match is not None:
+                matched[subscription] = match
+        return matched
+
+    def _event(self, device_data_list, changes=None):
         for device_data in device_data_list:
-            device_id = device_data.json_state.get('id')
-            device_list = self._devices.get(device_id)
+            device_list = self._devices.get(self._key(device_data))
             if device_list is None:
-                return
+                continue
+            device_changes = self._device_changes(device_data, changes)
             for device in device_list:
-                self._event_device(device, device_data)
+                self._event_device(device, device_data, device_changes)
 
-    def _event_device(self, device, device_data):
+    def _event_device(self, device, device_data, changes=None):
         if device is None:
             return
         # Climax can send an update status STATE_NO_JOB but
@@ -72,16 +316,53 @@ class SubscriptionRegistry(object):
                   device.name,
                   json.dumps(device_data.json_state))
         device.update(device_data.json_state)
-        for callback in self._callbacks.get(device, ()):
+        if changes is None:
+            changes = self._device_changes(device_data, None)
+        matched = self._match(device, changes)
+        if not matched:
+            return
+        if self.dispatcher is None:
+            self._run_callbacks(device, matched)
+        elif self.dispatcher.overflow == OVERFLOW_COALESCE:
+            # Merge with the changes still waiting, so the update replacing
+            # them in the dispatcher delivers them as well
+            with self._lock:
+                pending = self._pending_changes.setdefault(device, {})
+                for subscription, match in matched.items():
+                    pending[subscription] = merge_changes(
+                        pending.get(subscription, {}), match)
+            self.dispatcher.submit(device, self._run_pending, device)
+        else:
+            # Slow callbacks must not hold up polling
+            self.dispatcher.submit(device, self._run_callbacks, device,
+                                   matched)
+
+    def _run_pending(self, device):
+        with self._lock:
+            matched = self._pending_changes.pop(device, {})
+        self._run_callbacks(device, matched)
+
+    def _run_callbacks(self, device, matched):
+        start = time.perf_counter()
+        for subscription in list(self._callbacks.get(device, ())):
+            changes = matched.get(subscription)
+            if changes is None:
+                continue
             try:
-                callback(device)
+                if not subscription.filtered:
+                    subscription.callback(device)
+                elif changes:
+                    subscription.callback(device, changes)
             except:
                 # (Very) broad check to not let loosely-implemented callbacks
                 # kill our polling thread. They should be catching their own
                 # errors, so if it gets back to us, just log it and move on.
+                self.metrics.count('callback_errors', device.device_id)
                 logger.exception(
                     "Unhandled exception in callback for device #%s (%s)",
                     str(device.device_id), device.name)
+        self.metrics.observe('callback_seconds', device.device_id,
+                             time.perf_counter() - start)
 
     def join(self):
         """Don't allow the main thread to terminate until we have."""
@@ -89,49 +370,182 @@ class SubscriptionRegistry(object):
 
     def start(self):
         """Start a thread to handle Climax blocked polling."""
+        if self._poll_thread is not None and self._poll_thread.is_alive():
+            return
+        if not self._controllers:
+            from pyclimax import get_controller
+            self.add_controller(get_controller())
 
+        self._exiting = False
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='Climax Poll Worker')
+        self._heartbeat = time.monotonic()
         self._poll_thread = threading.Thread(target=self._run_poll_server,
                                              name='Climax Poll Thread')
-        self._poll_thread.deamon = True
+        self._poll_thread.daemon = True
         self._poll_thread.start()
+        self._watchdog_stop.clear()
+        self._watchdog = threading.Thread(target=self._run_watchdog,
+                                          name='Climax Watchdog',
+                                          daemon=True)
+        self._watchdog.start()
 
     def stop(self):
         """Tell the subscription thread to terminate."""
+        if self._poll_thread is None:
+            return
         self._exiting = True
+        self._watchdog_stop.set()
+        self.wakeup()
         self.join()
+        self._poll_thread = None
+        # Polls blocked on a hung hub finish on their own
+        self._executor.shutdown(wait=False)
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown()
         logger.info("Terminated thread")
 
+    def wakeup(self, controller=None):
+        """Poll a controller, or all of them, without further waiting."""
+        with self._lock:
+            now = time.monotonic()
+            for hub in self._controllers:
+                if controller is None or hub is controller:
+                    self._due[hub] = now
+        self._wakeup.set()
+
+    def _wait(self, delay):
+        self._wakeup.wait(delay)
+        self._wakeup.clear()
+
     def _run_poll_server(self):
-        from pyclimax import get_controller
-        controller = get_controller()
         while not self._exiting:
-            try:
-                logger.debug("Polling for Climax changes")
-                device_data = controller.get_changed_devices()
-            except requests.RequestException as ex:
-                logger.debug("Caught RequestException: %s", str(ex))
-                pass
-            except PyclimaxError as ex:
-                logger.debug("Non-fatal error in poll: %s", str(ex))
-                pass
-            except Exception as ex:
-                logger.exception("Climax poll thread general exception: %s",
-                    str(ex))
-                raise
-            else:
-                logger.debug("Poll returned")
-                if not self._exiting:
-                    if device_data:
-                        self._event(device_data)
-                    else:
-                        logger.debug("No changes in poll interval")
-                    time.sleep(1)
+            # Wake up regularly, so the watchdog sees the thread is alive
+            wait = WATCHDOG_INTERVAL
+            with self._lock:
+                now = time.monotonic()
+                self._heartbeat = now
+                for controller in self._controllers:
+                    if controller in self._polling:
+                        continue
+                    due = self._due[controller]
+                    if due <= now:
+                        self._polling.add(controller)
+                        self._poll_started[controller] = now
+                        self._executor.submit(self._poll, controller)
+                    elif due - now < wait:
+                        wait = due - now
+            self._wait(wait)
 
-                continue
+        logger.info("Shutdown Climax Poll Thread")
+
+    def _poll(self, controller):
+        """Poll one controller once and schedule its next poll."""
+        import requests
+        scheduler = controller.poll_scheduler
+        start = time.perf_counter()
+        try:
+            logger.debug("Polling for Climax changes")
+            device_data = controller.get_changed_devices()
+        except requests.RequestException as ex:
+            logger.debug("Caught RequestException: %s", str(ex))
+            failed = ex
+        except PyclimaxError as ex:
+            logger.debug("Non-fatal error in poll: %s", str(ex))
+            failed = ex
+        except Exception as ex:
+            # Keep polling the other hubs
+            logger.exception("Climax poll thread general exception: %s",
+                str(ex))
+            failed = ex
+        else:
+            logger.debug("Poll returned")
+            failed = None
+            scheduler.poll_succeeded(controller.last_changes.activity,
+                                     controller.long_polling,
+                                     controller.last_poll_held)
+            if not self._exiting:
+                events = time.perf_counter()
+                if controller.last_changes:
+                    self._event_changes(controller, controller.last_changes)
+                if device_data:
+                    self._event(device_data, controller.last_changes)
+                else:
+                    logger.debug("No changes in poll interval")
+                self.metrics.observe('poll_seconds', 'events',
+                                     time.perf_counter() - events)
+        self.metrics.observe('poll_seconds', 'total',
+                             time.perf_counter() - start)
 
+        if failed is not None:
             # After error, discard timestamp for fresh update. pyclimax issue #89
-            logger.info("Could not poll Climax - will retry in %ss",
-                     SUBSCRIPTION_RETRY)
-            time.sleep(SUBSCRIPTION_RETRY)
+            self.metrics.count('poll_errors', type(failed).__name__)
+            scheduler.poll_failed()
+        delay = scheduler.next_delay()
+        if failed is not None:
+            logger.info("Could not poll Climax %s - will retry in %.1fs",
+                        controller.base_url, delay)
 
-        logger.info("Shutdown Climax Poll Thread")
+        with self._lock:
+            if controller in self._due:
+                self._due[controller] = time.monotonic() + delay
+            self._polling.discard(controller)
+            self._poll_started.pop(controller, None)
+            if controller in self._stalled:
+                self._stalled.discard(controller)
+                logger.info("Poll of Climax %s finished after %.1fs",
+                            controller.base_url,
+                            time.perf_counter() - start)
+        self._wakeup.set()
+
+    def _run_watchdog(self):
+        while not self._watchdog_stop.wait(WATCHDOG_INTERVAL):
+            self._check_stalls()
+
+    def _check_stalls(self):
+        """Log polls running past their timeout, and a stuck poll thread."""
+        now = time.monotonic()
+        with self._lock:
+            started = list(self._poll_started.items())
+            heartbeat = self._heartbeat
+        for controller, since in started:
+            if controller in self._stalled:
+                continue
+            if now - since > controller._poll_timeout() + STALL_GRACE:
+                self._stalled.add(controller)
+                self.metrics.count('stalls', controller.base_url)
+                logger.warning("Poll of Climax %s stalled for %.1fs",
+                               controller.base_url, now - since)
+        stalled = now - heartbeat > WATCHDOG_INTERVAL + STALL_GRACE
+        if stalled and not self._thread_stalled and not self._exiting:
+            self.metrics.count('stalls', 'poll thread')
+            logger.warning("Climax Poll Thread stalled for %.1fs",
+                           now - heartbeat)
+        self._thread_stalled = stalled
+
+    def stats(self):
+        """Return a snapshot of the registry's metrics.
+
+        A dict of {metric: {label: value}}, see pyclimax.stats.METRICS,
+        with the base URLs and seconds of the 'stalled' polls and the
+        'dispatcher' queue counters.
+        """
+        stats = self.metrics.snapshot()
+        now = time.monotonic()
+        with self._lock:
+            stats['stalled'] = {controller.base_url: now - since
+                                for controller, since
+                                in self._poll_started.items()
+                                if controller in self._stalled}
+        if self.dispatcher is not None:
+            stats['dispatcher'] = self.dispatcher.stats()
+        return stats
+
+    def prometheus(self):
+        """Return the metrics of the registry and its controllers in the
+        Prometheus text format."""
+        return prometheus_text(
+            [(self.metrics, {})]
+            + [(controller.metrics, {'hub': controller.base_url})
+               for controller in self.controllers])
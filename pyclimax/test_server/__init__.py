@@ -0,0 +1 @@
+"""Simulated Climax hub for tests, benchmarks and manual runs."""
@@ -1,11 +1,16 @@
-import flask
-from flask import request, jsonify
+"""Climax hub simulator serving the devices of a sample home.
 
-app = flask.Flask(__name__)
-app.config["DEBUG"] = True
+    python -m pyclimax.test_server.server [--port 5000] [--tick 1]
 
-# Create some test data for our catalog in the form of a list of dictionaries.
+Serves the API on 127.0.0.1, see simulator.HubSimulator. With --tick the
+sample devices change over time.
+"""
+import argparse
+import time
 
+from pyclimax.test_server.simulator import ChangeRates, HubSimulator
+
+# Device list and welcome data of a sample home
 json_ret = {
     "senrows": [
             {
@@ -422,65 +427,29 @@ welcome_ret = {
     }
 }
 
-post_return = {
-    "result": 1,
-    "message": "Updated successfully."
-}
-
-
-@app.route('/', methods=['GET'])
-def home():
-    return '''<h1>HEJ JACQUELINE</h1>
-<p>Detta är en server för att visa att jag kan.</p>'''
-
-
-# A route to return all of the available entries in our catalog.
-@app.route('/action/deviceListGet', methods=['GET'])
-def api_list_get():
-    return jsonify(json_ret)
-
-# A route to return all of the available entries in our catalog.
-@app.route('/action/welcomeGet', methods=['GET'])
-def api_welcome_get():
-    return jsonify(welcome_ret)
-
-# A route to return all of the available entries in our catalog.
-@app.route('/action/deviceSwitchPSSPost', methods=['POST'])
-def api_switch_post():
-    query_params = request.form
-
-    id = query_params.get('id')
-    switch = query_params.get('switch')
-
-    senrows = json_ret.get('senrows')
-
-    for device in senrows:
-        if id in device.get('id'):
-            if '1' in switch:
-                print('Setting to on"')
-                device['status'] = "On, 1.3W"
-            else:
-                print('Setting to off"')
-                device['status'] = "Off, 0.0W"
-            break
-
-    return jsonify(post_return)
-
-# A route to return all of the available entries in our catalog.
-@app.route('/action/deviceSwitchDimmerPost', methods=['POST'])
-def api_dimmer_post():
-    query_params = request.form
-
-    id = query_params.get('id')
-    level = query_params.get('level')
-
-    senrows = json_ret.get('senrows')
 
-    for device in senrows:
-        if id in device.get('id'):
-            device['status'] = "On ({0}%)".format(level)
-            break
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a Climax hub.')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every response')
+    parser.add_argument('--tick', type=float, default=None,
+                        help='seconds between changes of the devices')
+    args = parser.parse_args()
+    rates = ChangeRates(switch_flips=0.01, power_drift=1.0,
+                        temperature_walk=0.05, energy=0.001)
+    hub = HubSimulator(rows=json_ret['senrows'], rates=rates,
+                       latency=args.latency, tick=args.tick,
+                       welcome=welcome_ret['updates'], port=args.port)
+    print('Serving {}'.format(hub.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.close()
 
-    return jsonify(post_return)
 
-app.run()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,535 @@
+"""In-process simulator of the Climax hub HTTP API.
+
+Serves deviceListGet, welcomeGet, deviceSwitchPSSPost and
+deviceSwitchDimmerPost from a stdlib HTTP server, for tests, benchmarks
+and load tests without a real hub:
+
+    with HubSimulator({48: 100, 20: 10}, latency=0.01) as hub:
+        controller = ClimaxController(hub.url, 'user', 'password')
+"""
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Simulated device types: type -> type_f
+DEVICE_TYPES = {
+    2: 'Remote Controller',
+    11: 'Smoke Detector',
+    20: 'Temperature Sensor',
+    48: 'Power Switch Meter',
+    50: 'Power Meter',
+    53: 'Dimmer',
+}
+TYPE_REMOTE = 2
+TYPE_SMOKE = 11
+TYPE_TEMPERATURE = 20
+TYPE_SWITCH = 48
+TYPE_POWER_METER = 50
+TYPE_DIMMER = 53
+
+# Default devices per type
+DEVICES_PER_TYPE = {TYPE_SWITCH: 10, TYPE_DIMMER: 3, TYPE_TEMPERATURE: 2,
+                    TYPE_POWER_METER: 1, TYPE_SMOKE: 1, TYPE_REMOTE: 1}
+# Default welcomeGet updates
+WELCOME = {
+    "version": "HPGW 0.0.1.77 HPGW-L2-XA12 2.1.2.3.1",
+    "em_ver": "0.0.1.77",
+    "rf_ver": "HPGW-L2-XA12",
+    "zb_ver": "2.1.2.3.1",
+    "zw_ver": "Z-Wave 3.40",
+    "gsm_ver": "Cinterion BGS3 REVISION 01.000",
+    "cfg_ver": "1.0",
+    "publicip": "127.0.0.1",
+    "ip": "127.0.0.1",
+    "mac": "00:1D:94:00:00:01",
+}
+POST_OK = {"result": 1, "message": "Updated successfully."}
+POST_FAILED = {"result": 0, "message": "Device not found."}
+
+# Faults injected by HubSimulator.inject
+FAULT_EMPTY = 'empty'          # 200 with an empty body
+FAULT_GARBLED = 'garbled'      # 200 with half of the JSON
+FAULT_MISSING = 'missing'      # 200 with JSON lacking senrows
+FAULT_TRUNCATED = 'truncated'  # connection closed halfway through the body
+FAULT_STALL = 'stall'          # no answer for stall_time seconds
+FAULT_RESET = 'reset'          # connection reset without an answer
+FAULT_ERROR = 'error'          # 503 Service Unavailable
+FAULT_DRIP = 'drip'            # body sent drip_size bytes at a time
+FAULTS = (FAULT_EMPTY, FAULT_GARBLED, FAULT_MISSING, FAULT_TRUNCATED,
+          FAULT_STALL, FAULT_RESET, FAULT_ERROR, FAULT_DRIP)
+# Default seconds a stalled request is held
+STALL_TIME = 60
+# Default bytes and seconds between the writes of a dripped body
+DRIP_SIZE = 512
+DRIP_INTERVAL = 0.1
+
+
+class ChangeRates(object):
+    """How fast the simulated devices change, per second of simulation.
+
+    switch_flips: chance per second that a switch is flipped.
+    power_drift: standard deviation in W of the load of switches that
+    are on.
+    temperature_walk: standard deviation in °C of temperature changes.
+    energy: kWh added to power meters.
+    rssi_jitter: chance per second that a device's signal changes.
+    """
+
+    def __init__(self, switch_flips=0.0, power_drift=0.0,
+                 temperature_walk=0.0, energy=0.0, rssi_jitter=0.0):
+        self.switch_flips = switch_flips
+        self.power_drift = power_drift
+        self.temperature_walk = temperature_walk
+        self.energy = energy
+        self.rssi_jitter = rssi_jitter
+
+
+class _Device(object):
+    """Simulated state of one device, rendered into its senrows item."""
+
+    def __init__(self, row, rng):
+        self.row = row
+        self.type = row.get('type')
+        self.on = row.get('status', '').startswith('On')
+        self.load = round(rng.uniform(1, 100), 1)
+        self.level = 100
+        self.temperature = 21.0
+        self.energy = 0.0
+        status = row.get('status', '')
+        try:
+            if self.type == TYPE_SWITCH and self.on:
+                self.load = float(status.split(',')[1].strip().rstrip('W'))
+            elif self.type == TYPE_DIMMER and self.on:
+                self.level = int(status.split('(')[1].rstrip('%)'))
+            elif self.type == TYPE_TEMPERATURE:
+                self.temperature = float(status.split()[0])
+            elif self.type == TYPE_POWER_METER:
+                self.energy = float(status.rstrip('kWh'))
+        except (IndexError, ValueError):
+            pass
+
+    def render(self):
+        """Update the status of the row from the state."""
+        if self.type == TYPE_SWITCH:
+            self.row['status'] = ('On, {:.1f}W'.format(self.load) if self.on
+                                  else 'Off, 0.0W')
+        elif self.type == TYPE_DIMMER:
+            self.row['status'] = ('On ({}%)'.format(self.level) if self.on
+                                  else 'Off')
+        elif self.type == TYPE_TEMPERATURE:
+            self.row['status'] = '{:.2f} °C'.format(self.temperature)
+        elif self.type == TYPE_POWER_METER:
+            self.row['status'] = '{:.3f}kWh'.format(self.energy)
+
+
+def generate_rows(devices_per_type=None, areas=1):
+    """Return senrows items for {type: count} devices."""
+    if devices_per_type is None:
+        devices_per_type = DEVICES_PER_TYPE
+    rows = []
+    for device_type, count in sorted(devices_per_type.items()):
+        type_f = DEVICE_TYPES.get(device_type, 'Device')
+        for number in range(count):
+            zone = len(rows) + 1
+            rows.append({
+                "area": 1 + len(rows) % areas,
+                "zone": zone,
+                "type": device_type,
+                "type_f": type_f,
+                "name": "{} {}".format(type_f, number + 1),
+                "cond": "",
+                "cond_ok": "1",
+                "battery": "",
+                "battery_ok": "1",
+                "tamper": "",
+                "tamper_ok": "1",
+                "bypass": "No",
+                "rssi": "Strong, 9",
+                "status": "",
+                "id": "ZB:{:016x}".format(zone),
+                "su": 1,
+            })
+    return rows
+
+
+class HubSimulator(object):
+    """Class simulating a Climax hub on an ephemeral port of 127.0.0.1.
+
+    devices_per_type: {device type: count} of generated devices.
+    rows: senrows items to serve instead of generated devices.
+    rates: ChangeRates applied by step(), and every tick seconds by a
+    background thread if tick is set.
+    latency: seconds, or a (min, max) range, added to every response.
+    block_polls: like the hub, hold deviceListGet up to its timeout
+    parameter until the devices change after the last response on the
+    same connection, and then up to its minimumdelay (ms) to collect
+    more changes.
+    long_poll: return the version of the device list with it, and hold
+    deviceListGet with the version parameter until the devices change
+    from that version, whatever the connection.
+    fault_rates: {fault: chance} of answering a request with a fault, on
+    top of those scheduled with inject().
+    """
+
+    def __init__(self, devices_per_type=None, rows=None, rates=None,
+                 latency=0, tick=None, areas=1, welcome=None, seed=None,
+                 block_polls=True, long_poll=True, fault_rates=None,
+                 port=0):
+        """Setup the devices and start serving."""
+        self.rates = rates or ChangeRates()
+        self.latency = latency
+        self.block_polls = block_polls
+        self.long_poll = long_poll
+        self.welcome = dict(WELCOME, **(welcome or {}))
+        self._random = random.Random(seed)
+        if rows is None:
+            rows = generate_rows(devices_per_type, areas)
+        self.rows = [dict(row) for row in rows]
+        self._devices = [_Device(row, self._random) for row in self.rows]
+        self._by_id = {device.row['id']: device for device in self._devices}
+        for device in self._devices:
+            device.render()
+        self._condition = threading.Condition()
+        self.version = 0
+        self._body = None
+        self.requests = {}
+        self.last_payloads = {}
+        self._stepped = time.monotonic()
+        self.fault_rates = dict(fault_rates or {})
+        self.stall_time = STALL_TIME
+        self.drip_size = DRIP_SIZE
+        self.drip_interval = DRIP_INTERVAL
+        self._faults = []
+        self.faults_served = {}
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port),
+                                          self._handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self._threads = [threading.Thread(target=self.server.serve_forever,
+                                          name='Climax Simulator',
+                                          daemon=True)]
+        self._exiting = threading.Event()
+        if tick:
+            self._threads.append(threading.Thread(
+                target=self._run_ticks, args=(tick,),
+                name='Climax Simulator Ticks', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop serving."""
+        self._exiting.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _run_ticks(self, tick):
+        while not self._exiting.wait(tick):
+            self.step()
+
+    def _changed(self):
+        """Note a change of the device list, under the condition."""
+        self.version += 1
+        self._body = None
+        self._condition.notify_all()
+
+    def step(self, seconds=None):
+        """Apply the change rates for seconds, by default since the last
+        step."""
+        now = time.monotonic()
+        if seconds is None:
+            seconds = now - self._stepped
+        self._stepped = now
+        rates = self.rates
+        rng = self._random
+        changed = False
+        with self._condition:
+            for device in self._devices:
+                before = device.row['status'], device.row['rssi']
+                if device.type == TYPE_SWITCH:
+                    if rng.random() < rates.switch_flips * seconds:
+                        device.on = not device.on
+                    if device.on and rates.power_drift:
+                        device.load = max(0.0, device.load + rng.gauss(
+                            0, rates.power_drift * seconds ** 0.5))
+                elif device.type == TYPE_TEMPERATURE and rates.temperature_walk:
+                    device.temperature += rng.gauss(
+                        0, rates.temperature_walk * seconds ** 0.5)
+                elif device.type == TYPE_POWER_METER:
+                    device.energy += rates.energy * seconds
+                if rng.random() < rates.rssi_jitter * seconds:
+                    device.row['rssi'] = 'Strong, {}'.format(rng.randint(5, 9))
+                device.render()
+                if (device.row['status'], device.row['rssi']) != before:
+                    changed = True
+            if changed:
+                self._changed()
+
+    def mutate(self, count):
+        """Flip count switches now, round robin, return their ids."""
+        switches = [device for device in self._devices
+                    if device.type in (TYPE_SWITCH, TYPE_DIMMER)]
+        flipped = []
+        with self._condition:
+            for number in range(count):
+                device = switches[(self.version + number) % len(switches)]
+                device.on = not device.on
+                device.render()
+                flipped.append(device.row['id'])
+            self._changed()
+        return flipped
+
+    def update(self, device_id, **state):
+        """Set the simulated state of a device now.
+
+        state: on, load (W), level (%), temperature (°C) or energy (kWh).
+        """
+        with self._condition:
+            device = self._by_id[device_id]
+            for name, value in state.items():
+                if name not in ('on', 'load', 'level', 'temperature',
+                                'energy'):
+                    raise ValueError("Unknown device state {!r}".format(name))
+                setattr(device, name, value)
+            device.render()
+            self._changed()
+
+    def device(self, device_id):
+        """Return the senrows item of a device, or None."""
+        device = self._by_id.get(device_id)
+        return device.row if device is not None else None
+
+    def body(self):
+        """Return the deviceListGet response body."""
+        with self._condition:
+            if self._body is None:
+                result = {'senrows': self.rows}
+                if self.long_poll:
+                    result['version'] = str(self.version)
+                self._body = json.dumps(result).encode()
+            return self._body
+
+    def _delay(self):
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = self._random.uniform(*latency)
+        if latency:
+            time.sleep(latency)
+
+    def inject(self, fault, count=1, duration=None, method='deviceListGet'):
+        """Answer the next count requests with fault, or all requests for
+        duration seconds if it is set.
+
+        method: the API method affected, None for all of them.
+        """
+        if fault not in FAULTS:
+            raise ValueError("Unknown fault {!r}".format(fault))
+        until = None
+        if duration is not None:
+            count = None
+            until = time.monotonic() + duration
+        with self._condition:
+            self._faults.append([fault, method, count, until])
+
+    def clear_faults(self):
+        """Cancel the faults scheduled with inject."""
+        with self._condition:
+            del self._faults[:]
+
+    def _next_fault(self, method):
+        """Return the fault to answer a request of method with, or None."""
+        now = time.monotonic()
+        with self._condition:
+            fault = None
+            for entry in list(self._faults):
+                name, entry_method, count, until = entry
+                if until is not None and now >= until:
+                    self._faults.remove(entry)
+                    continue
+                if entry_method is not None and entry_method != method:
+                    continue
+                if count is not None:
+                    entry[2] -= 1
+                    if entry[2] <= 0:
+                        self._faults.remove(entry)
+                fault = name
+                break
+            else:
+                for name, chance in self.fault_rates.items():
+                    if self._random.random() < chance:
+                        fault = name
+                        break
+            if fault is not None:
+                self.faults_served[fault] = (
+                    self.faults_served.get(fault, 0) + 1)
+            return fault
+
+    def _count(self, method, payload):
+        with self._condition:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.last_payloads[method] = payload
+
+    def device_list(self, payload, seen=None):
+        """Answer deviceListGet, return (body, version).
+
+        seen is the version last served on the connection, None for a
+        new connection. The version parameter of long polls replaces it.
+        """
+        start = time.monotonic()
+        try:
+            timeout = float(payload.get('timeout', 0))
+            minimum = float(payload.get('minimumdelay', 0)) / 1000.0
+        except ValueError:
+            timeout = minimum = 0
+        block = self.block_polls
+        if self.long_poll and 'version' in payload:
+            block = True
+            seen = payload['version']
+        with self._condition:
+            if block and seen is not None and timeout > 0:
+                if self._condition.wait_for(
+                        lambda: str(self.version) != str(seen),
+                        timeout):
+                    self._condition.wait_for(
+                        lambda: False, start + minimum - time.monotonic())
+            return self.body(), self.version
+
+    def switch(self, payload):
+        """Answer deviceSwitchPSSPost: switch 0 off, 1 on, 2 toggle."""
+        with self._condition:
+            device = self._by_id.get(payload.get('id'))
+            if device is None or device.type != TYPE_SWITCH:
+                return POST_FAILED
+            switch = payload.get('switch')
+            if switch == '2':
+                device.on = not device.on
+            elif switch in ('0', '1'):
+                device.on = switch == '1'
+            else:
+                return POST_FAILED
+            device.render()
+            self._changed()
+        return POST_OK
+
+    def dim(self, payload):
+        """Answer deviceSwitchDimmerPost: level 0-100, 0 is off."""
+        with self._condition:
+            device = self._by_id.get(payload.get('id'))
+            if device is None or device.type != TYPE_DIMMER:
+                return POST_FAILED
+            try:
+                level = int(payload.get('level'))
+            except (TypeError, ValueError):
+                return POST_FAILED
+            level = max(0, min(level, 100))
+            device.on = level > 0
+            if level:
+                device.level = level
+            device.render()
+            self._changed()
+        return POST_OK
+
+    def _handler(self):
+        hub = self
+        routes = {
+            ('GET', 'deviceListGet'): self.device_list,
+            ('GET', 'welcomeGet'): lambda payload: {'updates': hub.welcome},
+            ('POST', 'deviceSwitchPSSPost'): self.switch,
+            ('POST', 'deviceSwitchDimmerPost'): self.dim,
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are separate writes, don't let Nagle hold
+            # the body back until the client's delayed ACK
+            disable_nagle_algorithm = True
+            # Device list version last served on this connection
+            seen = None
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, verb):
+                url = urlsplit(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8', 'replace')
+                payload = dict(parse_qsl(url.query))
+                payload.update(parse_qsl(body))
+                method = url.path.rsplit('/', 1)[-1]
+                route = routes.get((verb, method))
+                if not url.path.startswith('/action/') or route is None:
+                    self.send_error(404)
+                    return
+                hub._count(method, payload)
+                hub._delay()
+                fault = hub._next_fault(method)
+                if fault == FAULT_RESET:
+                    self._reset()
+                    return
+                if fault == FAULT_ERROR:
+                    self.send_error(503)
+                    return
+                if fault == FAULT_STALL:
+                    hub._exiting.wait(hub.stall_time)
+                if fault == FAULT_EMPTY:
+                    result = b''
+                elif fault == FAULT_MISSING:
+                    result = {'result': 0}
+                elif method == 'deviceListGet':
+                    result, self.seen = hub.device_list(payload, self.seen)
+                else:
+                    result = route(payload)
+                if not isinstance(result, bytes):
+                    result = json.dumps(result).encode()
+                if fault == FAULT_GARBLED:
+                    result = result[:len(result) // 2]
+                try:
+                    self._reply(result, fault)
+                except OSError:
+                    # The client gave up, eg on a stall
+                    self.close_connection = True
+
+            def _reply(self, result, fault):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(result)))
+                self.end_headers()
+                if fault == FAULT_TRUNCATED:
+                    self.wfile.write(result[:len(result) // 2])
+                    self.close_connection = True
+                elif fault == FAULT_DRIP:
+                    for start in range(0, len(result), hub.drip_size):
+                        self.wfile.write(
+                            result[start:start + hub.drip_size])
+                        self.wfile.flush()
+                        if hub._exiting.wait(hub.drip_interval):
+                            break
+                else:
+                    self.wfile.write(result)
+
+            def _reset(self):
+                """Close the connection with a TCP reset."""
+                self.connection.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+                self.connection.close()
+                self.close_connection = True
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+        return Handler
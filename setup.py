@@ -7,6 +7,8 @@ setup(name='pyclimax',
       author='Niklas Hjern',
       author_email='hjern.niklas@gmail.com',
       license='MIT',
-      install_requires=['requests>=2.0', 'jsondiff>=1.1.2'],
+      install_requires=['requests>=2.0'],
+      extras_require={'async': ['aiohttp>=3.0'], 'fleet': ['numpy>=1.13'],
+                      'store': ['numpy>=1.13']},
       packages=find_packages(),
       zip_safe=True)
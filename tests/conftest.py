@@ -0,0 +1,54 @@
+"""Fixtures of the pyclimax tests."""
+import threading
+
+import pytest
+
+import pyclimax
+from pyclimax.test_server.simulator import HubSimulator
+
+# Seconds the hub may hold a subscription poll in the tests
+POLL_WAIT = 10
+
+
+@pytest.fixture
+def hub():
+    """A simulated hub with two switches and a temperature sensor."""
+    with HubSimulator({48: 2, 20: 1}) as simulator:
+        yield simulator
+
+
+@pytest.fixture
+def controllers():
+    """A list to add controllers to, they are stopped after the test."""
+    created = []
+    yield created
+    for controller in created:
+        controller.stop()
+
+
+@pytest.fixture
+def polling_controller(hub, controllers):
+    """Factory of controllers whose subscription poll is held by the hub,
+    taking ClimaxController keyword arguments."""
+
+    def create(**kwargs):
+        held = threading.Event()
+        device_list = hub.device_list
+
+        def note_held(payload, seen=None):
+            if (seen is not None and float(payload.get('timeout', 0)) > 0
+                    and str(seen) == str(hub.version)):
+                held.set()
+            return device_list(payload, seen)
+
+        hub.device_list = note_held
+        controller = pyclimax.ClimaxController(
+            hub.url, 'user', 'password', subscription_wait=POLL_WAIT,
+            **kwargs)
+        controllers.append(controller)
+        controller.get_devices()
+        controller.start()
+        assert held.wait(5), "no subscription poll was held"
+        return controller
+
+    return create
@@ -0,0 +1,87 @@
+"""Tests of the asyncio controller against the hub simulator."""
+import asyncio
+
+import pytest
+
+import pyclimax
+
+aiohttp = pytest.importorskip('aiohttp')
+aio = pytest.importorskip('pyclimax.aio')
+
+
+def _switch(devices):
+    return [device for device in devices
+            if isinstance(device, pyclimax.ClimaxSwitch)][0]
+
+
+def test_devices_and_commands(hub):
+    async def run():
+        async with aio.AsyncClimaxController(hub.url, 'user',
+                                             'password') as controller:
+            devices = await controller.get_devices()
+            switch = _switch(devices)
+            await switch.switch_off()
+            await switch.refresh()
+            off = switch.is_switched_on()
+            await switch.switch_on()
+            await switch.refresh()
+            return devices, off, switch.is_switched_on()
+
+    devices, off, on = asyncio.run(run())
+
+    assert [device.device_id for device in devices] == [
+        row['id'] for row in hub.rows]
+    assert (off, on) == (False, True)
+    assert hub.requests['deviceSwitchPSSPost'] == 2
+
+
+def test_subscription_reports_changes(hub):
+    async def run():
+        async with aio.AsyncClimaxController(
+                hub.url, 'user', 'password', subscription_wait=5) as controller:
+            await controller.get_devices()
+            changed = asyncio.Event()
+            reported = []
+
+            def on_changes(controller, changes):
+                reported.extend(changes.changed)
+                changed.set()
+
+            controller.register_changes(on_changes)
+            controller.start()
+            await asyncio.sleep(0.3)
+            flipped = hub.mutate(1)
+            await asyncio.wait_for(changed.wait(), 5)
+            await controller.stop()
+            return flipped, reported
+
+    flipped, reported = asyncio.run(run())
+
+    assert reported == flipped
+
+
+def test_shared_session_is_left_open(hub):
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            async with aio.AsyncClimaxController(
+                    hub.url, 'user', 'password', session=session) as first:
+                await first.get_devices()
+            return session.closed
+
+    assert asyncio.run(run()) is False
+
+
+def test_blocking_use_is_refused(hub):
+    async def run():
+        controller = aio.AsyncClimaxController(hub.url, 'user', 'password')
+        try:
+            switch = _switch(await controller.get_devices())
+            with pytest.raises(TypeError):
+                with controller:
+                    pass
+            with pytest.raises(pyclimax.PyclimaxError):
+                switch.is_switched_on(refresh=True)
+        finally:
+            await controller.close()
+
+    asyncio.run(run())
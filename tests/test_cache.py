@@ -0,0 +1,22 @@
+"""Tests of the device list cache."""
+from pyclimax.cache import DeviceListCache
+
+
+def test_result_is_reused_only_for_its_fingerprint():
+    cache = DeviceListCache(5)
+    first = {'senrows': [{'id': 'a'}]}
+    second = {'senrows': [{'id': 'b'}]}
+    cache.put(first, b'first')
+    cache.put(second, b'second')
+
+    assert cache.reuse(b'first') is None
+    assert cache.reuse(b'second') is second
+
+
+def test_restored_result_is_never_reused():
+    cache = DeviceListCache(5)
+    cache.put({'senrows': []}, b'body')
+    cache.restore({'senrows': [{'id': 'a'}]}, 0)
+
+    assert cache.reuse(b'body') is None
+    assert cache.reuse(None) is None
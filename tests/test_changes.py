@@ -0,0 +1,51 @@
+"""Tests of change detection between device lists."""
+from pyclimax.changes import ChangeDetector
+
+
+def _row(device_id, status='Off', rssi='Strong, 9', **fields):
+    return dict({'id': device_id, 'status': status, 'rssi': rssi}, **fields)
+
+
+def test_first_list_is_all_added():
+    changes = ChangeDetector().detect([_row('a'), _row('b')])
+
+    assert changes.added == ['a', 'b']
+    assert not changes.removed and not changes.changed
+
+
+def test_added_removed_and_changed():
+    detector = ChangeDetector()
+    detector.detect([_row('a'), _row('b'), _row('c')])
+
+    changes = detector.detect([_row('a', status='On'), _row('c'),
+                               _row('d')])
+
+    assert changes.added == ['d']
+    assert changes.removed == ['b']
+    assert changes.changed == {'a': {'status': ('Off', 'On')}}
+    assert changes.ids == ['d', 'a']
+
+
+def test_same_list_has_no_changes():
+    detector = ChangeDetector()
+    detector.detect([_row('a')])
+
+    assert not detector.detect([_row('a')])
+
+
+def test_ignored_fields_are_not_changes():
+    detector = ChangeDetector(ignored_fields=('rssi',))
+    detector.detect([_row('a'), _row('b')])
+
+    changes = detector.detect([_row('a', rssi='Weak, 2'),
+                               _row('b', rssi='Weak, 2', status='On')])
+
+    assert changes.changed == {'b': {'status': ('Off', 'On')}}
+
+
+def test_seed_only_sets_an_empty_baseline():
+    detector = ChangeDetector()
+    detector.seed([_row('a')])
+    detector.seed([_row('b')])
+
+    assert detector.detect([_row('a')]).added == []
@@ -0,0 +1,110 @@
+"""Tests of confirmed device commands against the hub simulator."""
+import time
+
+import pyclimax
+
+
+def _controller(hub, controllers, **kwargs):
+    controller = pyclimax.ClimaxController(
+        hub.url, 'user', 'password', confirm_commands=True, **kwargs)
+    controllers.append(controller)
+    return controller
+
+
+def _switch(controller):
+    return [device for device in controller.get_devices()
+            if isinstance(device, pyclimax.ClimaxSwitch)][0]
+
+
+def test_toggle_sends_explicit_state_read_from_hub(hub, controllers):
+    controller = _controller(hub, controllers, confirm_timeout=1)
+    switch = _switch(controller)
+    # The cached list says off, the hub was switched on since
+    hub.update(switch.device_id, on=True)
+    assert not switch.is_switched_on()
+
+    result = switch.switch_toggle().result(5)
+
+    assert result.confirmed
+    assert result.attempts == 1
+    assert hub.requests['deviceSwitchPSSPost'] == 1
+    assert hub.last_payloads['deviceSwitchPSSPost']['switch'] == '0'
+    assert hub.device(switch.device_id)['status'].startswith('Off')
+
+
+def test_unconfirmed_toggle_is_not_resent(hub, controllers):
+    controller = _controller(hub, controllers, confirm_timeout=0.2,
+                             command_retries=3)
+    switch = _switch(controller)
+
+    future = controller.send_command(
+        'deviceSwitchPSSPost', {'id': switch.device_id, 'switch': 2},
+        expect=lambda json_state: False)
+
+    try:
+        future.result(5)
+    except pyclimax.PyclimaxError:
+        pass
+    else:
+        raise AssertionError("an unconfirmable command was confirmed")
+    assert hub.requests['deviceSwitchPSSPost'] == 1
+
+
+def test_unconfirmed_command_is_resent(hub, controllers):
+    controller = _controller(hub, controllers, confirm_timeout=0.2,
+                             command_retries=2)
+    switch = _switch(controller)
+
+    future = controller.send_command(
+        'deviceSwitchPSSPost', {'id': switch.device_id, 'switch': 1},
+        expect=lambda json_state: False)
+
+    try:
+        future.result(5)
+    except pyclimax.PyclimaxError:
+        pass
+    assert hub.requests['deviceSwitchPSSPost'] == 3
+
+
+def test_commands_are_posted_in_order(hub, controllers):
+    controller = _controller(hub, controllers)
+    switches = [device for device in controller.get_devices()
+                if isinstance(device, pyclimax.ClimaxSwitch)]
+    posted = []
+    post_request = controller.post_request
+
+    def record(method, payload, **kwargs):
+        posted.append((payload['id'], payload['switch']))
+        return post_request(method, payload, **kwargs)
+
+    controller.post_request = record
+    futures = [switch.switch_on() for switch in switches]
+    futures += [switch.switch_off() for switch in switches]
+
+    assert posted == ([(switch.device_id, 1) for switch in switches]
+                      + [(switch.device_id, 0) for switch in switches])
+    for future in futures:
+        future.result(5)
+
+
+def test_confirmation_does_not_wait_for_poll(polling_controller):
+    controller = polling_controller(confirm_commands=True)
+    switch = _switch(controller)
+
+    start = time.monotonic()
+    result = switch.switch_on().result(5)
+
+    assert result.confirmed
+    assert time.monotonic() - start < 1
+
+
+def test_toggle_without_confirmation_posts_toggle(hub, controllers):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password')
+    controllers.append(controller)
+    switch = _switch(controller)
+    reads = hub.requests['deviceListGet']
+
+    switch.switch_toggle()
+
+    assert hub.requests['deviceListGet'] == reads
+    assert hub.last_payloads['deviceSwitchPSSPost']['switch'] == '2'
@@ -0,0 +1,21 @@
+"""Tests of the controller lifecycle."""
+import threading
+
+import pyclimax
+
+
+def _poll_threads():
+    return [thread for thread in threading.enumerate()
+            if thread.name == 'Climax Poll Thread' and thread.is_alive()]
+
+
+def test_context_manager_stops_polling(hub):
+    running = len(_poll_threads())
+    with pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                   subscription_wait=1) as controller:
+        controller.get_devices()
+        controller.start()
+        assert len(_poll_threads()) > running
+
+    assert len(_poll_threads()) == running
+    assert controller._session is None
@@ -0,0 +1,83 @@
+"""Tests of the subscription callback dispatcher."""
+import threading
+
+import pytest
+
+from pyclimax.dispatch import (CallbackDispatcher, OVERFLOW_COALESCE,
+                               OVERFLOW_DROP_OLDEST)
+
+
+def _blocked(dispatcher, key, calls):
+    """Submit work for key that blocks until the returned event is set."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+        calls.append((key, 'block'))
+
+    dispatcher.submit(key, block)
+    assert started.wait(5)
+    return release
+
+
+def test_work_of_a_device_runs_in_order():
+    dispatcher = CallbackDispatcher(max_workers=4,
+                                    overflow=OVERFLOW_DROP_OLDEST)
+    calls = []
+    for number in range(50):
+        for key in ('a', 'b'):
+            dispatcher.submit(key, calls.append, (key, number))
+    dispatcher.shutdown()
+
+    for key in ('a', 'b'):
+        assert [number for k, number in calls if k == key] == list(range(50))
+    assert dispatcher.dispatched == 100
+    assert dispatcher.dropped == dispatcher.coalesced == 0
+
+
+def test_coalesce_keeps_the_newest_pending_update():
+    dispatcher = CallbackDispatcher(overflow=OVERFLOW_COALESCE)
+    calls = []
+    release = _blocked(dispatcher, 'a', calls)
+    for number in range(3):
+        dispatcher.submit('a', calls.append, ('a', number))
+    release.set()
+    dispatcher.shutdown()
+
+    assert calls == [('a', 'block'), ('a', 2)]
+    assert dispatcher.coalesced == 2
+    assert dispatcher.stats()['queue_depth'] == 0
+
+
+def test_drop_oldest_keeps_max_pending_updates():
+    dispatcher = CallbackDispatcher(overflow=OVERFLOW_DROP_OLDEST,
+                                    max_pending=2)
+    calls = []
+    release = _blocked(dispatcher, 'a', calls)
+    for number in range(5):
+        dispatcher.submit('a', calls.append, ('a', number))
+    release.set()
+    dispatcher.shutdown()
+
+    assert calls == [('a', 'block'), ('a', 3), ('a', 4)]
+    assert dispatcher.dropped == 3
+    assert dispatcher.max_queue_depth == 2
+
+
+def test_slow_device_does_not_hold_up_others():
+    dispatcher = CallbackDispatcher(max_workers=2)
+    calls = []
+    release = _blocked(dispatcher, 'slow', calls)
+    done = threading.Event()
+    dispatcher.submit('fast', done.set)
+
+    assert done.wait(5)
+    release.set()
+    dispatcher.shutdown()
+
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        CallbackDispatcher(overflow='block')
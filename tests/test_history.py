@@ -0,0 +1,61 @@
+"""Tests of the in-memory reading history."""
+import pytest
+
+from pyclimax.history import ReadingHistory, RingBuffer
+
+NOW = 299.0
+
+
+def _history(tiers):
+    """Return a history of the values 0..299, one per second."""
+    history = ReadingHistory(raw_capacity=50, tiers=tiers)
+    for second in range(300):
+        history.add(float(second), now=float(second))
+    return history
+
+
+def test_ring_buffer_overwrites_oldest_rows():
+    buffer = RingBuffer(3, 2)
+    for second in range(5):
+        buffer.append(float(second), second * 10.0)
+
+    assert buffer.full
+    assert list(buffer.rows()) == [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)]
+    assert buffer.bisect(3.5) == 2
+
+
+def test_window_within_raw_samples_is_exact():
+    history = _history(((10, 100), (100, 100)))
+
+    stats = history.window(30, now=NOW)
+
+    assert stats == (31, 269.0, 299.0, 284.0)
+
+
+def test_window_past_raw_samples_uses_first_tier():
+    history = _history(((10, 100), (100, 100)))
+
+    stats = history.window(100, now=NOW)
+
+    # Rounded out to the 10 s buckets, including the open one
+    assert stats.count == 110
+    assert (stats.min, stats.max) == (190.0, 299.0)
+    assert stats.mean == pytest.approx(244.5)
+
+
+def test_window_past_first_tier_uses_coarser_tier():
+    history = _history(((10, 5), (100, 100)))
+
+    stats = history.window(200, now=NOW)
+
+    assert stats.count == 300
+    assert (stats.min, stats.max) == (0.0, 299.0)
+    assert stats.mean == pytest.approx(149.5)
+
+
+def test_empty_window():
+    history = ReadingHistory()
+
+    assert history.window(60, now=NOW) is None
+    history.add(1.0, now=0.0)
+    assert history.window(60, now=NOW) is None
@@ -0,0 +1,49 @@
+"""Tests of the device indexes."""
+import pyclimax
+from pyclimax import index
+
+
+def test_poll_reindexes_only_changed_devices(hub, controllers, monkeypatch):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password')
+    controllers.append(controller)
+    controller.get_devices()
+    calls = []
+
+    def counting(name):
+        calls.append(name)
+        return normalize_name(name)
+
+    normalize_name = index.normalize_name
+    monkeypatch.setattr(index, 'normalize_name', counting)
+    hub.mutate(1)
+    controller.get_changed_devices()
+
+    assert calls == []
+    assert len(controller.device_index) == len(hub.rows)
+    for row in hub.rows:
+        assert controller.get_device_by_name(row['name']).device_id == row['id']
+
+
+def test_names_match_across_case_composition_and_whitespace():
+    decomposed = 'Ko\u0308k'
+
+    assert index.normalize_name('Kök ') == index.normalize_name('KÖK')
+    assert index.normalize_name(decomposed) == index.normalize_name('kök')
+    assert index.normalize_name('Hall  Å') == index.normalize_name('hall å')
+    assert index.normalize_name('Ä') != index.normalize_name('A')
+    assert index.normalize_name(None) is None
+
+
+def test_lookup_by_name_with_swedish_letters():
+    class Device(object):
+        def __init__(self, device_id, name):
+            self.device_id = device_id
+            self.name = name
+            self.json_state = {'type': 48, 'area': 1, 'zone': 1}
+
+    devices = index.DeviceIndex()
+    devices.update([Device('a', 'Kök'), Device('b', 'Vardagsrum Ö')])
+
+    assert devices.by_name('KÖK ').device_id == 'a'
+    assert devices.by_name('vardagsrum ö').device_id == 'b'
+    assert devices.by_name('Kok') is None
@@ -0,0 +1,13 @@
+"""Tests of reads made while a subscription poll is held by the hub."""
+import time
+
+
+def test_reads_do_not_join_poll_in_flight(polling_controller):
+    controller = polling_controller()
+
+    start = time.monotonic()
+    controller.get_devices(max_age=0)
+    controller.devices[0].refresh()
+    controller.refresh_data()
+
+    assert time.monotonic() - start < 1
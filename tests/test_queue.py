@@ -0,0 +1,69 @@
+"""Tests of the coalescing command queue."""
+import threading
+
+import pytest
+
+from pyclimax.commands import CommandQueue
+
+METHOD = 'deviceSwitchPSSPost'
+
+
+@pytest.fixture
+def sent():
+    """The (device id, value) of posted commands, in order."""
+    return []
+
+
+@pytest.fixture
+def queue(sent):
+    lock = threading.Lock()
+
+    def send(method, payload):
+        with lock:
+            sent.append((payload['id'], payload['switch']))
+        return 'response to {}'.format(payload['switch'])
+
+    command_queue = CommandQueue(send, window=0.2)
+    yield command_queue
+    command_queue.close()
+
+
+def test_newer_value_replaces_pending_command(queue, sent):
+    first = queue.submit(METHOD, {'id': 'a', 'switch': 1})
+    second = queue.submit(METHOD, {'id': 'a', 'switch': 0})
+    queue.flush()
+
+    assert sent == [('a', 0)]
+    assert first.result(5) == second.result(5) == 'response to 0'
+    assert queue.coalesced == 1
+    assert queue.sent == 1
+
+
+def test_devices_are_sent_in_submission_order(queue, sent):
+    for device_id in ('c', 'a', 'b'):
+        queue.submit(METHOD, {'id': device_id, 'switch': 1})
+    # Coalescing keeps the place of the first command of a device
+    queue.submit(METHOD, {'id': 'c', 'switch': 0})
+    queue.flush()
+
+    assert sent == [('c', 0), ('a', 1), ('b', 1)]
+
+
+def test_close_sends_pending_commands(queue, sent):
+    future = queue.submit(METHOD, {'id': 'a', 'switch': 1})
+    queue.close()
+
+    assert sent == [('a', 1)]
+    assert future.done()
+
+
+def test_failed_send_fails_the_futures():
+    def send(method, payload):
+        raise IOError('hub unreachable')
+
+    failing = CommandQueue(send, window=0)
+    future = failing.submit(METHOD, {'id': 'a', 'switch': 1})
+    failing.close()
+
+    with pytest.raises(IOError):
+        future.result(5)
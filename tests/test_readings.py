@@ -0,0 +1,49 @@
+"""Tests of parsing device status strings."""
+import pytest
+
+from pyclimax.readings import parse_dimmer, parse_sensor, parse_switch
+
+
+@pytest.mark.parametrize('status, on, power', [
+    ('On, 1.3W', True, 1.3),
+    ('Off, 0.0W', False, 0.0),
+    ('Off', False, 0.0),
+    ('On', True, 0.0),
+    (' On , 12W', True, 12.0),
+    ('garbage', False, 0.0),
+    (None, False, 0.0),
+])
+def test_switch(status, on, power):
+    reading = parse_switch(status)
+
+    assert reading.status == status
+    assert reading.on is on
+    assert reading.power == power
+
+
+@pytest.mark.parametrize('status, on, level', [
+    ('On (84%)', True, 84),
+    ('Off', False, 0),
+    ('On', True, 0),
+])
+def test_dimmer(status, on, level):
+    reading = parse_dimmer(status)
+
+    assert (reading.on, reading.level) == (on, level)
+
+
+@pytest.mark.parametrize('status, temperature, energy', [
+    ('21.25 °C', 21.25, 0.0),
+    ('21.25 C', 21.25, 0.0),
+    ('21.25°C', 21.25, 0.0),
+    ('-3.5 °C', -3.5, 0.0),
+    ('-12 C', -12.0, 0.0),
+    ('29945.742kWh', 0.0, 29945.742),
+    ('', 0.0, 0.0),
+    ('n/a', 0.0, 0.0),
+])
+def test_sensor(status, temperature, energy):
+    reading = parse_sensor(status)
+
+    assert reading.temperature == temperature
+    assert reading.energy == energy
@@ -0,0 +1,44 @@
+"""Tests of reading devices through the device list cache."""
+import time
+
+import pyclimax
+
+
+def _switch(controller):
+    return [device for device in controller.get_devices()
+            if isinstance(device, pyclimax.ClimaxSwitch)][0]
+
+
+def test_refresh_never_returns_expired_state(hub, controllers):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                           max_age=0.2)
+    controllers.append(controller)
+    switch = _switch(controller)
+    hub.update(switch.device_id, on=False)
+    switch.refresh()
+    hub.update(switch.device_id, on=True)
+    time.sleep(1)
+
+    assert switch.is_switched_on(refresh=True)
+
+
+def test_expired_list_is_served_within_max_stale(hub, controllers):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                           max_age=0.2, max_stale=10)
+    controllers.append(controller)
+    before = controller.get_device_list()
+    hub.mutate(1)
+    time.sleep(0.5)
+
+    assert controller.get_device_list() is before
+
+
+def test_list_older_than_max_stale_is_fetched(hub, controllers):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                           max_age=0.2, max_stale=0.2)
+    controllers.append(controller)
+    before = controller.get_device_list()
+    hub.mutate(1)
+    time.sleep(0.5)
+
+    assert controller.get_device_list() is not before
@@ -0,0 +1,38 @@
+"""Tests of the poll scheduler."""
+from pyclimax.changes import ChangeSet
+from pyclimax.scheduler import PollScheduler
+
+
+def test_held_polls_follow_each_other_fast_while_active():
+    scheduler = PollScheduler(active_interval=0.2, min_interval=1)
+    scheduler.command_sent()
+    scheduler.poll_succeeded(False, held=True)
+
+    assert scheduler.next_delay() == 0.2
+
+
+def test_hub_answering_at_once_is_polled_at_most_every_min_interval():
+    scheduler = PollScheduler(active_interval=0.2, min_interval=1)
+    scheduler.command_sent()
+    scheduler.poll_succeeded(False)
+
+    assert scheduler.next_delay() == 1
+
+
+def test_activity_speeds_up_hub_answering_at_once():
+    scheduler = PollScheduler(active_interval=0.2, idle_interval=2,
+                              active_period=0, min_interval=1)
+    for _ in range(10):
+        scheduler.poll_succeeded(False)
+    assert scheduler.next_delay() == 2
+
+    scheduler.poll_succeeded(ChangeSet(changed={'a': {'status': (0, 1)}})
+                             .activity)
+    assert scheduler.next_delay() == 0.2
+
+
+def test_rssi_changes_are_not_activity():
+    noise = ChangeSet(changed={'a': {'rssi': ('Strong, 5', 'Strong, 6')}})
+
+    assert not noise.activity
+    assert ChangeSet(removed=['a']).activity
@@ -0,0 +1,54 @@
+"""Tests of warm-start snapshots."""
+import os
+
+import pyclimax
+from pyclimax.snapshot import SnapshotStore
+
+URL = 'http://climax:80'
+MAC = '00:1d:94:00:00:01'
+DEVICES = {'senrows': [{'id': 'ZB:01', 'type': 48, 'status': 'On, 1.0W'}]}
+
+
+def test_round_trip(tmpdir):
+    store = SnapshotStore(str(tmpdir))
+    store.save(URL, MAC, {'mac': MAC, 'version': '1.0'}, DEVICES,
+               saved_at=100.0)
+
+    snapshot = SnapshotStore(str(tmpdir)).load(URL)
+
+    assert snapshot['mac'] == MAC
+    assert snapshot['saved_at'] == 100.0
+    assert snapshot['welcome'] == {'mac': MAC, 'version': '1.0'}
+    assert snapshot['devices'] == DEVICES
+
+
+def test_unknown_or_unreadable_snapshot_is_ignored(tmpdir):
+    store = SnapshotStore(str(tmpdir))
+    assert store.load(URL) is None
+
+    store.save(URL, MAC, {}, DEVICES)
+    with open(os.path.join(str(tmpdir), MAC.replace(':', '-') + '.json'),
+              'w') as snapshot_file:
+        snapshot_file.write('{"version": 1, "mac"')
+
+    assert store.load(URL) is None
+
+
+def test_warm_start_restores_devices(hub, controllers, tmpdir):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                           snapshot=str(tmpdir))
+    controller.refresh_data()
+    devices = [(device.device_id, device.name)
+               for device in controller.get_devices()]
+    controller.close()
+
+    hub.close()
+    restarted = pyclimax.ClimaxController(hub.url, 'user', 'password',
+                                          snapshot=str(tmpdir))
+    controllers.append(restarted)
+
+    assert restarted.warm_start()
+    assert [(device.device_id, device.name)
+            for device in restarted.devices] == devices
+    assert restarted.mac == controller.mac
+    assert restarted.device_cache.stale
@@ -0,0 +1,56 @@
+"""Tests of the stats and their Prometheus exposition."""
+import pyclimax
+from pyclimax.stats import Histogram, prometheus_text, Stats
+
+
+def test_histogram_quantiles():
+    histogram = Histogram((1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3.0):
+        histogram.observe(value)
+
+    assert histogram.counts == [1, 2, 1, 0]
+    assert histogram.quantile(0.5) == 1.5
+    assert histogram.snapshot()['max'] == 3.0
+    assert Histogram().quantile(0.5) is None
+
+
+def test_prometheus_text():
+    stats = Stats(buckets=(0.1, 1))
+    stats.count('errors', 'ConnectionError')
+    stats.count('errors', 'ConnectionError')
+    stats.observe('request_seconds', 'deviceListGet', 0.05)
+    stats.observe('request_seconds', 'deviceListGet', 0.5)
+
+    lines = prometheus_text([(stats, {'hub': 'http://a"b'})]).splitlines()
+
+    assert '# TYPE pyclimax_errors_total counter' in lines
+    assert ('pyclimax_errors_total{hub="http://a\\"b",'
+            'kind="ConnectionError"} 2') in lines
+    assert '# TYPE pyclimax_request_seconds histogram' in lines
+    bucket = 'pyclimax_request_seconds_bucket{{hub="http://a\\"b",' \
+             'method="deviceListGet",le="{}"}} {}'
+    assert bucket.format(0.1, 1) in lines
+    assert bucket.format(1, 2) in lines
+    assert bucket.format('+Inf', 2) in lines
+    assert ('pyclimax_request_seconds_count{hub="http://a\\"b",'
+            'method="deviceListGet"} 2') in lines
+
+
+def test_disabled_stats_record_nothing():
+    stats = Stats()
+    stats.enabled = False
+    stats.count('errors', 'Timeout')
+
+    assert stats.snapshot() == {}
+
+
+def test_controller_exposes_request_metrics(hub, controllers):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password')
+    controllers.append(controller)
+    controller.get_devices()
+
+    text = controller.prometheus()
+
+    assert ('pyclimax_request_seconds_count{{hub="{}",'
+            'method="deviceListGet"}} 1').format(hub.url) in text
+    assert 'pyclimax_received_bytes_total' in text
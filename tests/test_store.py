@@ -0,0 +1,61 @@
+"""Tests of reopening a time-series store after an interrupted write."""
+import os
+import time
+
+import pytest
+
+import pyclimax
+
+np = pytest.importorskip('numpy')
+store = pytest.importorskip('pyclimax.store')
+
+
+def _devices(hub):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password')
+    try:
+        return controller.get_devices()
+    finally:
+        controller.close()
+
+
+def test_reopen_after_partial_write(hub, tmpdir):
+    devices = _devices(hub)
+    now = time.time()
+    with store.TimeSeriesStore(str(tmpdir)) as series:
+        for offset, device in enumerate(devices):
+            series.add(device, now=now + offset)
+    segment = series.segments()[0]
+    rows = len(segment)
+    assert rows == len(devices)
+
+    # A crash after appending to some of the columns of a batch
+    for name, dtype in store._COLUMNS[:3]:
+        path = os.path.join(segment.path, '{}.{}'.format(name, dtype.str[1:]))
+        with open(path, 'ab') as column_file:
+            column_file.write(np.zeros(2, dtype=dtype).tobytes())
+
+    series = store.TimeSeriesStore(str(tmpdir))
+    assert len(series.segments()[0]) == rows
+    series.add(devices[0], now=now + 100)
+    series.close()
+
+    segment = series.segments()[0]
+    assert len(segment) == rows + 1
+    assert segment.columns['time'][-1] == now + 100
+    assert (segment.columns['device'][-1]
+            == segment.columns['device'][0])
+    for name, dtype in store._COLUMNS:
+        path = os.path.join(segment.path, '{}.{}'.format(name, dtype.str[1:]))
+        assert os.path.getsize(path) == (rows + 1) * dtype.itemsize
+
+
+def test_device_key_is_stable_once_mac_is_known(hub):
+    controller = pyclimax.ClimaxController(hub.url, 'user', 'password')
+    try:
+        device = controller.get_devices()[0]
+        before = store.device_key(device)
+        controller.refresh_data()
+        assert controller.mac
+        assert store.device_key(device) == before
+    finally:
+        controller.close()